@@ -0,0 +1,326 @@
+import os
+# 禁止生成 __pycache__ 文件
+os.environ['PYTHONDONTWRITEBYTECODE'] = '1'
+
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import math
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import yaml
+
+TEMP_DIR = "tmp"
+if not os.path.exists(TEMP_DIR):
+    os.makedirs(TEMP_DIR)
+
+logger = logging.getLogger("benchmark")
+
+# 录音的格式，与 WebSocketRecorder 要求的一致
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+# 报告的阶段和分位数
+STAGES = ["vad", "asr", "llm", "tools", "tts", "prepare", "thg"]
+PERCENTILES = [50, 90, 95, 99]
+
+DEFAULT_REPLY = "好的，我来帮你看一下。今天北京天气晴朗，气温十八到二十六度，适合出门散步。还有其他需要帮忙的吗？"
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """
+    模拟 Ollama 的 /api/chat：固定的回复内容，首token延迟和token间隔可配置，结果可重复。
+    流式请求按 Ollama 的格式逐行返回 JSON（chunked 编码），非流式请求一次返回完整回复
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(f"fake ollama: {format % args}")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            request = {}
+        if self.path != "/api/chat":
+            self.send_error(404)
+            return
+        server = self.server
+        if not request.get("stream"):
+            time.sleep(server.ttft_ms / 1000)
+            body = json.dumps(self._chunk(server.reply, done=True), ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(server.ttft_ms / 1000)
+        tokens = [server.reply[i:i + server.chars_per_token] for i in range(0, len(server.reply), server.chars_per_token)]
+        try:
+            for i, token in enumerate(tokens):
+                if i > 0:
+                    time.sleep(server.token_ms / 1000)
+                self._write_chunk(self._chunk(token))
+            self._write_chunk(self._chunk("", done=True))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 用户打断时客户端关闭连接
+            pass
+
+    def _chunk(self, content, done=False):
+        return {"model": "fake", "message": {"role": "assistant", "content": content}, "done": done}
+
+    def _write_chunk(self, data):
+        line = json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, reply=DEFAULT_REPLY, ttft_ms=300, token_ms=30, chars_per_token=2, port=0):
+        super().__init__(("127.0.0.1", port), FakeOllamaHandler)
+        self.reply = reply
+        self.ttft_ms = ttft_ms
+        self.token_ms = token_ms
+        self.chars_per_token = chars_per_token
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"fake ollama 已启动: {self.url}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def build_config(config_path, work_dir, llm_url, args) -> str:
+    """在原配置的基础上替换为本地替身：fake Ollama、静音TTS、不生成视频、不出声的播放器，写入临时配置文件"""
+    with open(config_path, "r", encoding="utf-8") as file:
+        config = yaml.safe_load(file)
+    config["interrupt"] = False
+    config["StartTaskMode"] = False
+    selected = config["selected_module"]
+    selected.update(Recorder="WebSocketRecorder", LLM="OllamaLLM", TTS="SilentTTS", THG="NullTHG", Player="NullPlayer")
+    config.setdefault("Recorder", {}).setdefault("WebSocketRecorder", {"codecs": ["pcm"]})
+    config.setdefault("LLM", {})["OllamaLLM"] = {"model_name": "fake", "url": llm_url}
+    config.setdefault("TTS", {})["SilentTTS"] = {
+        "output_file": os.path.join(work_dir, "tts/"),
+        "latency_ms": args.tts_ms,
+        "seconds_per_char": args.seconds_per_char,
+    }
+    config.setdefault("THG", {})["NullTHG"] = None
+    config.setdefault("Player", {})["NullPlayer"] = {"realtime": not args.no_playback_wait}
+    config.setdefault("Memory", {})["dialogue_history_path"] = os.path.join(work_dir, "dialogues/")
+    os.makedirs(config["Memory"]["dialogue_history_path"], exist_ok=True)
+    config["Tracing"] = {"enabled": True, "directory": os.path.join(work_dir, "traces/"), "sample_rate": 1.0}
+    bench_config = os.path.join(work_dir, "config.yaml")
+    with open(bench_config, "w", encoding="utf-8") as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+    return bench_config
+
+
+def read_wav(path) -> bytes:
+    """读取 16kHz 单声道 16bit 的 wav，返回 PCM 数据"""
+    with wave.open(path, "rb") as wf:
+        if wf.getframerate() != SAMPLE_RATE or wf.getnchannels() != 1 or wf.getsampwidth() != SAMPLE_WIDTH:
+            raise ValueError(f"{path} 需要是 16kHz 单声道 16bit 的 wav，"
+                             f"实际为 {wf.getframerate()}Hz {wf.getnchannels()} 声道 {wf.getsampwidth() * 8}bit")
+        return wf.readframes(wf.getnframes())
+
+
+def list_audio(paths) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.wav"))))
+        else:
+            files.append(path)
+    return files
+
+
+def percentile(values, p):
+    """最近秩法分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(values) -> Dict:
+    if not values:
+        return {"count": 0}
+    result = {"count": len(values), "mean": round(sum(values) / len(values), 1)}
+    for p in PERCENTILES:
+        result[f"p{p}"] = round(percentile(values, p), 1)
+    result["max"] = round(max(values), 1)
+    return result
+
+
+def load_traces(directory) -> List[Dict]:
+    traces = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.jsonl"))):
+        with open(path, "r", encoding="utf-8") as file:
+            traces.extend(json.loads(line) for line in file if line.strip())
+    return traces
+
+
+def build_report(traces, expected_turns) -> Dict:
+    voice = [t for t in traces if t["attributes"].get("source") == "voice"]
+    ttfa = [t["ttfa_ms"] for t in voice if t.get("ttfa_ms") is not None]
+    stages = {stage: [] for stage in STAGES}
+    ttft = []
+    for trace in voice:
+        for span in trace["spans"]:
+            if span["name"] in stages:
+                stages[span["name"]].append(span["duration_ms"])
+            if span["name"] == "llm" and span["attributes"].get("ttft_ms") is not None:
+                ttft.append(span["attributes"]["ttft_ms"])
+    return {
+        "turns": expected_turns,
+        "completed": len(ttfa),
+        "ttfa_ms": summarize(ttfa),
+        "llm_ttft_ms": summarize(ttft),
+        "stages_ms": {stage: summarize(values) for stage, values in stages.items() if values},
+    }
+
+
+def print_report(report):
+    columns = ["count", "mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+    print(f"\n回合数: {report['turns']}，有首音的回合: {report['completed']}")
+    print(f"{'指标(ms)':<14}" + "".join(f"{c:>10}" for c in columns))
+    rows = [("ttfa", report["ttfa_ms"]), ("llm_ttft", report["llm_ttft_ms"])]
+    rows += list(report["stages_ms"].items())
+    for name, stats in rows:
+        print(f"{name:<14}" + "".join(f"{str(stats.get(c, '-')):>10}" for c in columns))
+
+
+async def replay(robot, audio_files, args):
+    """把录音按实时速度（或 --speed 倍速）送入 WebSocketRecorder，每段说完等本轮回复播放结束再送下一段"""
+    from src.pipeline import SessionPipeline, SharedPools
+    from src.session_manager import Session
+
+    loop = asyncio.get_running_loop()
+    session = Session("benchmark", robot)
+    pipeline = SessionPipeline(session, SharedPools.instance({}), loop)
+    session.pipeline = pipeline
+    pipeline.start(voice=True)
+
+    chunk_bytes = int(SAMPLE_RATE * args.chunk_ms / 1000) * SAMPLE_WIDTH
+    silence = b"\x00" * (int(SAMPLE_RATE * args.tail_silence_ms / 1000) * SAMPLE_WIDTH)
+    turns = 0
+    try:
+        for round_index in range(args.repeat):
+            for path in audio_files:
+                pcm = read_wav(path) + silence
+                previous = pipeline.turn_task
+                for start in range(0, len(pcm), chunk_bytes):
+                    robot.recorder.put_audio(pcm[start:start + chunk_bytes])
+                    if args.speed > 0:
+                        await asyncio.sleep(args.chunk_ms / 1000 / args.speed)
+                    else:
+                        await asyncio.sleep(0)
+                turns += 1
+                deadline = loop.time() + args.timeout
+                # 等VAD检测到说话结束、本轮处理完，并且回复播放完
+                while loop.time() < deadline:
+                    task = pipeline.turn_task
+                    if task is not previous and task is not None and task.done() \
+                            and not robot.player.get_playing_status():
+                        break
+                    await asyncio.sleep(0.01)
+                else:
+                    logger.warning(f"{path} 在 {args.timeout} 秒内没有完成一轮对话（没有检测到语音或处理超时）")
+                logger.info(f"[{round_index + 1}/{args.repeat}] {os.path.basename(path)} 完成")
+    finally:
+        pipeline.stop()
+    return turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回放录音，测量端到端语音延迟（首音延迟、ASR及各阶段耗时分位数）")
+    parser.add_argument("audio", nargs="+", help="16kHz 单声道 16bit 的 wav 文件或包含 wav 的目录")
+    parser.add_argument("--config_path", type=str, default="config/config.yaml", help="配置文件，ASR/VAD 等使用其中的配置")
+    parser.add_argument("--repeat", type=int, default=1, help="重复回放的次数")
+    parser.add_argument("--speed", type=float, default=1.0, help="送入音频的速度倍数，0 表示不等待")
+    parser.add_argument("--chunk_ms", type=int, default=20, help="每次 put_audio 的音频时长")
+    parser.add_argument("--tail_silence_ms", type=int, default=1000, help="每段录音后追加的静音，用于触发VAD结束")
+    parser.add_argument("--timeout", type=float, default=60, help="每轮对话的最长等待秒数")
+    parser.add_argument("--llm_ttft_ms", type=int, default=300, help="fake Ollama 的首token延迟")
+    parser.add_argument("--llm_token_ms", type=int, default=30, help="fake Ollama 的token间隔")
+    parser.add_argument("--reply", type=str, default=DEFAULT_REPLY, help="fake Ollama 的回复内容")
+    parser.add_argument("--tts_ms", type=int, default=100, help="静音TTS每句的耗时")
+    parser.add_argument("--seconds_per_char", type=float, default=0.2, help="静音TTS每个字的音频时长")
+    parser.add_argument("--no_playback_wait", action="store_true", help="播放立即完成，不按音频时长等待")
+    parser.add_argument("--output", type=str, help="把报告写入 JSON 文件")
+    parser.add_argument("--max_p95_ttfa_ms", type=float, help="首音延迟 p95 超过该值时以非0状态退出，用于CI")
+    parser.add_argument("--log_level", type=str, default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.WARNING),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(os.path.join(TEMP_DIR, 'benchmark.log'))
+        ]
+    )
+
+    audio_files = list_audio(args.audio)
+    if not audio_files:
+        parser.error("没有找到 wav 文件")
+    for path in audio_files:
+        read_wav(path)
+
+    llm_server = FakeOllamaServer(args.reply, args.llm_ttft_ms, args.llm_token_ms).start()
+    work_dir = tempfile.mkdtemp(prefix="benchmark-", dir=TEMP_DIR)
+    config_path = build_config(args.config_path, work_dir, llm_server.url, args)
+
+    from src.robot import Robot
+
+    robot = Robot(config_path)
+    try:
+        turns = asyncio.run(replay(robot, audio_files, args))
+    finally:
+        robot.shutdown()
+        llm_server.stop()
+
+    report = build_report(load_traces(os.path.join(work_dir, "traces/")), turns)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    logger.info(f"本次回放的配置、对话记录和 trace 保存在 {work_dir}")
+
+    p95 = report["ttfa_ms"].get("p95")
+    if report["completed"] < turns:
+        logger.error(f"{turns - report['completed']} 轮对话没有播放出声音")
+        sys.exit(1)
+    if args.max_p95_ttfa_ms is not None and p95 is not None and p95 > args.max_p95_ttfa_ms:
+        logger.error(f"首音延迟 p95 {p95}ms 超过阈值 {args.max_p95_ttfa_ms}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
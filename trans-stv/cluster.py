@@ -0,0 +1,192 @@
+import os
+# 禁止生成 __pycache__ 文件
+os.environ['PYTHONDONTWRITEBYTECODE'] = '1'
+
+import argparse
+import asyncio
+import itertools
+import logging
+import signal
+import subprocess
+import sys
+from typing import Dict
+from urllib.parse import urlsplit, parse_qs
+
+import yaml
+
+TEMP_DIR = "tmp"
+if not os.path.exists(TEMP_DIR):
+    os.makedirs(TEMP_DIR)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(),  # 控制台输出
+        logging.FileHandler(os.path.join(TEMP_DIR, 'cluster.log'))  # 文件输出到temp目录
+    ]
+)
+
+from src.hash_ring import HashRing
+from src.signaling import SignalingHub
+
+logger = logging.getLogger(__name__)
+
+# HTTP 请求头的最大长度
+MAX_HEADER_SIZE = 64 * 1024
+SERVICE_UNAVAILABLE = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+class Worker:
+    """一个 server.py 工作进程，只监听本机端口"""
+
+    def __init__(self, worker_id: str, port: int, command: list):
+        self.worker_id = worker_id
+        self.port = port
+        self.command = command
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command)
+        logger.info(f"worker {self.worker_id} 已启动，端口 {self.port}，pid {self.process.pid}")
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class Dispatcher:
+    """
+    前端分发进程：在 TCP 层转发 HTTP/WebSocket 连接。
+    读取请求行中的 user_id，用一致性哈希固定分配到某个 worker，同一用户的 /ws 和 /webrtc 总是落在同一个 worker；
+    没有 user_id 的请求（静态资源、理财接口等无状态请求）轮询分配。
+    """
+
+    def __init__(self, workers: Dict[str, Worker]):
+        self.workers = workers
+        self.ring = HashRing(list(workers))
+        self._round_robin = itertools.cycle(list(workers))
+
+    def pick(self, target: str) -> Worker:
+        user_id = parse_qs(urlsplit(target).query).get("user_id")
+        if user_id:
+            return self.workers[self.ring.get(user_id[0])]
+        return self.workers[next(self._round_robin)]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        try:
+            request_line = head.split(b"\r\n", 1)[0].decode("latin-1")
+            target = request_line.split(" ")[1]
+        except IndexError:
+            writer.write(BAD_REQUEST)
+            writer.close()
+            return
+
+        worker = self.pick(target)
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", worker.port)
+        except OSError as e:
+            logger.warning(f"worker {worker.worker_id} 不可用: {e}")
+            writer.write(SERVICE_UNAVAILABLE)
+            writer.close()
+            return
+
+        upstream_writer.write(head)
+        await asyncio.gather(
+            self._pipe(reader, upstream_writer),
+            self._pipe(upstream_reader, writer),
+        )
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            # 一端关闭后关闭另一端，另一个方向的转发随之结束
+            writer.close()
+
+
+async def supervise(workers: Dict[str, Worker], stop_event: asyncio.Event):
+    """worker 异常退出后自动重启"""
+    while not stop_event.is_set():
+        for worker in workers.values():
+            if not worker.alive():
+                logger.error(f"worker {worker.worker_id} 已退出，重新启动")
+                worker.start()
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=2)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main(args):
+    with open(args.config_path, "r", encoding="utf-8") as file:
+        server_config = (yaml.safe_load(file) or {}).get("Server") or {}
+    worker_count = args.workers or server_config.get("workers") or os.cpu_count() or 1
+    base_port = args.worker_base_port or server_config.get("worker_base_port", 8001)
+    socket_path = os.path.abspath(os.path.join(TEMP_DIR, "signaling.sock"))
+
+    hub = SignalingHub(socket_path, server_config.get("max_room_size", 2))
+    await hub.start()
+
+    workers = {}
+    for i in range(worker_count):
+        worker_id = str(i)
+        port = base_port + i
+        command = [sys.executable, "server.py",
+                   "--config_path", args.config_path,
+                   "--host", "127.0.0.1",
+                   "--port", str(port),
+                   "--worker_id", worker_id,
+                   "--signaling_socket", socket_path]
+        workers[worker_id] = Worker(worker_id, port, command)
+        workers[worker_id].start()
+
+    dispatcher = Dispatcher(workers)
+    server = await asyncio.start_server(dispatcher.handle, args.host, args.port, limit=MAX_HEADER_SIZE)
+    logger.info(f"分发进程已启动 {args.host}:{args.port}，worker 数量 {worker_count}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    supervisor = asyncio.create_task(supervise(workers, stop_event))
+    await stop_event.wait()
+
+    logger.info("正在关闭所有 worker...")
+    server.close()
+    await supervisor
+    for worker in workers.values():
+        worker.stop()
+    await hub.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="多进程部署：分发进程 + 多个 server.py worker")
+    parser.add_argument('--config_path', type=str, help="配置文件", default="config/config.yaml")
+    parser.add_argument('--host', type=str, help="对外监听地址", default="0.0.0.0")
+    parser.add_argument('--port', type=int, help="对外监听端口", default=8000)
+    parser.add_argument('--workers', type=int, help="worker 进程数，默认等于CPU核数", default=None)
+    parser.add_argument('--worker_base_port', type=int, help="worker 起始端口", default=None)
+    asyncio.run(main(parser.parse_args()))
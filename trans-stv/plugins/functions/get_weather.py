@@ -4,7 +4,8 @@ from bs4 import BeautifulSoup
 from plugins.registry import register_function, ToolType
 from plugins.registry import ActionResponse, Action
 
-@register_function('get_weather', ToolType.WAIT)
+# 天气几分钟内不会变化，同一城市的查询在所有会话间共享结果
+@register_function('get_weather', ToolType.WAIT, cache_ttl=600)
 def get_weather(city: str):
     """
     "获取某个地点的天气，用户应先提供一个位置，参数为：该地区所在省份的名称拼音全拼小写/该地区名称的拼音全拼小写，\n比如用户说杭州天气，参数为：zhejiang/hangzhou，\n\n比如用户说北京天气怎么样，参数为：beijing/beijing",
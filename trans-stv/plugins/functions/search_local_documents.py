@@ -2,7 +2,7 @@ from plugins.registry import register_function, ToolType
 from plugins.registry import ActionResponse, Action
 from src.rag import Rag
 
-@register_function('search_local_documents', action=ToolType.TIME_CONSUMING)
+@register_function('search_local_documents', action=ToolType.TIME_CONSUMING, cache_ttl=300)
 def search_local_documents(keyword: str):
     rsp = Rag().query(keyword)
     return ActionResponse(Action.RESPONSE, None, rsp)
@@ -5,14 +5,14 @@ from plugins.registry import register_function, ToolType
 from plugins.registry import ActionResponse, Action
 
 
-@register_function('web_search', action=ToolType.TIME_CONSUMING)
+@register_function('web_search', action=ToolType.TIME_CONSUMING, cache_ttl=300, cache_key=("query", "engine"))
 def web_search(query, engine="baidu"):
     """
     在指定的搜索引擎上进行搜索，并返回搜索结果页面的 HTML 内容。
 
     Args:
         query (str): 搜索关键词。
-        engine (str): 指定的搜索引擎，默认为 'google'。可以选择 'baidu'。
+        engine (str): 指定的搜索引擎，默认为 'baidu'。可以选择 'google'。
 
     Returns:
         str: 搜索结果页面的 HTML 内容。
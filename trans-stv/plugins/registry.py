@@ -8,12 +8,18 @@ logger = logging.getLogger(__name__)
 # 初始化函数注册字典
 function_registry = {}
 
-def register_function(name, action=None):
-    """注册函数到函数注册字典的装饰器"""
+def register_function(name, action=None, cache_ttl=None, cache_key=None):
+    """
+    注册函数到函数注册字典的装饰器
+    cache_ttl: 可选，结果缓存的秒数，只用于幂等的查询类工具；相同参数的调用在所有会话间共享结果
+    cache_key: 可选，缓存键策略：参与缓存键的参数名列表，或接收参数字典返回缓存键的函数；默认使用全部参数
+    """
     def decorator(func):
         function_registry[name] = func
         if action:
             func.action = action  # 将 action 属性添加到函数上
+        func.cache_ttl = cache_ttl
+        func.cache_key = cache_key
         logger.info(f"函数 '{name}' 注册成功")
         return func
     return decorator
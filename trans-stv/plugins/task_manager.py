@@ -2,11 +2,13 @@ import logging
 import importlib
 import pkgutil
 import queue
-import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, TimeoutError, as_completed
+from typing import List, Tuple
 
 from plugins.registry import function_registry, Action, ActionResponse, ToolType
+from plugins.tool_cache import ToolCache, cache_key
+from src.executors import SharedPools, INTERACTIVE, BACKGROUND, submit
 from src.utils import read_json_file
 
 
@@ -39,37 +41,40 @@ auto_import_modules('plugins.functions')
 
 
 class TaskManager:
-    def __init__(self, config, result_queue: queue.Queue):
+    def __init__(self, config, result_queue: queue.Queue, executor: Executor = None):
         self.functions = read_json_file(config.get("functions_call_name"))
         aigc_manus_enabled = config.get("aigc_manus_enabled", "false")
         if not aigc_manus_enabled:
             self.functions = [item for item in self.functions if item["function"]["name"] != 'aigc_manus']
-        self.task_queue = queue.Queue()
-        # 初始化线程池
-        self.task_executor = ThreadPoolExecutor(max_workers=10)
+        # 工具的线程池，所有会话共享；本轮的工具调用优先于后台工具
+        self.task_executor = executor or SharedPools.instance().tools
         self.result_queue = result_queue
+        # 同一轮回复中的工具并发执行，每个调用的等待时间（秒），tool_timeouts 可以按函数名单独配置
+        self.tool_timeout = config.get("tool_timeout", 10)
+        self.tool_timeouts = config.get("tool_timeouts") or {}
+        # 声明了 cache_ttl 的工具，结果缓存在所有会话共享的 LRU 中
+        self.cache = ToolCache.instance(config.get("tool_cache_size", 256))
 
     def get_functions(self):
         return self.functions
 
-    def process_task(self):
-        def task_thread():
-            while True:
-                try:
-                    # 从队列中取出已完成的任务
-                    while not self.task_queue.empty():
-                        future = self.task_queue.get()
-                        if future.done():  # 检查任务是否完成
-                            result = future.result()  # 获取任务结果
-                            self.result_queue.put(result)
-                        else:
-                            self.task_queue.put(future)  # 如果没有完成，放回队列
-                        time.sleep(1)
-                except Exception as e:
-                    logger.error(f"task_thread 处理出错: {e}")
-                time.sleep(2)
-        consumer_task = threading.Thread(target=task_thread, daemon=True)
-        consumer_task.start()
+    def _submit_background(self, func_name, func_args):
+        """后台执行工具，完成后把结果放入 result_queue，不再轮询检查任务状态"""
+        future = submit(self.task_executor, BACKGROUND, self.invoke, func_name, func_args)
+        future.add_done_callback(self._on_background_done)
+
+    def _on_background_done(self, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"后台任务出错: {e}")
+            return
+        if isinstance(result, ActionResponse):
+            self.result_queue.put(result)
+
+    def shutdown(self):
+        # 线程池由所有会话共享，随进程退出时关闭
+        pass
 
     @staticmethod
     def call_function(func_name, *args, **kwargs):
@@ -93,30 +98,68 @@ class TaskManager:
         except Exception as e:
             return f"调用函数 '{func_name}' 时出错：{str(e)}"
 
+    def invoke(self, func_name, func_args):
+        """调用工具；声明了 cache_ttl 的工具先查缓存，相同的请求正在执行时等待其结果"""
+        func = function_registry.get(func_name)
+        ttl = getattr(func, "cache_ttl", None)
+        if not ttl:
+            return self.call_function(func_name, **func_args)
+        return self.cache.call(cache_key(func_name, func, func_args), ttl,
+                               lambda: self.call_function(func_name, **func_args))
+
     def tool_call(self, func_name, func_args) -> ActionResponse:
         if func_name not in function_registry:
             return ActionResponse(action=Action.NOTFOUND, result="没有找到相应函数", response=None)
         func = function_registry[func_name]
+        if getattr(func, "cache_ttl", None):
+            # 缓存命中时直接返回，耗时任务也不用再转到后台
+            cached = self.cache.get(cache_key(func_name, func, func_args))
+            if cached is not None:
+                logger.info(f"工具 {func_name} 命中缓存")
+                return cached
         if func.action == ToolType.NONE: #  = (1, "调用完工具后，啥也不用管")
-            future = self.task_executor.submit(self.call_function, func_name, **func_args)
-            self.task_queue.put(future)
+            self._submit_background(func_name, func_args)
             return ActionResponse(action=Action.NONE, result=None, response=None)
         elif func.action == ToolType.WAIT: # = (2, "调用工具，等待函数返回")
-            result = self.call_function( func_name, **func_args)
+            result = self.invoke(func_name, func_args)
             return result
         elif func.action == ToolType.SCHEDULER: # = (3, "定时任务，时间到了之后，直接回复")
             result = self.call_function(func_name, **func_args)
             return result
         elif func.action == ToolType.TIME_CONSUMING: #  = (4, "耗时任务，需要一定时间，后台运行有结果后再回复")
-            future = self.task_executor.submit(self.call_function, func_name, **func_args)
-            self.task_queue.put(future)
+            self._submit_background(func_name, func_args)
             return ActionResponse(action=Action.RESPONSE, result=None, response="您好，正在查询信息中，一会查询完我会告诉你哟")
         elif func.action == ToolType.ADD_SYS_PROMPT: #  = (5, "增加系统指定到对话历史中去")
             result = self.call_function(func_name, **func_args)
             return result
         else:
-            result = self.call_function(func_name, **func_args)
+            result = self.invoke(func_name, func_args)
             return result
 
+    def tool_calls(self, calls: List[Tuple[str, dict]]) -> List[ActionResponse]:
+        """
+        并发执行一轮回复中的多个工具调用，按调用顺序返回结果。
+        每个调用有自己的截止时间，超时或出错的调用返回 REQLLM，由LLM告诉用户没有查到结果
+        """
+        start = time.monotonic()
+        futures = [submit(self.task_executor, INTERACTIVE, self.tool_call, name, args or {}) for name, args in calls]
+        results = []
+        for (name, _), future in zip(calls, futures):
+            deadline = start + self.tool_timeouts.get(name, self.tool_timeout)
+            try:
+                result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                future.cancel()
+                logger.warning(f"工具 {name} 调用超时")
+                result = ActionResponse(action=Action.REQLLM, result=f"工具 {name} 调用超时，没有返回结果", response=None)
+            except Exception as e:
+                logger.error(f"工具 {name} 调用出错: {e}")
+                result = ActionResponse(action=Action.REQLLM, result=f"工具 {name} 调用出错：{e}", response=None)
+            if not isinstance(result, ActionResponse):
+                # call_function 出错时返回错误信息字符串
+                result = ActionResponse(action=Action.REQLLM, result=str(result), response=None)
+            results.append(result)
+        return results
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,145 @@
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from plugins.registry import ActionResponse, Action
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(value):
+    """字符串去掉首尾空白、合并连续空白并忽略大小写，同一个问题的不同写法命中同一条缓存"""
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def _bound_args(func, func_args: dict) -> dict:
+    """按函数签名补上默认值：省略参数和显式传入默认值的调用得到相同的参数字典"""
+    try:
+        bound = inspect.signature(func).bind(**func_args)
+    except (TypeError, ValueError):
+        # 参数不匹配时调用本身会出错，缓存键保持原样即可
+        return func_args
+    bound.apply_defaults()
+    args = {}
+    for name, value in bound.arguments.items():
+        if bound.signature.parameters[name].kind == inspect.Parameter.VAR_KEYWORD:
+            args.update(value)
+        else:
+            args[name] = value
+    return args
+
+
+def cache_key(func_name, func, func_args: dict) -> str:
+    """
+    按工具声明的 cache_key 策略生成缓存键，参数先按函数签名补上默认值：
+    - None：使用全部参数
+    - 参数名列表：只使用这些参数
+    - 可调用对象：cache_key(参数字典) 返回缓存键
+    """
+    func_args = _bound_args(func, func_args)
+    policy = getattr(func, "cache_key", None)
+    if callable(policy):
+        return f"{func_name}:{policy(func_args)}"
+    args = func_args if policy is None else {k: func_args.get(k) for k in policy}
+    return f"{func_name}:{json.dumps(_normalize(args), ensure_ascii=False, sort_keys=True, default=str)}"
+
+
+def cacheable(result) -> bool:
+    """只缓存正常返回的结果；出错时 call_function 返回字符串，查询失败的工具不带 result"""
+    if not isinstance(result, ActionResponse):
+        return False
+    if result.action == Action.RESPONSE:
+        return bool(result.response)
+    return result.action == Action.REQLLM and result.result is not None
+
+
+class ToolCache:
+    """
+    工具结果缓存，所有会话共享。按 LRU 淘汰，每条记录有自己的过期时间（工具声明的 cache_ttl）。
+    同一个缓存键的请求正在执行时，后来的请求等待它的结果，不重复调用。
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        # key -> (过期时间, 结果)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight = {}
+        self._mutex = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @classmethod
+    def instance(cls, max_entries: int = 256):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls(max_entries)
+        return cls._instance
+
+    def get(self, key: str) -> Optional[object]:
+        """返回未过期的缓存结果，没有时返回 None"""
+        with self._mutex:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def call(self, key: str, ttl: float, fn: Callable[[], object]):
+        """命中缓存时直接返回；同样的请求正在执行时等待它的结果；否则执行 fn 并缓存 ttl 秒"""
+        with self._mutex:
+            result = self._get(key)
+            if result is not None:
+                return result
+            inflight = self._inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.debug(f"工具调用 {key} 正在执行，等待其结果")
+            return inflight.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            inflight.set_exception(e)
+            raise
+        finally:
+            with self._mutex:
+                self._inflight.pop(key, None)
+        if cacheable(result):
+            with self._mutex:
+                self._entries[key] = (time.monotonic() + ttl, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        inflight.set_result(result)
+        return result
+
+    def __len__(self):
+        return len(self._entries)
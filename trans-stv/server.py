@@ -10,10 +10,12 @@ import logging
 import asyncio
 import uvicorn
 import socket
-from fastapi import FastAPI, WebSocket, Query, WebSocketDisconnect, HTTPException
+import uuid
+from fastapi import FastAPI, WebSocket, Query, WebSocketDisconnect, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from fastapi.responses import Response
+from contextlib import asynccontextmanager, suppress
 from typing import Dict, List
 from pydantic import BaseModel
 import json
@@ -35,25 +37,96 @@ logging.basicConfig(
 )
 
 from src import robot
+from src.model_registry import get_registry
+from src.signaling import create_signaling, RoomFullError, DEFAULT_ROOM, CLOSE_ROOM_FULL
+from src.session_manager import Session, SessionManager, CLOSE_SESSION_EVICTED
+from src.executors import SharedPools
+from src.pipeline import SessionPipeline
+from src.admission import AdmissionController, REJECT, TEXT_ONLY, CLOSE_TRY_AGAIN_LATER
+from src.utils import read_config
+from src.catalog import ProductCatalog, read_products
+from src.metrics import REGISTRY as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from plugins.tool_cache import ToolCache
 logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description="Description of your script.")
 
 # Add arguments
 parser.add_argument('--config_path', type=str, help="配置文件", default="config/config.yaml")
+parser.add_argument('--host', type=str, help="监听地址", default="0.0.0.0")
+parser.add_argument('--port', type=int, help="监听端口", default=8000)
+# 多进程模式（由 cluster.py 启动）使用的参数
+parser.add_argument('--worker_id', type=str, help="worker编号", default=None)
+parser.add_argument('--signaling_socket', type=str, help="信令中心的Unix socket路径", default=None)
 
 # Parse arguments
 args = parser.parse_args()
 config_path = args.config_path
+server_config = read_config(config_path).get("Server") or {}
+queues_config = read_config(config_path).get("Queues") or {}
 
 # 存储对话历史
 dialogue: List[Dict] = []
 # 存储用户对话历史
 user_dialogues: Dict[str, List[Dict]] = {}
-active_robots: Dict[str, list] = {}
-# 存储WebRTC连接
-webrtc_connections: Dict[str, WebSocket] = {}
-TIMEOUT = 600
+# WebRTC信令转发，多进程模式下通过本机IPC在worker之间转发
+signaling = create_signaling(args.signaling_socket, args.worker_id, server_config.get("max_room_size", 2))
+# 会话管理：空闲过期、会话数上限
+sessions = SessionManager(
+    idle_timeout=server_config.get("idle_timeout", 600),
+    max_sessions=server_config.get("max_sessions", 100)
+)
+# 新会话准入控制：负载超出预算时拒绝、排队或以纯文字模式接入
+admission = AdmissionController.from_config(server_config.get("admission"))
+
+
+def _collect_queue_stats(field):
+    """按队列名汇总所有会话的队列状态"""
+    totals = {}
+    for session in list(sessions.sessions.values()):
+        if session.pipeline is None:
+            continue
+        for stats in session.pipeline.queue_stats():
+            totals[stats["name"]] = totals.get(stats["name"], 0) + stats[field]
+    return [({"queue": name}, value) for name, value in totals.items()]
+
+
+def _collect_dropped():
+    """在线会话的丢弃数加上已关闭会话留下的丢弃数，会话关闭时计数不会变小"""
+    totals = dict(sessions.retired_dropped)
+    for labels, value in _collect_queue_stats("dropped"):
+        totals[labels["queue"]] = totals.get(labels["queue"], 0) + value
+    return [({"queue": name}, value) for name, value in totals.items()]
+
+
+metrics_registry.gauge("trans_sessions", "当前会话数", lambda: [({}, len(sessions))])
+metrics_registry.gauge("trans_queue_depth", "各会话队列的当前长度之和", lambda: _collect_queue_stats("depth"))
+metrics_registry.counter("trans_queue_dropped", "各会话队列累计丢弃的项数，包括已关闭的会话", lambda: _collect_dropped())
+metrics_registry.gauge("trans_llm_inflight", "进行中的LLM请求数", lambda: [({}, admission.inflight_llm)])
+metrics_registry.counter("trans_admission_rejected", "因过载被拒绝的新会话数", lambda: [({}, admission.rejected)])
+metrics_registry.counter("trans_admission_text_only", "因过载以纯文字模式接入的新会话数", lambda: [({}, admission.text_only)])
+# 工具结果缓存，所有会话共享
+tool_cache = ToolCache.instance((read_config(config_path).get("TaskManager") or {}).get("tool_cache_size", 256))
+metrics_registry.counter("trans_tool_cache", "工具结果缓存的命中、未命中和合并的请求数", lambda: [
+    ({"result": "hit"}, tool_cache.hits), ({"result": "miss"}, tool_cache.misses), ({"result": "coalesced"}, tool_cache.coalesced)])
+
+# 所有会话共享的线程池：阻塞的模型推理、LLM 请求、工具调用都放到有界线程池中执行，不占用事件循环
+pools = SharedPools.instance(dict(server_config.get("pools") or {}, chat=server_config.get("chat_workers", 8)))
+metrics_registry.gauge("trans_pool_pending", "TTS、THG、工具线程池中排队等待的任务数",
+                       lambda: [({"pool": name}, value) for name, value in pools.pending().items()])
+
+
+def _tts_backlog():
+    """TTS 积压：共享 TTS 线程池中排队的任务，加上各会话预取窗口中还没播放和还没进入窗口的句子"""
+    backlog = pools.tts.pending()
+    for session in list(sessions.sessions.values()):
+        if session.pipeline is None:
+            continue
+        backlog += len(session.pipeline.speech_window) + session.pipeline.tts_queue.qsize()
+    return backlog
+
+
+admission.tts_backlog = _tts_backlog
 
 # 语音文件存储目录
 AUDIO_DIR = os.path.join(TEMP_DIR, "audio")
@@ -61,31 +134,23 @@ if not os.path.exists(AUDIO_DIR):
     os.makedirs(AUDIO_DIR)
     logger.info(f"创建语音文件存储目录: {AUDIO_DIR}")
 
-# 清理超时连接的任务
-async def cleanup_task():
-    while True:
-        now = time.time()
-        for uid, (robot_instance, ts) in list(active_robots.items()):
-            if now - ts > TIMEOUT:
-                try:
-                    robot_instance.recorder.stop_recording()
-                    robot_instance.shutdown()
-                    logger.info(f"{uid} 对应的robot已释放")
-                except Exception as e:
-                    logger.info(f"{uid} 对应的robot释放 出错: {e}")
-                active_robots.pop(uid, None)
-        await asyncio.sleep(10)
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动时执行
     logger.info("服务器启动")
-    # 启动清理任务
-    task = asyncio.create_task(cleanup_task())
+    # 预加载共享模型，所有会话共用一份
+    await asyncio.get_running_loop().run_in_executor(None, get_registry().preload, read_config(config_path))
+    await signaling.start()
+    # 启动会话过期清理任务
+    task = asyncio.create_task(sessions.run())
     yield
     # 关闭时执行
     task.cancel()
-    await task
+    with suppress(asyncio.CancelledError):
+        await task
+    sessions.shutdown()
+    await signaling.stop()
+    pools.shutdown()
     logger.info("服务器关闭")
 
 app = FastAPI(lifespan=lifespan)
@@ -129,27 +194,59 @@ assets_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__fil
 if os.path.exists(assets_path):
     app.mount("/assets", StaticFiles(directory=assets_path), name="assets")
 
-# 模拟理财产品数据
-financial_products = [
-    FinancialProduct(id=1, name="稳健增长混合基金", type="基金", risk_level="稳健型", expected_return=5.2, description="主要投资于优质股票和债券，风险适中，收益稳定"),
-    FinancialProduct(id=2, name="科技创新股票基金", type="基金", risk_level="积极型", expected_return=8.5, description="专注于科技创新领域的优质上市公司股票"),
-    FinancialProduct(id=3, name="国债逆回购", type="债券", risk_level="保守型", expected_return=2.8, description="安全性极高，流动性好的短期投资工具"),
-    FinancialProduct(id=4, name="货币市场基金", type="基金", risk_level="保守型", expected_return=3.0, description="投资于短期货币工具，流动性极佳"),
-    FinancialProduct(id=5, name="黄金ETF", type="商品", risk_level="稳健型", expected_return=4.5, description="跟踪黄金价格变动，对抗通胀的良好工具"),
-]
+# 理财产品目录，加载时校验字段并建立索引
+catalog_config = read_config(config_path).get("Catalog") or {}
+product_catalog = ProductCatalog(
+    [FinancialProduct(**p).model_dump() for p in read_products(catalog_config.get("products_file"))],
+    cache_size=catalog_config.get("cache_size", 256)
+)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """按 GET 请求的弱比较判断 If-None-Match：支持逗号分隔的多个 ETag、W/ 前缀和 *"""
+    if not if_none_match:
+        return False
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def catalog_response(request: Request, body: bytes, etag: str, headers: Dict[str, str] = None) -> Response:
+    """客户端的 If-None-Match 与 ETag 匹配时返回 304，不再重复发送产品数据"""
+    headers = dict(headers or {}, ETag=etag)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 格式的运行指标：各阶段延迟直方图、会话数、队列深度"""
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
 
 @app.get("/api/products")
-async def get_financial_products():
-    """获取所有理财产品列表"""
-    return financial_products
+async def get_financial_products(request: Request,
+                                 risk_level: str = None,
+                                 type: str = None,
+                                 page: int = Query(None, ge=1),
+                                 page_size: int = Query(catalog_config.get("page_size", 20), ge=1, le=500)):
+    """获取理财产品列表，可按风险等级、类型过滤；传入 page 时分页返回，总数放在 X-Total-Count 响应头"""
+    body, etag, total = product_catalog.list_page(risk_level, type, page, page_size)
+    return catalog_response(request, body, etag, {"X-Total-Count": str(total)})
 
 @app.get("/api/products/{product_id}")
-async def get_financial_product(product_id: int):
+async def get_financial_product(request: Request, product_id: int):
     """根据ID获取特定理财产品信息"""
-    for product in financial_products:
-        if product.id == product_id:
-            return product
-    raise HTTPException(status_code=404, detail="理财产品未找到")
+    entry = product_catalog.get(product_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="理财产品未找到")
+    return catalog_response(request, *entry)
 
 @app.post("/api/advice")
 async def get_financial_advice(request: FinancialAdviceRequest):
@@ -173,21 +270,9 @@ async def get_financial_advice(request: FinancialAdviceRequest):
     return {"advice": advice}
 
 @app.post("/api/recommendations")
-async def get_product_recommendations(request: ProductRecommendationRequest):
-    """根据用户需求推荐理财产品"""
-    # 这里应该调用实际的产品推荐逻辑
-    recommendations = []
-    
-    if request.risk_tolerance == "保守型":
-        recommendations = [p for p in financial_products if p.risk_level == "保守型"]
-    elif request.risk_tolerance == "稳健型":
-        recommendations = [p for p in financial_products if p.risk_level in ["保守型", "稳健型"]]
-    elif request.risk_tolerance == "积极型":
-        recommendations = [p for p in financial_products if p.risk_level in ["稳健型", "积极型"]]
-    else:
-        recommendations = financial_products
-    
-    return {"recommendations": recommendations}
+async def get_product_recommendations(request: ProductRecommendationRequest, http_request: Request):
+    """根据用户需求推荐理财产品，各风险偏好的推荐列表在目录加载时已预先计算"""
+    return catalog_response(http_request, *product_catalog.recommend(request.risk_tolerance))
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, user_id: str = Query(...)):
@@ -195,36 +280,58 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str = Query(...)):
     await websocket.accept()
     loop = asyncio.get_event_loop()
     logger.info("WebSocket连接已建立")
-    if user_id not in active_robots:
-        active_robots[user_id] = [robot.Robot(config_path, websocket, loop), time.time()]
-        threading.Thread(target=active_robots[user_id][0].run, daemon=True).start()
-    robot_instance = active_robots[user_id][0]
+    session = sessions.get(user_id)
+    if session is None:
+        # 已有会话的重连不受准入控制，只限制新会话
+        decision = await admission.admit(user_id)
+        if decision == REJECT:
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason="server busy")
+            return
+        # 创建 Robot 会读取配置、初始化播放器等，同样不放在事件循环上执行
+        robot_instance = await loop.run_in_executor(pools.chat, robot.Robot, config_path, websocket, loop, pools)
+        session = sessions.get(user_id)
+        if session is None:
+            session = Session(user_id, robot_instance, websocket, text_only=decision == TEXT_ONLY)
+            session.pipeline = SessionPipeline(session, pools, loop, queues_config, admission.track_llm)
+            # 纯文字模式不处理语音
+            session.pipeline.start(voice=not session.text_only)
+            for evicted in sessions.add(session):
+                logger.info(f"会话数达到上限，回收用户 {evicted.user_id} 的会话")
+                sessions.release_later(evicted, CLOSE_SESSION_EVICTED, "session evicted")
+        else:
+            # 同一用户并发连接，已经有会话了，释放多创建的 Robot
+            loop.run_in_executor(pools.chat, robot_instance.shutdown)
+    session.websocket = websocket
+    sessions.touch(user_id)
+    robot_instance = session.robot
     logger.info(f"用户 {user_id} 已连接")
+    if session.text_only:
+        await websocket.send_text(json.dumps({"type": "session_mode", "mode": TEXT_ONLY}))
     
     try:
         while True:
             msg = await websocket.receive()
+            if msg["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(msg.get("code", 1000))
 
-            if "bytes" in msg:
-                robot_instance.recorder.put_audio(msg["bytes"])
-            elif "text" in msg:
+            if msg.get("bytes") is not None:
+                if session.pipeline.voice:
+                    robot_instance.recorder.put_audio(msg["bytes"])
+            elif msg.get("text") is not None:
                 logger.info(f"收到请求:{msg}")
                 message_data = json.loads(msg["text"])
+                # 协商上行音频编码：{"type": "audio_format", "codec": "opus"}
+                if message_data.get("type") == "audio_format":
+                    codec = "pcm"
+                    if hasattr(robot_instance.recorder, "set_format"):
+                        codec = await loop.run_in_executor(None, robot_instance.recorder.set_format, message_data.get("codec"))
+                    await websocket.send_text(json.dumps({"type": "audio_format", "codec": codec}))
+                    continue
                 logger.info(f"收到请求:{message_data.get('content', '')}")
                 content = message_data.get("content", "")
-                # 处理用户消息
-                response_message=robot_instance.chat_tool_tts(content)
-                
-                # 通过WebSocket将response_message返回给前端
-                if response_message is not None:
-                    # 发送完整的对话历史，而不仅仅是当前的用户消息和助手回复
-                    full_dialogue = robot_instance.dialogue.get_llm_dialogue()
-                    await websocket.send_text(json.dumps({
-                        "type": "update_dialogue",
-                        "data": full_dialogue
-                    }, ensure_ascii=False))
-                logger.info(f"返回结果: {response_message}")
-            active_robots[user_id][1] = time.time()
+                # 处理用户消息，不阻塞读循环
+                session.pipeline.submit_text(content)
+            sessions.touch(user_id)
 
     except WebSocketDisconnect:
         logger.info(f"用户 {user_id} 断开连接")
@@ -235,13 +342,18 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str = Query(...)):
 
 
 @app.websocket("/webrtc")
-async def webrtc_endpoint(websocket: WebSocket, user_id: str = Query(...)):
-    """处理WebRTC信令服务器连接"""
+async def webrtc_endpoint(websocket: WebSocket, user_id: str = Query(...), room_id: str = Query(DEFAULT_ROOM)):
+    """处理WebRTC信令服务器连接，信令只在同一房间的成员之间转发"""
     await websocket.accept()
-    logger.info(f"WebRTC连接已建立，用户ID: {user_id}")
+    logger.info(f"WebRTC连接已建立，用户ID: {user_id}，房间: {room_id}")
     
-    # 存储连接
-    webrtc_connections[user_id] = websocket
+    # 加入房间
+    try:
+        await signaling.join(user_id, websocket, room_id)
+    except RoomFullError as e:
+        logger.warning(f"{e}，拒绝用户 {user_id}")
+        await websocket.close(code=CLOSE_ROOM_FULL, reason="room full")
+        return
     
     try:
         while True:
@@ -253,12 +365,8 @@ async def webrtc_endpoint(websocket: WebSocket, user_id: str = Query(...)):
             
             # 处理不同类型的信令消息
             if message['type'] == 'offer' or message['type'] == 'answer' or message['type'] == 'ice-candidate':
-                # 转发消息给其他用户（在实际应用中可能需要更复杂的逻辑）
-                # 这里简化处理，假设只有两个用户在通话
-                for uid, ws in webrtc_connections.items():
-                    if uid != user_id and ws.client_state.CONNECTED:
-                        await ws.send_text(data)
-                        break
+                # 指定了 target 时只发给该成员，否则发给房间内的其他成员
+                await signaling.relay(user_id, data, message.get('target'))
             
     except WebSocketDisconnect:
         logger.info(f"用户 {user_id} WebRTC连接断开")
@@ -266,8 +374,7 @@ async def webrtc_endpoint(websocket: WebSocket, user_id: str = Query(...)):
         logger.error(f"处理WebRTC消息时出错: {e}")
     finally:
         # 清理连接
-        if user_id in webrtc_connections:
-            del webrtc_connections[user_id]
+        await signaling.leave(user_id, websocket)
         logger.info("WebRTC连接已关闭")
 
 def get_lan_ip():
@@ -284,13 +391,13 @@ def get_lan_ip():
 if __name__ == '__main__':
     lan_ip = get_lan_ip()
     print(f"\n请在局域网中使用以下地址访问:")
-    print(f"https://{lan_ip}:8000\n")
+    print(f"https://{lan_ip}:{args.port}\n")
     logger.info("阿雅语音助手已启动")
     logger.info("支持语音输入和文本输入，可以转为语音回复")
     uvicorn.run(
         "server:app",
-        host="0.0.0.0",
-        port=8000,
+        host=args.host,
+        port=args.port,
         reload=False,  # 生产环境中关闭自动重载
         log_level="info"
     )
\ No newline at end of file
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 服务过载时关闭 websocket 使用的状态码（RFC 6455: Try Again Later）
+CLOSE_TRY_AGAIN_LATER = 1013
+
+# 准入结果
+ADMIT = "admit"
+TEXT_ONLY = "text_only"
+REJECT = "reject"
+
+# 超出预算时的处理方式
+OVERFLOW_REJECT = "reject"        # 直接拒绝，前端稍后重连
+OVERFLOW_QUEUE = "queue"          # 等待负载下降，超过 queue_timeout 仍未下降则拒绝
+OVERFLOW_TEXT_ONLY = "text_only"  # 接入但只提供文字对话，不处理语音
+
+
+def _cpu_sampler():
+    """优先使用 psutil 统计CPU占用，未安装时用系统平均负载估算"""
+    try:
+        import psutil
+        psutil.cpu_percent(interval=None)
+        return lambda: psutil.cpu_percent(interval=None)
+    except ImportError:
+        pass
+    if hasattr(os, "getloadavg"):
+        cpu_count = os.cpu_count() or 1
+        return lambda: os.getloadavg()[0] / cpu_count * 100
+    logger.warning("无法获取CPU占用，准入控制不考虑CPU")
+    return lambda: 0.0
+
+
+class AdmissionController:
+    """
+    新会话的准入控制。根据当前负载（进行中的LLM请求数、TTS积压、CPU占用）决定是否接入新的 /ws 会话，
+    已接入的会话不受影响，保证它们的延迟。预算为 0 表示不限制该项。
+    """
+
+    def __init__(self, max_inflight_llm: int = 0, max_tts_backlog: int = 0, max_cpu_percent: float = 0,
+                 overflow: str = OVERFLOW_REJECT, queue_timeout: float = 10, cpu_sample_interval: float = 1.0):
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_QUEUE, OVERFLOW_TEXT_ONLY):
+            raise ValueError(f"未知的过载处理方式: {overflow}")
+        self.max_inflight_llm = max_inflight_llm
+        self.max_tts_backlog = max_tts_backlog
+        self.max_cpu_percent = max_cpu_percent
+        self.overflow = overflow
+        self.queue_timeout = queue_timeout
+        self.cpu_sample_interval = cpu_sample_interval
+        # TTS 积压由调用方提供，例如 TTS 线程池排队的任务数加上各会话待播放的句子数
+        self.tts_backlog: Callable[[], int] = lambda: 0
+        self.inflight_llm = 0
+        self.rejected = 0
+        self.text_only = 0
+        self._lock = threading.Lock()
+        self._cpu = _cpu_sampler() if max_cpu_percent else (lambda: 0.0)
+        self._cpu_value = 0.0
+        self._cpu_sampled_at = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            max_inflight_llm=config.get("max_inflight_llm", 0),
+            max_tts_backlog=config.get("max_tts_backlog", 0),
+            max_cpu_percent=config.get("max_cpu_percent", 0),
+            overflow=config.get("overflow", OVERFLOW_REJECT),
+            queue_timeout=config.get("queue_timeout", 10),
+        )
+
+    @contextmanager
+    def track_llm(self):
+        """包住一次LLM调用，统计进行中的请求数"""
+        with self._lock:
+            self.inflight_llm += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.inflight_llm -= 1
+
+    def cpu_percent(self) -> float:
+        now = time.monotonic()
+        if now - self._cpu_sampled_at >= self.cpu_sample_interval:
+            self._cpu_value = self._cpu()
+            self._cpu_sampled_at = now
+        return self._cpu_value
+
+    def overload_reason(self) -> Optional[str]:
+        """返回超出预算的原因，没有超出时返回 None"""
+        if self.max_inflight_llm and self.inflight_llm >= self.max_inflight_llm:
+            return f"进行中的LLM请求 {self.inflight_llm} >= {self.max_inflight_llm}"
+        if self.max_tts_backlog:
+            backlog = self.tts_backlog()
+            if backlog >= self.max_tts_backlog:
+                return f"TTS积压 {backlog} >= {self.max_tts_backlog}"
+        if self.max_cpu_percent:
+            cpu = self.cpu_percent()
+            if cpu >= self.max_cpu_percent:
+                return f"CPU占用 {cpu:.0f}% >= {self.max_cpu_percent}%"
+        return None
+
+    async def admit(self, user_id: str) -> str:
+        """决定新会话的接入方式：ADMIT、TEXT_ONLY 或 REJECT"""
+        reason = self.overload_reason()
+        if reason is None:
+            return ADMIT
+        if self.overflow == OVERFLOW_QUEUE:
+            deadline = time.monotonic() + self.queue_timeout
+            while reason is not None and time.monotonic() < deadline:
+                await asyncio.sleep(min(self.cpu_sample_interval, 0.5))
+                reason = self.overload_reason()
+            if reason is None:
+                return ADMIT
+        if self.overflow == OVERFLOW_TEXT_ONLY:
+            self.text_only += 1
+            logger.warning(f"服务负载过高（{reason}），用户 {user_id} 以纯文字模式接入")
+            return TEXT_ONLY
+        self.rejected += 1
+        logger.warning(f"服务负载过高（{reason}），拒绝用户 {user_id} 的新会话")
+        return REJECT
@@ -0,0 +1,153 @@
+import logging
+import queue
+import shutil
+import subprocess
+import threading
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+# 解码后统一输出 16kHz 单声道 Int16 PCM，与 VAD/ASR 的输入一致
+SAMPLE_RATE = 16000
+CHANNELS = 1
+# 等待写入 ffmpeg 的数据段上限，超过时丢弃新数据
+MAX_PENDING_CHUNKS = 256
+# 每丢弃多少段数据记录一次警告
+DROP_LOG_INTERVAL = 50
+
+
+class AudioDecoder(ABC):
+    """把前端上行的音频数据解码成 PCM，解码结果通过 on_pcm(bytes) 回调输出"""
+
+    def __init__(self, on_pcm):
+        self.on_pcm = on_pcm
+
+    @abstractmethod
+    def feed(self, data: bytes):
+        pass
+
+    def close(self):
+        pass
+
+
+class PCMDecoder(AudioDecoder):
+    """原始 16kHz Int16 PCM，直接透传"""
+
+    def feed(self, data: bytes):
+        self.on_pcm(data)
+
+
+class OpusDecoder(AudioDecoder):
+    """
+    裸 Opus 包（例如浏览器 WebCodecs AudioEncoder 的输出），每条 websocket 消息是一个完整的包。
+    Opus 解码器可以直接输出 16kHz，与编码端采样率无关。
+    """
+
+    def __init__(self, on_pcm):
+        super().__init__(on_pcm)
+        import opuslib
+        self.decoder = opuslib.Decoder(SAMPLE_RATE, CHANNELS)
+        # 单个 Opus 包最长 120ms
+        self.max_frame_size = SAMPLE_RATE * 120 // 1000
+
+    def feed(self, data: bytes):
+        try:
+            self.on_pcm(self.decoder.decode(bytes(data), self.max_frame_size))
+        except Exception as e:
+            logger.warning(f"Opus 解码失败，丢弃一个包: {e}")
+
+
+class FFmpegDecoder(AudioDecoder):
+    """
+    带容器的流（例如 MediaRecorder 输出的 WebM/Opus、Ogg/Opus），交给 ffmpeg 子进程流式解码。
+    写入和读取分开：feed 只把数据放入有界队列，由写线程写 stdin，读线程读 stdout 并回调。
+    feed 在事件循环上调用，ffmpeg 的 stdin 管道写满时也不会阻塞事件循环，队列满时丢弃新数据。
+    """
+
+    def __init__(self, on_pcm, input_format="webm", max_pending: int = MAX_PENDING_CHUNKS):
+        super().__init__(on_pcm)
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("未找到 ffmpeg")
+        self.process = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-f", input_format, "-i", "pipe:0",
+             "-f", "s16le", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "pipe:1"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0
+        )
+        self._pending = queue.Queue(max_pending)
+        self._closed = threading.Event()
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.writer.start()
+        self.reader.start()
+
+    def _write(self):
+        while True:
+            data = self._pending.get()
+            if data is None:
+                break
+            try:
+                self.process.stdin.write(data)
+            except (BrokenPipeError, ValueError, OSError) as e:
+                logger.warning(f"ffmpeg 解码进程已退出，丢弃数据: {e}")
+                break
+        try:
+            self.process.stdin.close()
+        except Exception:
+            pass
+
+    def _read(self):
+        while True:
+            pcm = self.process.stdout.read(4096)
+            if not pcm:
+                break
+            # 关闭后 ffmpeg 冲刷出来的剩余数据属于旧的流，不再输出
+            if self._closed.is_set():
+                continue
+            self.on_pcm(pcm)
+
+    def feed(self, data: bytes):
+        if self._closed.is_set():
+            return
+        try:
+            self._pending.put_nowait(bytes(data))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % DROP_LOG_INTERVAL == 1:
+                logger.warning(f"ffmpeg 解码跟不上，累计丢弃 {self.dropped} 段音频数据")
+
+    def close(self):
+        """停止输出并等待读写线程退出，最多阻塞约2秒，需要在事件循环之外调用"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        # 队列满时先清空，保证结束标记能放进去
+        while True:
+            try:
+                self._pending.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self._pending.get_nowait()
+                except queue.Empty:
+                    pass
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.writer.join(timeout=1)
+        self.reader.join(timeout=1)
+
+
+def create_decoder(codec, on_pcm):
+    """根据协商的编码创建解码器，依赖缺失时抛出异常，由调用方回退到 pcm"""
+    codec = (codec or "pcm").lower()
+    if codec == "pcm":
+        return PCMDecoder(on_pcm)
+    if codec == "opus":
+        return OpusDecoder(on_pcm)
+    if codec in ("webm", "ogg"):
+        return FFmpegDecoder(on_pcm, input_format=codec)
+    raise ValueError(f"不支持的音频编码: {codec}")
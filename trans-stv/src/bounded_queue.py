@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import queue
+
+logger = logging.getLogger(__name__)
+
+# 队列满时的处理策略
+POLICY_BLOCK = "block"              # 阻塞等待，对上游形成背压
+POLICY_DROP_OLDEST = "drop_oldest"  # 丢弃最旧的一项，保证延迟不会无限增长
+POLICY_DROP_NEWEST = "drop_newest"  # 丢弃新来的一项，put 抛出 queue.Full
+POLICY_COALESCE = "coalesce"        # 优先丢弃最旧的可丢弃项（例如不带VAD事件的帧），没有可丢弃项时丢弃最旧的一项
+
+# 每丢弃多少项打印一次告警，避免过载时日志刷屏
+DROP_LOG_INTERVAL = 100
+
+
+class BoundedQueue(queue.Queue):
+    """
+    带丢弃策略和计数的有界队列，接口与 queue.Queue 一致。
+    maxsize <= 0 表示不限长度。
+    """
+
+    def __init__(self, name, maxsize=0, policy=POLICY_BLOCK, droppable=None):
+        super().__init__(maxsize)
+        if policy not in (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_COALESCE):
+            raise ValueError(f"未知的队列策略: {policy}")
+        self.name = name
+        self.policy = policy
+        self.droppable = droppable
+        self.dropped = 0
+        self.high_watermark = 0
+
+    @classmethod
+    def from_config(cls, name, config, droppable=None):
+        config = config or {}
+        return cls(name, config.get("maxsize", 0), config.get("policy", POLICY_BLOCK), droppable)
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == POLICY_BLOCK:
+            super().put(item, block, timeout)
+            with self.mutex:
+                self.high_watermark = max(self.high_watermark, self._qsize())
+            return
+        with self.not_full:
+            replaced = False
+            if 0 < self.maxsize <= self._qsize():
+                if self.policy == POLICY_DROP_NEWEST:
+                    self._on_drop()
+                    raise queue.Full
+                self._drop_one()
+                replaced = True
+            self._put(item)
+            # 被丢弃的项不会再有 task_done，新项顶替它的计数
+            if not replaced:
+                self.unfinished_tasks += 1
+            self.high_watermark = max(self.high_watermark, self._qsize())
+            self.not_empty.notify()
+
+    def _drop_one(self):
+        if self.policy == POLICY_COALESCE and self.droppable is not None:
+            for i, item in enumerate(self.queue):
+                if self.droppable(item):
+                    del self.queue[i]
+                    self._on_drop()
+                    return
+        self._get()
+        self._on_drop()
+
+    def _on_drop(self):
+        self.dropped += 1
+        if self.dropped % DROP_LOG_INTERVAL == 1:
+            logger.warning(f"队列 {self.name} 已满（{self.maxsize}），累计丢弃 {self.dropped} 项")
+
+    def clear(self):
+        """清空队列，返回被移除的元素"""
+        with self.mutex:
+            items = list(self.queue)
+            self.queue.clear()
+            self.unfinished_tasks = 0
+            self.all_tasks_done.notify_all()
+            self.not_full.notify_all()
+        return items
+
+    def stats(self):
+        with self.mutex:
+            return {
+                "name": self.name,
+                "depth": self._qsize(),
+                "maxsize": self.maxsize,
+                "policy": self.policy,
+                "dropped": self.dropped,
+                "high_watermark": self.high_watermark,
+            }
+
+
+class AsyncBoundedQueue:
+    """
+    事件循环上使用的有界队列，统计口径与 BoundedQueue 一致。
+    put 可以在任意线程调用（例如 ffmpeg 解码线程），通过 call_soon_threadsafe 交给事件循环入队；
+    生产者不能阻塞，队列满时 drop_newest 丢弃新来的一项，其余策略都丢弃最旧的一项。
+    """
+
+    def __init__(self, name, loop, maxsize=0, policy=POLICY_DROP_OLDEST):
+        if policy not in (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_COALESCE):
+            raise ValueError(f"未知的队列策略: {policy}")
+        self.name = name
+        self.loop = loop
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.high_watermark = 0
+        self._queue = asyncio.Queue()
+
+    @classmethod
+    def from_config(cls, name, loop, config):
+        config = config or {}
+        return cls(name, loop, config.get("maxsize", 0), config.get("policy", POLICY_DROP_OLDEST))
+
+    def put(self, item, block=False, timeout=None):
+        """线程安全，兼容 queue.Queue.put 的调用方式"""
+        self.loop.call_soon_threadsafe(self.put_nowait, item)
+
+    def put_nowait(self, item):
+        """只能在事件循环线程调用"""
+        if 0 < self.maxsize <= self._queue.qsize():
+            self.dropped += 1
+            if self.dropped % DROP_LOG_INTERVAL == 1:
+                logger.warning(f"队列 {self.name} 已满（{self.maxsize}），累计丢弃 {self.dropped} 项")
+            if self.policy == POLICY_DROP_NEWEST:
+                return
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+        self.high_watermark = max(self.high_watermark, self._queue.qsize())
+
+    async def get(self):
+        return await self._queue.get()
+
+    def get_nowait(self):
+        """队列为空时抛出 asyncio.QueueEmpty"""
+        return self._queue.get_nowait()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def clear(self):
+        """清空队列，返回被移除的元素"""
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "depth": self._queue.qsize(),
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "dropped": self.dropped,
+            "high_watermark": self.high_watermark,
+        }
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 没有配置产品数据文件时使用的示例数据
+DEFAULT_PRODUCTS = [
+    {"id": 1, "name": "稳健增长混合基金", "type": "基金", "risk_level": "稳健型", "expected_return": 5.2, "description": "主要投资于优质股票和债券，风险适中，收益稳定"},
+    {"id": 2, "name": "科技创新股票基金", "type": "基金", "risk_level": "积极型", "expected_return": 8.5, "description": "专注于科技创新领域的优质上市公司股票"},
+    {"id": 3, "name": "国债逆回购", "type": "债券", "risk_level": "保守型", "expected_return": 2.8, "description": "安全性极高，流动性好的短期投资工具"},
+    {"id": 4, "name": "货币市场基金", "type": "基金", "risk_level": "保守型", "expected_return": 3.0, "description": "投资于短期货币工具，流动性极佳"},
+    {"id": 5, "name": "黄金ETF", "type": "商品", "risk_level": "稳健型", "expected_return": 4.5, "description": "跟踪黄金价格变动，对抗通胀的良好工具"},
+]
+
+# 各风险偏好可以推荐的产品风险等级，不在表中的风险偏好推荐全部产品
+RECOMMENDATION_TIERS = {
+    "保守型": ("保守型",),
+    "稳健型": ("保守型", "稳健型"),
+    "积极型": ("稳健型", "积极型"),
+}
+
+
+def read_products(products_file: Optional[str] = None) -> List[dict]:
+    """从 JSON 文件读取产品列表，未配置时使用示例数据"""
+    if not products_file:
+        return [dict(p) for p in DEFAULT_PRODUCTS]
+    with open(products_file, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _dumps(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ProductCatalog:
+    """
+    理财产品目录。产品数据加载后不再修改，加载时建立按 id、风险等级、类型的索引，
+    并预先计算各风险偏好的推荐列表，请求时只做字典查找和切片。
+    序列化后的响应体按查询条件缓存，ETag 由目录内容的哈希和查询条件组成，目录不变时客户端可以用 If-None-Match 跳过下载。
+    """
+
+    def __init__(self, products: List[dict], cache_size: int = 256):
+        # 按 id 排序，列表接口和分页的顺序保持稳定
+        self.products = sorted(products, key=lambda p: p["id"])
+        self.by_id: Dict[int, dict] = {}
+        self.by_risk: Dict[str, List[dict]] = {}
+        self.by_type: Dict[str, List[dict]] = {}
+        self.by_risk_type: Dict[Tuple[str, str], List[dict]] = {}
+        for product in self.products:
+            if product["id"] in self.by_id:
+                logger.warning(f"理财产品 id 重复，后出现的覆盖前面的: {product['id']}")
+            self.by_id[product["id"]] = product
+            self.by_risk.setdefault(product["risk_level"], []).append(product)
+            self.by_type.setdefault(product["type"], []).append(product)
+            self.by_risk_type.setdefault((product["risk_level"], product["type"]), []).append(product)
+        self.recommendations: Dict[str, List[dict]] = {
+            tolerance: [p for p in self.products if p["risk_level"] in levels]
+            for tolerance, levels in RECOMMENDATION_TIERS.items()
+        }
+        self.version = hashlib.sha1(_dumps(self.products)).hexdigest()[:16]
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, Tuple[bytes, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        logger.info(f"理财产品目录已加载，共 {len(self.products)} 个产品，版本 {self.version}")
+
+    def _etag(self, key: tuple) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:8]
+        return f'"{self.version}-{digest}"'
+
+    def _cached(self, key: tuple, build) -> Tuple[bytes, str]:
+        """返回 (响应体, ETag)，同样的查询只序列化一次"""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                return entry
+        entry = (_dumps(build()), self._etag(key))
+        with self._lock:
+            self._cache[key] = entry
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    def filter(self, risk_level: str = None, product_type: str = None) -> List[dict]:
+        if risk_level and product_type:
+            return self.by_risk_type.get((risk_level, product_type), [])
+        if risk_level:
+            return self.by_risk.get(risk_level, [])
+        if product_type:
+            return self.by_type.get(product_type, [])
+        return self.products
+
+    def list_page(self, risk_level: str = None, product_type: str = None,
+                  page: int = None, page_size: int = 20) -> Tuple[bytes, str, int]:
+        """返回 (响应体, ETag, 过滤后的总数)；page 为空时返回全部产品"""
+        products = self.filter(risk_level, product_type)
+        if page is None:
+            key = ("list", risk_level, product_type)
+            body, etag = self._cached(key, lambda: products)
+        else:
+            start = (page - 1) * page_size
+            key = ("list", risk_level, product_type, page, page_size)
+            body, etag = self._cached(key, lambda: products[start:start + page_size])
+        return body, etag, len(products)
+
+    def get(self, product_id: int) -> Optional[Tuple[bytes, str]]:
+        if product_id not in self.by_id:
+            return None
+        return self._cached(("product", product_id), lambda: self.by_id[product_id])
+
+    def recommend(self, risk_tolerance: str) -> Tuple[bytes, str]:
+        recommendations = self.recommendations.get(risk_tolerance, self.products)
+        key = ("recommend", risk_tolerance if risk_tolerance in self.recommendations else None)
+        return self._cached(key, lambda: {"recommendations": recommendations})
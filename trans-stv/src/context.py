@@ -0,0 +1,158 @@
+import json
+import logging
+import re
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.executors import BACKGROUND, submit
+
+logger = logging.getLogger(__name__)
+
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD = 4
+# 中日韩文字和全角标点大约一个字一个 token，其余字符大约四个字符一个 token
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+SUMMARY_PREFIX = "以下是本次会话中较早对话的摘要：\n"
+
+summary_prompt_template = """
+你是一个对话记录员。请把已有的对话摘要和新移出上下文的对话合并成一份新的摘要，保留用户的需求、偏好、已经确认的信息和尚未完成的事项，不超过${max_chars}个字，只输出摘要内容。
+
+# 已有摘要
+${summary}
+
+# 新移出上下文的对话
+${dialogue}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数，不依赖具体模型的分词器"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: Dict) -> int:
+    """估算一条 LLM 格式消息的 token 数"""
+    text = message.get("content") or ""
+    if message.get("tool_calls") is not None:
+        text += json.dumps(message["tool_calls"], ensure_ascii=False)
+    return MESSAGE_OVERHEAD + estimate_tokens(text)
+
+
+def _dialogue_text(messages: List[Dict]) -> str:
+    lines = []
+    for message in messages:
+        content = message.get("content")
+        if content:
+            lines.append(f"{message['role']}: {content}")
+    return "\n".join(lines)
+
+
+class ContextWindow:
+    """
+    发给LLM的上下文窗口。系统提示词始终保留，之后按轮次（以用户消息开始）保留最近的对话：
+    - 最多保留 keep_turns 轮，总 token 数不超过 max_tokens，当前这一轮总是保留
+    - 移出窗口的轮次在后台交给 summarize 合并进滚动摘要，摘要作为一条系统消息放在系统提示词之后
+    窗口起点只会向后移动，没有新的轮次移出时发给LLM的前缀保持不变。
+    """
+
+    def __init__(self, max_tokens: int = 3000, keep_turns: int = 8, summary_max_chars: int = 400,
+                 summarize: Callable[[str], str] = None, executor=None):
+        self.max_tokens = max_tokens
+        self.keep_turns = max(keep_turns, 1)
+        self.summary_max_chars = summary_max_chars
+        # summarize(prompt) -> 摘要文本，为空时移出窗口的对话直接丢弃
+        self.summarize = summarize
+        self.executor = executor
+        # 窗口中第一条消息在对话历史中的下标
+        self.start = 0
+        self.summary = ""
+        self._summary_message: Optional[Tuple[Dict, bytes]] = None
+        # 已移出窗口、还没有合并进摘要的消息
+        self._pending: List[Dict] = []
+        self._running = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, summarize=None, executor=None):
+        config = config or {}
+        return cls(
+            max_tokens=config.get("max_tokens", 3000),
+            keep_turns=config.get("keep_turns", 8),
+            summary_max_chars=config.get("summary_max_chars", 400),
+            summarize=summarize,
+            executor=executor,
+        )
+
+    def summary_message(self) -> Optional[Tuple[Dict, bytes]]:
+        """摘要对应的系统消息及其 JSON 编码，还没有摘要时返回 None"""
+        return self._summary_message
+
+    def window(self, messages: List[Dict], tokens: List[int], turn_starts: List[int]) -> int:
+        """
+        根据当前对话计算窗口起点并返回。messages 为LLM格式的消息，tokens 为每条消息的 token 数，
+        turn_starts 为每一轮第一条消息的下标。移出窗口的轮次提交后台摘要。
+        """
+        if not turn_starts:
+            return len(messages)
+        self.start = max(self.start, turn_starts[0])
+        first = bisect_left(turn_starts, self.start)
+        summary = self._summary_message
+        budget = self.max_tokens - sum(tokens[:turn_starts[0]]) - (message_tokens(summary[0]) if summary else 0)
+        total = sum(tokens[self.start:])
+        last = len(turn_starts) - 1
+        i = first
+        while i < last and (len(turn_starts) - i > self.keep_turns or total > budget):
+            total -= sum(tokens[turn_starts[i]:turn_starts[i + 1]])
+            i += 1
+        if i > first:
+            evicted = messages[turn_starts[first]:turn_starts[i]]
+            self.start = turn_starts[i]
+            logger.info(f"上下文移出 {i - first} 轮对话（{len(evicted)} 条消息），窗口约 {total} tokens")
+            self._fold(evicted)
+        return self.start
+
+    def _fold(self, messages: List[Dict]):
+        if self.summarize is None:
+            return
+        with self._lock:
+            self._pending.extend(messages)
+            if self._running:
+                return
+            self._running = True
+        if self.executor is None:
+            self._summarize_pending()
+            return
+        try:
+            submit(self.executor, BACKGROUND, self._summarize_pending)
+        except RuntimeError as e:
+            # 线程池已经关闭
+            logger.warning(f"无法提交对话摘要任务: {e}")
+            with self._lock:
+                self._running = False
+
+    def _summarize_pending(self):
+        """依次把积累的消息合并进摘要，同一时间只有一个摘要任务"""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                messages, self._pending = self._pending, []
+            prompt = summary_prompt_template.replace("${max_chars}", str(self.summary_max_chars)) \
+                .replace("${summary}", self.summary or "无") \
+                .replace("${dialogue}", _dialogue_text(messages)).strip()
+            try:
+                summary = (self.summarize(prompt) or "").strip()
+            except Exception as e:
+                logger.error(f"生成对话摘要失败: {e}")
+                continue
+            if summary:
+                message = {"role": "system", "content": SUMMARY_PREFIX + summary}
+                self.summary = summary
+                self._summary_message = (message, json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                logger.debug(f"对话摘要已更新: {summary}")
@@ -1,8 +1,20 @@
+import json
+import logging
 import os.path
+import threading
+import time
 import uuid
 from typing import List, Dict
 from datetime import datetime
-from src.utils import write_json_file
+
+from src.context import ContextWindow, message_tokens
+
+logger = logging.getLogger(__name__)
+
+# 写入对话日志的角色
+JOURNAL_ROLES = ("user", "assistant")
+# 回复被用户打断时追加在助手消息末尾，让LLM知道这句话没有说完
+INTERRUPTED_MARK = "……（被用户打断）"
 
 
 class Message:
@@ -20,37 +32,189 @@ class Message:
         self.tool_call_id = tool_call_id
 
 
+def _llm_message(m: Message) -> Dict:
+    if m.tool_calls is not None:
+        return {"role": m.role, "tool_calls": m.tool_calls}
+    if m.role == "tool":
+        return {"role": m.role, "tool_call_id": m.tool_call_id, "content": m.content}
+    return {"role": m.role, "content": m.content}
+
+
+def _encode(message: Dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class LLMDialogue(list):
+    """
+    发给LLM的消息列表，同时带有预先编码好的 JSON（encoded），
+    LLM 客户端可以直接拼进请求体，不必每次重新序列化整个对话历史
+    """
+
+    def __init__(self, messages, encoded: bytes = None):
+        super().__init__(messages)
+        self.encoded = encoded
+
+
+def _read_records(file_path) -> Dict[str, Dict]:
+    """
+    读取 JSONL 对话日志，按消息 id 去重：同一条消息写入多次时以最后一次为准，位置保持第一次出现的位置；
+    损坏的行（例如进程崩溃时写了一半）跳过
+    """
+    records: Dict[str, Dict] = {}
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"{file_path} 中有损坏的记录，已跳过")
+                continue
+            records[record.get("id") or str(len(records))] = record
+    return records
+
+
+def read_journal(file_path) -> List[Dict[str, str]]:
+    """读取 JSONL 对话日志，返回 [{"role":..., "content":...}]"""
+    return [{"role": r["role"], "content": r["content"]} for r in _read_records(file_path).values()]
+
+
 class Dialogue:
-    def __init__(self, dialogue_history_path):
+    """
+    对话历史。内存中保存完整的消息列表，用户和助手的消息同时追加到 JSONL 日志 dialogue-<时间>-<会话id>.jsonl：
+    - put 只把一行记录放入缓冲区，缓冲区满 flush_lines 行或距上次写入超过 flush_interval 秒时追加写入
+    - dump_dialogue 在一轮对话结束时调用，把缓冲区写入文件
+    - close 时压缩日志，同一条消息只保留最后一次写入
+    发给LLM的消息格式和它的 JSON 编码在 put 时增量维护，get_llm_dialogue 不再遍历全部消息重新构造。
+    设置了 context 时只发送系统提示词、较早对话的摘要和上下文窗口内最近的几轮对话。
+    """
+
+    def __init__(self, dialogue_history_path, flush_interval: float = 5, flush_lines: int = 20,
+                 context: ContextWindow = None):
         self.dialogue_history_path = dialogue_history_path
         self.dialogue: List[Message] = []
         # 获取当前时间
         self.current_time  = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # 同一秒内可能创建多个会话，文件名加上会话 id，各会话的日志和压缩互不影响
+        self.session_id = uuid.uuid4().hex[:12]
+        self.journal_file = os.path.join(self.dialogue_history_path,
+                                         f"dialogue-{self.current_time}-{self.session_id}.jsonl")
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self._pending: List[str] = []
+        self._journal_lines = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        # LLM 格式的消息、每条消息的 JSON 编码，以及消息 id 到下标的映射
+        self._llm_messages: List[Dict] = []
+        self._encoded_messages: List[bytes] = []
+        self._index: Dict[str, int] = {}
+        # 每条消息的 token 数，以及每一轮（以用户消息开始）第一条消息的下标
+        self.tokens: List[int] = []
+        self.turn_starts: List[int] = []
+        self.context = context
+        # 发给LLM的消息列表的 JSON 编码，对话、窗口或摘要有变化时失效
+        self._encoded: bytes = None
+        self._encoded_key = None
 
     def put(self, message: Message):
+        llm_message = _llm_message(message)
+        if message.role == "user":
+            self.turn_starts.append(len(self.dialogue))
+        self._index[message.uniq_id] = len(self.dialogue)
         self.dialogue.append(message)
+        self._llm_messages.append(llm_message)
+        self._encoded_messages.append(_encode(llm_message))
+        self.tokens.append(message_tokens(llm_message))
+        self._encoded = None
+        self._journal(message)
+
+    def update(self, message: Message):
+        """消息内容有变化（例如回复被打断后截断），更新LLM视图并重新写一条相同 id 的记录"""
+        index = self._index.get(message.uniq_id)
+        if index is not None:
+            llm_message = _llm_message(message)
+            self._llm_messages[index] = llm_message
+            self._encoded_messages[index] = _encode(llm_message)
+            self.tokens[index] = message_tokens(llm_message)
+            self._encoded = None
+        self._journal(message)
 
-    def get_llm_dialogue(self) -> List[Dict[str, str]]:
-        dialogue = []
-        for m in self.dialogue:
-            if m.tool_calls is not None:
-                dialogue.append({"role": m.role, "tool_calls": m.tool_calls})
-            elif m.role == "tool":
-                dialogue.append({"role": m.role, "tool_call_id": m.tool_call_id, "content": m.content})
-            else:
-                dialogue.append({"role": m.role, "content": m.content})
-        return dialogue
+    def _journal(self, message: Message):
+        if message.role not in JOURNAL_ROLES or message.content is None:
+            return
+        line = json.dumps({"id": message.uniq_id, "role": message.role, "content": message.content}, ensure_ascii=False)
+        with self._lock:
+            self._pending.append(line)
+            due = len(self._pending) >= self.flush_lines or time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def get_llm_dialogue(self) -> LLMDialogue:
+        """返回发给LLM的消息列表（浅拷贝，调用方不要修改其中的消息），附带整个列表的 JSON 编码"""
+        if self.context is None:
+            if self._encoded is None:
+                self._encoded = b"[" + b",".join(self._encoded_messages) + b"]"
+            return LLMDialogue(self._llm_messages, self._encoded)
+        start = self.context.window(self._llm_messages, self.tokens, self.turn_starts)
+        pinned = self.turn_starts[0] if self.turn_starts else len(self.dialogue)
+        summary = self.context.summary_message()
+        messages = self._llm_messages[:pinned]
+        encoded = self._encoded_messages[:pinned]
+        if summary is not None:
+            messages.append(summary[0])
+            encoded.append(summary[1])
+        messages += self._llm_messages[start:]
+        key = (start, summary)
+        if self._encoded is None or self._encoded_key != key:
+            self._encoded = b"[" + b",".join(encoded + self._encoded_messages[start:]) + b"]"
+            self._encoded_key = key
+        return LLMDialogue(messages, self._encoded)
+
+    def flush(self):
+        """把缓冲区中的记录追加写入日志文件"""
+        with self._lock:
+            if not self._pending:
+                self._last_flush = time.monotonic()
+                return
+            lines, self._pending = self._pending, []
+            try:
+                with open(self.journal_file, "a", encoding="utf-8") as file:
+                    file.write("\n".join(lines) + "\n")
+                self._journal_lines += len(lines)
+            except OSError as e:
+                logger.error(f"写入对话日志失败: {e}")
+                self._pending = lines + self._pending
+            self._last_flush = time.monotonic()
 
     def dump_dialogue(self):
-        dialogue = []
-        for d in self.get_llm_dialogue():
-            if d["role"] not in ("user", "assistant"):
-                continue
-            dialogue.append(d)
-        file_name = os.path.join(self.dialogue_history_path, f"dialogue-{self.current_time}.json")
-        write_json_file(file_name, dialogue)
+        """一轮对话结束时调用，写入缓冲区中的记录"""
+        self.flush()
+
+    def compact(self):
+        """日志中有重复写入的消息时重写文件，每条消息只保留一行"""
+        self.flush()
+        with self._lock:
+            if not os.path.exists(self.journal_file):
+                return
+            records = list(_read_records(self.journal_file).values())
+            if len(records) == self._journal_lines:
+                return
+            tmp_file = self.journal_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as file:
+                for record in records:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(tmp_file, self.journal_file)
+            self._journal_lines = len(records)
+
+    def close(self):
+        try:
+            self.compact()
+        except OSError as e:
+            logger.error(f"压缩对话日志失败: {e}")
 
 if __name__ == "__main__":
     d = Dialogue("../tmp/")
     d.put(Message(role="user", content="你好"))
-    d.dump_dialogue()
\ No newline at end of file
+    d.dump_dialogue()
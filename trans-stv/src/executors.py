@@ -0,0 +1,143 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 任务优先级，数值越小越先执行
+FIRST_SENTENCE = 0  # 一轮回复的第一句 TTS/THG，决定用户多久听到声音
+INTERACTIVE = 1     # 用户正在等待的工作：本轮的工具调用、播放前的音频转换等
+SENTENCE = 2        # 回复中后面的句子，播放第一句期间生成即可
+BACKGROUND = 3      # 后台工具、上下文摘要等不影响当前回复的工作
+
+
+class PriorityExecutor(Executor):
+    """
+    按优先级调度的线程池：同一优先级先提交先执行，线程数固定上限、按需创建。
+    submit 使用 INTERACTIVE 优先级，兼容 loop.run_in_executor 等只调用 submit 的代码
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = "priority"):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        # (优先级, 提交序号, future, fn, args, kwargs)
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._idle = 0
+        self._shutdown = False
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        return self.submit_at(INTERACTIVE, fn, *args, **kwargs)
+
+    def submit_at(self, priority: int, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            heapq.heappush(self._queue, (priority, next(self._seq), future, fn, args, kwargs))
+            if self._idle == 0 and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, daemon=True,
+                                          name=f"{self.thread_name_prefix}_{len(self._threads)}")
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._cond.notify()
+        return future
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    self._cond.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                _, _, future, fn, args, kwargs = heapq.heappop(self._queue)
+            # 排队期间被取消（例如用户打断）的任务直接跳过
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def pending(self) -> int:
+        """排队等待执行的任务数"""
+        with self._cond:
+            return len(self._queue)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for item in self._queue:
+                    item[2].cancel()
+                self._queue.clear()
+            self._cond.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def submit(executor: Executor, priority: int, fn, /, *args, **kwargs) -> Future:
+    """按优先级提交；普通线程池（例如调用方传入的 ThreadPoolExecutor）忽略优先级"""
+    if isinstance(executor, PriorityExecutor):
+        return executor.submit_at(priority, fn, *args, **kwargs)
+    return executor.submit(fn, *args, **kwargs)
+
+
+def settle(future: Future, result=None, exception: BaseException = None):
+    """设置自行创建的 Future 的结果；已被取消时忽略"""
+    if not future.set_running_or_notify_cancel():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class SharedPools:
+    """
+    所有会话共享的线程池，按阶段划分：VAD、ASR、LLM对话、TTS、THG、工具。
+    会话本身运行在事件循环上，只把阻塞的模型推理和网络请求交给这些线程池，线程数不再随会话数增长。
+    TTS、THG、工具使用优先级线程池：回复的第一句先于后面的句子和后台工具执行。
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, config):
+        config = config or {}
+        cpus = os.cpu_count() or 1
+        self.vad = ThreadPoolExecutor(max_workers=config.get("vad", 2), thread_name_prefix="vad")
+        self.asr = ThreadPoolExecutor(max_workers=config.get("asr", 2), thread_name_prefix="asr")
+        self.chat = ThreadPoolExecutor(max_workers=config.get("chat", 8), thread_name_prefix="chat")
+        # TTS/THG 是计算密集的模型推理，线程数默认不超过CPU核数
+        self.tts = PriorityExecutor(config.get("tts", min(4, cpus)), thread_name_prefix="tts")
+        self.thg = PriorityExecutor(config.get("thg", 1), thread_name_prefix="thg")
+        self.tools = PriorityExecutor(config.get("tools", 8), thread_name_prefix="tools")
+
+    @classmethod
+    def instance(cls, config=None):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls(config)
+        return cls._instance
+
+    def pending(self):
+        """各优先级线程池排队的任务数"""
+        return {"tts": self.tts.pending(), "thg": self.thg.pending(), "tools": self.tools.pending()}
+
+    def shutdown(self):
+        for executor in (self.vad, self.asr, self.chat, self.tts, self.thg, self.tools):
+            executor.shutdown(wait=False)
@@ -0,0 +1,39 @@
+import bisect
+import hashlib
+from typing import List
+
+
+class HashRing:
+    """
+    一致性哈希环，把 user_id 固定分配到某个节点。
+    每个节点在环上放 replicas 个虚拟节点，增减节点时只有少量用户被重新分配。
+    """
+
+    def __init__(self, nodes: List[str] = None, replicas: int = 100):
+        self.replicas = replicas
+        self._keys = []
+        self._ring = {}
+        for node in nodes or []:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+    def add(self, node: str):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}#{i}")
+            self._ring[h] = node
+            bisect.insort(self._keys, h)
+
+    def remove(self, node: str):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}#{i}")
+            if self._ring.pop(h, None) is not None:
+                self._keys.remove(h)
+
+    def get(self, key: str) -> str:
+        if not self._keys:
+            raise ValueError("哈希环为空")
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[self._keys[index]]
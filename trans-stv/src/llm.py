@@ -4,6 +4,8 @@ import re
 import requests
 import logging
 from typing import Generator, Tuple, Any, Optional
+
+from src.metrics import StreamTimer
 # from langchain_experimental.llms.ollama_functions import OllamaFunctions
 
 logger = logging.getLogger(__name__)
@@ -17,28 +19,47 @@ class LLM(ABC):
     def response_call(self, dialogue, functions_call) -> Generator[Tuple[str, Optional[Any]], Any, None]:
         pass
 
+    def response_stream(self, dialogue) -> Generator[str, Any, None]:
+        """逐段返回回复文本；不支持流式的实现整段返回"""
+        yield from self.response(dialogue)
+
 class OllamaLLM(LLM):
     def __init__(self, config):
         # 从配置中获取参数
         self.model_name = config.get("model_name")
         self.url = config.get("url")  # 默认 URL
+        self._model_json = json.dumps(self.model_name, ensure_ascii=False).encode("utf-8")
+
+    def _post(self, url, dialogue, stream):
+        """
+        发送 /api/chat 请求。dialogue 带有预先编码的 JSON（Dialogue.get_llm_dialogue 返回的 LLMDialogue）时
+        直接拼接请求体，不再重新序列化整个对话历史
+        """
+        encoded = getattr(dialogue, "encoded", None)
+        if encoded is None:
+            data = {"model": self.model_name, "messages": dialogue, "stream": stream}
+            return requests.post(url, json=data, stream=stream)
+        body = b'{"model":' + self._model_json + b',"stream":' + (b"true" if stream else b"false") + \
+            b',"messages":' + encoded + b"}"
+        return requests.post(url, data=body, headers={"Content-Type": "application/json"}, stream=stream)
+
+    def _log_request(self, dialogue, stream):
+        if logger.isEnabledFor(logging.DEBUG):
+            data = {"model": self.model_name, "messages": dialogue, "stream": stream}
+            logger.debug(f"LLM请求详情 - 数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
 
     def response(self, dialogue):
+        response = None
         try:
             # 构造请求 URL
             url = f"{self.url}/api/chat"
-            data = {
-                "model": self.model_name,
-                "messages": dialogue,
-                "stream": False
-            }
 
             # 记录请求信息
             logger.info(f"LLM请求 - 模型: {self.model_name}, 消息数量: {len(dialogue)}, URL: {url}")
-            logger.debug(f"LLM请求详情 - 数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
+            self._log_request(dialogue, False)
 
             # 发送请求
-            response = requests.post(url, json=data, stream=False)
+            response = self._post(url, dialogue, stream=False)
             response.raise_for_status()  # 检查请求是否成功
             
             # 记录响应状态
@@ -76,24 +97,23 @@ class OllamaLLM(LLM):
                     yield filtered_text
         except Exception as e:
             logger.error(f"Error in response generation: {e}")
+        finally:
+            # 生成器被提前关闭（例如用户打断）时同时关闭HTTP连接
+            if response is not None:
+                response.close()
 
     def response_call(self, dialogue, functions_call):
         try:
             # 构造请求 URL
             url = f"{self.url}/api/chat"
-            data = {
-                "model": self.model_name,
-                "messages": dialogue,
-                "stream": False
-            }
 
             # 记录请求信息 (包含工具调用)
             tool_count = len(functions_call) if functions_call else 0
             logger.info(f"LLM工具调用请求 - 模型: {self.model_name}, 消息数量: {len(dialogue)}, 工具数量: {tool_count} (通过文本格式), URL: {url}")
-            logger.debug(f"LLM工具调用请求详情 - 数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
+            self._log_request(dialogue, False)
 
             # 发送请求
-            response = requests.post(url, json=data, stream=False)
+            response = self._post(url, dialogue, stream=False)
             response.raise_for_status()  # 检查请求是否成功
 
             # 解析响应内容（非流式响应，直接解析JSON）
@@ -101,7 +121,8 @@ class OllamaLLM(LLM):
             
             # 记录响应状态
             logger.info(f"LLM工具调用响应 - 状态码: {response.status_code}, 响应大小: {len(response.content)} bytes")
-            logger.debug(f"LLM工具调用响应详情 - 数据: {json.dumps(response_data, ensure_ascii=False, indent=2)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"LLM工具调用响应详情 - 数据: {json.dumps(response_data, ensure_ascii=False, indent=2)}")
             
             # 检查响应格式
             if "message" not in response_data:
@@ -149,30 +170,29 @@ class OllamaLLM(LLM):
         """
         支持流式工具调用：
         tools: list of tool definitions, e.g. [{"type":"function","function":{...}}, ...]
+        调用方提前关闭生成器（例如用户打断）时关闭HTTP连接，Ollama 随即停止生成
         """
+        response = None
         try:
 
             url = f"{self.url}/api/chat"
-            data = {
-                "model": self.model_name,
-                "messages": dialogue,
-                "stream": True
-            }
-        
-    
+
             # 记录请求信息 (包含工具调用)
             tool_count = len(functions_call) if functions_call else 0
             logger.info(f"LLM工具调用请求 - 模型: {self.model_name}, 消息数量: {len(dialogue)}, 工具数量: {tool_count}, URL: {url}")
-            logger.debug(f"LLM工具调用请求详情 - 数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
+            self._log_request(dialogue, True)
 
             # 发送请求
-            response = requests.post(url, json=data, stream=True)
+            timer = StreamTimer()
+            response = self._post(url, dialogue, stream=True)
             response.raise_for_status()  # 检查请求是否成功   
 
             # 记录响应状态
             logger.info(f"LLM工具调用响应 - 状态码: {response.status_code}, Content-Type: {response.headers.get('content-type', 'unknown')}")
 
             chunk_count = 0
+            in_think = False
+            started = False
             for line in response.iter_lines():
                 if not line:
                     continue
@@ -181,6 +201,15 @@ class OllamaLLM(LLM):
                 msg = data.get("message", {})
                 content = msg.get("content")
                 tool_calls = msg.get("tool_calls")
+
+                # 流式过滤<think>和</think>之间的内容，标签可能跨多个chunk
+                if content:
+                    content, in_think = self._strip_think(content, in_think)
+                    # 去掉开头多余的换行符
+                    if not started:
+                        content = content.lstrip()
+                        started = len(content) > 0
+                    content = self._replace_special_chars(content)
                 
                 # 区分文本响应与工具调用的日志格式
                 if tool_calls is not None:
@@ -188,11 +217,61 @@ class OllamaLLM(LLM):
                 elif content is not None:
                     logger.debug(f"LLM文本响应chunk {chunk_count} - 内容: '{content}'")
                 
+                if content or tool_calls:
+                    timer.token()
                 yield content, tool_calls
                 
+            timer.finish()
             logger.info(f"LLM流式响应完成 - 总共{chunk_count}个chunk")
         except Exception as e:
             logger.error(f"OllamaLLM tool-call error: {e}")
+        finally:
+            if response is not None:
+                response.close()
+
+    def response_stream(self, dialogue):
+        """流式返回回复文本，调用方提前关闭生成器（例如用户打断）时关闭HTTP连接，Ollama 随即停止生成"""
+        responses = self.response_call_stream(dialogue, None)
+        try:
+            for content, _ in responses:
+                if content:
+                    yield content
+        finally:
+            responses.close()
+
+    @staticmethod
+    def _strip_think(content, in_think):
+        """去掉<think>...</think>部分，返回剩余内容以及当前是否仍在think块内"""
+        text = ""
+        while content:
+            if in_think:
+                end = content.find("</think>")
+                if end < 0:
+                    return text, True
+                content = content[end + len("</think>"):]
+                in_think = False
+            else:
+                start = content.find("<think>")
+                if start < 0:
+                    text += content
+                    break
+                text += content[:start]
+                content = content[start + len("<think>"):]
+                in_think = True
+        return text, in_think
+
+    @staticmethod
+    def _replace_special_chars(text):
+        # 定义需要替换的特殊字符
+        special_chars = {
+            "*": "",  # 替换为空格
+            "《": "",  # 删除
+            "》": "",  # 删除
+            "～": "~",  # 替换为普通波浪号
+        }
+        for char, replacement in special_chars.items():
+            text = text.replace(char, replacement)
+        return text
 
 def create_instance(class_name, *args, **kwargs):
     # 获取类对象
@@ -3,9 +3,11 @@ import os
 import glob
 import logging
 import re
+import threading
 import requests
 
 from src.utils import read_json_file, write_json_file
+from src.dialogue import read_journal
 
 logger = logging.getLogger(__name__)
 
@@ -27,19 +29,25 @@ ${dialogue_history}
 
 class Memory:
     def __init__(self, config):
-        file_path = config.get("dialogue_history_path")
+        self.file_path = config.get("dialogue_history_path")
         self.memory_file = config.get("memory_file")
-        if os.path.isfile(self.memory_file):
-            self.memory = read_json_file(self.memory_file)
-        else:
-            self.memory = {"history_memory_file": [], "memory": ""}
-
         self.model_name = config.get("model_name")
         self.base_url = config.get("url")
+        # 实例在会话间共享，刷新时加锁，避免并发创建的会话重复总结同一个对话日志
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """重新读取记忆文件，并把新增的对话日志合并进摘要；每个新会话创建时调用，拿到最新的记忆"""
+        with self._lock:
+            if os.path.isfile(self.memory_file):
+                self.memory = read_json_file(self.memory_file)
+            else:
+                self.memory = {"history_memory_file": [], "memory": ""}
 
-        self.read_dialogues_in_order(file_path)
+            self.read_dialogues_in_order(self.file_path)
 
-        write_json_file(self.memory_file, self.memory)
+            write_json_file(self.memory_file, self.memory)
 
 
     def get_memory(self):
@@ -91,7 +99,9 @@ class Memory:
 
     @staticmethod
     def read_dialogue_file(file_path):
-        """读取 JSON 对话文件并返回对话列表"""
+        """读取对话文件并返回对话列表，支持 JSONL 对话日志和旧版的 JSON 文件"""
+        if file_path.endswith(".jsonl"):
+            return read_journal(file_path)
         with open(file_path, 'r', encoding='utf-8') as file:
             try:
                 dialogues = json.load(file)
@@ -114,8 +124,8 @@ class Memory:
     def read_dialogues_in_order(self, directory):
         """读取指定目录下的所有对话文件，按时间顺序排列"""
         # 获取所有符合命名规则的文件路径
-        pattern = os.path.join(directory, 'dialogue-*-*-*.json')
-        files = glob.glob(pattern)
+        files = glob.glob(os.path.join(directory, 'dialogue-*-*-*.json')) + \
+            glob.glob(os.path.join(directory, 'dialogue-*-*-*.jsonl'))
 
         # 按时间排序
         files.sort(key=lambda x: self.extract_time_from_filename(os.path.basename(x)))
@@ -0,0 +1,182 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 默认的延迟分桶（秒），覆盖单帧VAD的毫秒级到LLM/THG的数十秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 吞吐量分桶（tokens/s）
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    items = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+def _format_bound(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(float(value))
+
+
+class Histogram:
+    """线程安全的直方图，输出 Prometheus 的 _bucket/_sum/_count"""
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """with histogram.time(): ... 记录代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format_bound(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    采集时才计算的指标，collect 返回 [(labels, value), ...]。
+    会话数、队列深度这类状态直接从现有对象读取，不需要在业务代码里维护。
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], List[Tuple[Dict[str, str], float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    @property
+    def sample_name(self) -> str:
+        return self.name
+
+    def render(self) -> List[str]:
+        name = self.sample_name
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.TYPE}"]
+        try:
+            samples = self.collect()
+        except Exception as e:
+            logger.error(f"采集指标 {name} 出错: {e}")
+            samples = []
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Gauge):
+    """
+    采集时才计算的累计值（只增不减，例如累计拒绝数、丢弃数、缓存命中数），
+    以 counter 类型和 _total 后缀输出，Prometheus 的 rate()/increase() 才能正确处理进程重启造成的归零
+    """
+    TYPE = "counter"
+
+    @property
+    def sample_name(self) -> str:
+        return self.name if self.name.endswith("_total") else f"{self.name}_total"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, documentation, buckets)
+            return self._metrics[name]
+
+    def gauge(self, name: str, documentation: str, collect) -> Gauge:
+        """注册采集函数，同名指标重复注册时覆盖"""
+        with self._lock:
+            self._metrics[name] = Gauge(name, documentation, collect)
+            return self._metrics[name]
+
+    def counter(self, name: str, documentation: str, collect) -> Counter:
+        """注册只增不减的采集函数，输出时加 _total 后缀；同名指标重复注册时覆盖"""
+        with self._lock:
+            self._metrics[name] = Counter(name, documentation, collect)
+            return self._metrics[name]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# 各阶段的延迟直方图
+VAD_FRAME_SECONDS = REGISTRY.histogram("trans_vad_frame_seconds", "单帧VAD检测耗时")
+ASR_SECONDS = REGISTRY.histogram("trans_asr_seconds", "ASR识别一段语音的耗时")
+LLM_TTFT_SECONDS = REGISTRY.histogram("trans_llm_time_to_first_token_seconds", "LLM从发出请求到返回首个token的耗时")
+LLM_TOKENS_PER_SECOND = REGISTRY.histogram("trans_llm_tokens_per_second", "LLM首个token之后的生成速度", RATE_BUCKETS)
+TTS_SECONDS = REGISTRY.histogram("trans_tts_seconds", "tts.to_tts 耗时")
+THG_SECONDS = REGISTRY.histogram("trans_thg_seconds", "thg.to_thg 耗时")
+PLAYER_QUEUE_WAIT_SECONDS = REGISTRY.histogram("trans_player_queue_wait_seconds", "音频进入播放队列到开始播放的等待时间")
+
+
+class StreamTimer:
+    """
+    记录一次流式LLM调用的首token时间和生成速度：
+    请求发出前创建，每收到一个token调用 token()，结束时调用 finish()
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first = None
+        self.tokens = 0
+
+    def token(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+            LLM_TTFT_SECONDS.observe(self.first - self.start)
+        self.tokens += 1
+
+    def finish(self):
+        if self.first is None or self.tokens < 2:
+            return
+        elapsed = time.perf_counter() - self.first
+        if elapsed > 0:
+            # 首个token的耗时已计入TTFT，这里只统计之后的token
+            LLM_TOKENS_PER_SECOND.observe((self.tokens - 1) / elapsed)
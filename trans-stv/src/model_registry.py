@@ -0,0 +1,98 @@
+import logging
+import threading
+
+from src import (
+    asr,
+    llm,
+    tts,
+    thg,
+    vad,
+    memory,
+    rag
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    进程级模型注册表。
+    每个选中的后端（ASR/VAD/LLM/TTS/THG/Memory/RAG）在进程内只加载一次，
+    各个会话只持有自己的状态（VADIterator、对话历史、播放器等），模型本身共享。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def _get_or_load(self, key, loader):
+        # 加载放在锁内，保证同一个模型不会被并发的会话重复加载
+        with self._lock:
+            if key not in self._models:
+                logger.info(f"加载共享模型: {key}")
+                self._models[key] = loader()
+            return self._models[key]
+
+    def register(self, module_name, class_name, instance):
+        """直接注册一个已构造好的实例，替换配置中的后端（例如测试桩）"""
+        with self._lock:
+            self._models[(module_name, class_name)] = instance
+
+    def _selected(self, config, module_name):
+        class_name = config["selected_module"][module_name]
+        return class_name, config[module_name][class_name]
+
+    def get_asr(self, config):
+        class_name, module_config = self._selected(config, "ASR")
+        return self._get_or_load(("ASR", class_name), lambda: asr.create_instance(class_name, module_config))
+
+    def get_llm(self, config):
+        class_name, module_config = self._selected(config, "LLM")
+        return self._get_or_load(("LLM", class_name), lambda: llm.create_instance(class_name, module_config))
+
+    def get_tts(self, config):
+        class_name, module_config = self._selected(config, "TTS")
+        return self._get_or_load(("TTS", class_name), lambda: tts.create_instance(class_name, module_config))
+
+    def get_thg(self, config):
+        class_name, module_config = self._selected(config, "THG")
+        return self._get_or_load(("THG", class_name), lambda: thg.create_instance(class_name, module_config))
+
+    def get_memory(self, config):
+        return self._get_or_load(("Memory", "Memory"), lambda: memory.Memory(config.get("Memory")))
+
+    def get_rag(self, config):
+        return self._get_or_load(("Rag", "Rag"), lambda: rag.Rag(config["Rag"]))
+
+    def create_vad(self, config):
+        """VAD 带有逐帧的循环状态，每个会话单独创建，只共享权重"""
+        class_name, module_config = self._selected(config, "VAD")
+        shared = self._get_or_load(("VAD", class_name), lambda: vad.load_shared(class_name, module_config))
+        if shared is None:
+            return vad.create_instance(class_name, module_config)
+        return vad.create_instance(class_name, module_config, shared=shared)
+
+    def preload(self, config):
+        """服务启动时预加载所有共享模型，避免第一个连接的用户等待模型加载"""
+        self.get_asr(config)
+        self.get_llm(config)
+        self.get_tts(config)
+        self.get_thg(config)
+        self.get_memory(config)
+        self.get_rag(config)
+        self.create_vad(config)
+        logger.info("共享模型预加载完成")
+
+
+def get_registry():
+    return ModelRegistry.instance()
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+
+from src.bounded_queue import AsyncBoundedQueue
+from src.executors import SharedPools
+from src.prefetch import PrefetchWindow
+
+logger = logging.getLogger(__name__)
+
+# 会话状态
+LISTENING = "listening"        # 等待/接收用户语音
+RECOGNIZING = "recognizing"    # ASR 识别中
+THINKING = "thinking"          # LLM 生成回复中
+SPEAKING = "speaking"          # 播放回复语音中
+
+
+class SessionPipeline:
+    """
+    单个会话的事件驱动处理流程，状态机：listening -> recognizing -> thinking -> speaking -> listening。
+    - 音频帧由 recorder 放入 audio_queue，一个协程顺序做VAD，只在 VAD 的 start/end 事件上做状态切换
+    - 一轮对话（识别、LLM、TTS、播放）在独立的协程中执行，同一会话的对话按顺序处理
+    - 后台工具的结果通过回调放入队列，空闲时播报，不再轮询
+    """
+
+    def __init__(self, session, pools: SharedPools, loop: asyncio.AbstractEventLoop,
+                 queues_config=None, llm_tracker=None):
+        queues_config = queues_config or {}
+        self.session = session
+        self.robot = session.robot
+        self.pools = pools
+        self.loop = loop
+        # 统计进行中的LLM请求，例如准入控制的 track_llm
+        self.llm_tracker = llm_tracker or nullcontext
+        self.state = LISTENING
+        self.voice = False
+        self.audio_queue = AsyncBoundedQueue.from_config("audio_queue", loop, queues_config.get("audio_queue"))
+        self.tts_queue = AsyncBoundedQueue("tts_queue", loop)
+        # 按顺序播放的句子，最多提前生成几句
+        self.speech_window = PrefetchWindow.from_config(self.robot.prepare_speech, self.robot.speech_output_config)
+        self.task_results = AsyncBoundedQueue("task_results", loop)
+        self.turn_lock = asyncio.Lock()
+        self.turn_task = None
+        self.speech = []
+        self.in_speech = False
+        # 当前语音段的开始时间和VAD累计耗时，记入本轮的 trace
+        self.speech_started = None
+        self.vad_seconds = 0.0
+        # 被打断的回合在线程池中的LLM调用，打断后会在下一个token处停止，下一轮开始前等待它结束，避免两轮同时写对话历史
+        self._pending_chat = None
+        self._tasks = set()
+
+    def start(self, voice: bool = True):
+        self.robot.set_task_result_sink(self.task_results)
+        # 语音回合由 Robot.chat 断句，句子放入 tts_queue 由 _speaker 生成并播放（AsyncBoundedQueue.put 线程安全）
+        self.robot.set_speech_sink(self.tts_queue)
+        # 只有 WebSocketRecorder 接收前端上行的音频
+        if voice and not hasattr(self.robot.recorder, "put_audio"):
+            logger.info(f"录音模块 {type(self.robot.recorder).__name__} 不接收websocket音频，会话只处理文字消息")
+            voice = False
+        self.voice = voice
+        if voice:
+            self.robot.recorder.start_recording(self.audio_queue)
+            self._spawn(self._audio_loop())
+        self._spawn(self._task_result_loop())
+
+    def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self.turn_task is not None:
+            self.turn_task.cancel()
+
+    def queue_stats(self):
+        return [self.audio_queue.stats(), self.tts_queue.stats()]
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _set_state(self, state):
+        if self.state != state:
+            logger.debug(f"用户 {self.session.user_id} 状态 {self.state} -> {state}")
+            self.state = state
+
+    async def _send(self, message: dict):
+        websocket = self.session.websocket
+        if websocket is None:
+            return
+        try:
+            await websocket.send_text(json.dumps(message, ensure_ascii=False))
+        except Exception as e:
+            logger.debug(f"用户 {self.session.user_id} 发送消息失败: {e}")
+
+    # ---------- 语音输入 ----------
+
+    async def _audio_loop(self):
+        while True:
+            frame = await self.audio_queue.get()
+            started = time.perf_counter()
+            try:
+                status = await asyncio.wrap_future(self.robot.detect_vad_async(frame))
+            except Exception as e:
+                logger.error(f"VAD 处理出错: {e}")
+                continue
+            self.vad_seconds += time.perf_counter() - started
+            await self._on_frame(frame, status)
+
+    def _busy(self):
+        return self.state in (THINKING, SPEAKING) or self.robot.player.get_playing_status()
+
+    async def _on_frame(self, frame, status):
+        # frame 是录音环形缓冲区帧槽的 memoryview，积累给ASR的语音复制出来，不长期占用帧槽
+        if self.in_speech:
+            self.speech.append(bytes(frame))
+        if status is None:
+            return
+        if "start" in status:
+            if self._busy():
+                if not self.robot.INTERRUPT:
+                    return
+                self.interrupt()
+            if not self.in_speech:
+                self.in_speech = True
+                self.speech.append(bytes(frame))
+                self.speech_started = time.time()
+                self.vad_seconds = 0.0
+        elif "end" in status and self.speech:
+            frames, self.speech, self.in_speech = self.speech, [], False
+            speech = (self.speech_started, time.time(), self.vad_seconds)
+            self.turn_task = self._spawn(self._run_turn(frames=frames, speak=True, speech=speech))
+
+    def interrupt(self):
+        """用户开口打断：取消LLM生成和还没完成的 TTS/THG 任务，停止播放，回到 listening"""
+        logger.info(f"用户 {self.session.user_id} 打断当前回复")
+        if self.turn_task is not None and not self.turn_task.done():
+            self.turn_task.cancel()
+        self.tts_queue.clear()
+        self.speech_window.clear()
+        self.robot.cancel_turn()
+        self._set_state(LISTENING)
+
+    # ---------- 对话回合 ----------
+
+    def submit_text(self, content: str):
+        """文字消息：不做服务端语音播放，由前端播放"""
+        return self._spawn(self._run_turn(text=content, speak=False))
+
+    async def _run_turn(self, text: str = None, frames=None, speak: bool = False, speech=None):
+        """speech: 语音回合的 (开始说话时间, 说完时间, VAD累计耗时)"""
+        async with self.turn_lock:
+            if self._pending_chat is not None and not self._pending_chat.done():
+                await asyncio.shield(asyncio.wrap_future(self._pending_chat))
+            self.robot.begin_turn(speak, start=speech[0] if speech else None,
+                                  source="voice" if frames is not None else "text",
+                                  user_id=self.session.user_id)
+            trace = self.robot.turn_trace
+            if speech:
+                trace.add_span("vad", speech[0], speech[1], frames=len(frames), vad_ms=round(speech[2] * 1000, 1))
+                trace.mark("speech_end", speech[1])
+            try:
+                if frames is not None:
+                    self._set_state(RECOGNIZING)
+                    text = await self.loop.run_in_executor(self.pools.asr, self.robot.recognize, frames)
+                    if not text or not text.strip():
+                        logger.debug("识别结果为空，跳过处理。")
+                        return
+                    logger.debug(f"ASR识别结果: {text}")
+                    await self._send({"type": "user_transcript", "content": text})
+                self._set_state(THINKING)
+                await self._chat(text, speak)
+            except asyncio.CancelledError:
+                logger.info(f"用户 {self.session.user_id} 的回合已取消")
+                raise
+            except Exception as e:
+                logger.error(f"用户 {self.session.user_id} 处理消息出错: {e}")
+            finally:
+                trace.finish()
+                self._set_state(LISTENING)
+
+    async def _chat(self, text: str, speak: bool):
+        """
+        LLM 在线程池中流式生成，回复按增量推送给前端：
+          {"type": "assistant_delta", "turn_id": ..., "seq": n, "content": 新生成的文本}
+          {"type": "assistant_commit", "turn_id": ..., "content": 完整回复, "spoken": 是否已由服务端播放}
+        语音回合按配置的对话模式（StartTaskMode）走 Robot.chat，断出的句子交给 TTS 线程池并按顺序播放；
+        文字回合走 chat_tool_tts，只推送文本
+        """
+        turn_id = uuid.uuid4().hex
+        deltas: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        interrupted = self.robot.turn_cancel
+
+        def on_delta(content):
+            # 在线程池中被调用，转交给事件循环按顺序处理
+            if cancelled.is_set() or interrupted.is_set():
+                return
+            self.loop.call_soon_threadsafe(deltas.put_nowait, content)
+
+        async def send_deltas():
+            seq = 0
+            while True:
+                content = await deltas.get()
+                if content is None:
+                    return
+                await self._send({"type": "assistant_delta", "turn_id": turn_id, "seq": seq, "content": content})
+                seq += 1
+
+        sender = self._spawn(send_deltas())
+        speaker = self._spawn(self._speaker()) if speak else None
+        try:
+            with self.llm_tracker():
+                chat = self.robot.chat if speak else self.robot.chat_tool_tts
+                self._pending_chat = self.pools.chat.submit(chat, text, on_delta)
+                response_message = await asyncio.wrap_future(self._pending_chat)
+            deltas.put_nowait(None)
+            await sender
+            # 只发送本轮的完整回复，不再重发整个对话历史；服务端已经播放的回复前端不再朗读
+            if response_message is not None:
+                await self._send({"type": "assistant_commit", "turn_id": turn_id,
+                                  "content": "".join(response_message), "spoken": speak})
+            logger.info(f"返回结果: {response_message}")
+            if speaker is not None:
+                self.tts_queue.put_nowait(None)
+                await speaker
+        finally:
+            cancelled.set()
+            sender.cancel()
+            if speaker is not None:
+                speaker.cancel()
+
+    def _speak(self, text: str):
+        """提交一句话的 TTS（以及数字人视频），在共享的 TTS/THG 线程池中按优先级生成，结果按提交顺序播放"""
+        self.tts_queue.put_nowait((text, self.robot.turn_cancel, self.robot.turn_trace))
+
+    async def _fill(self, window):
+        """从 tts_queue 取句子加入预取窗口，返回是否已经取到结束标记"""
+        while not window.full():
+            if len(window) == 0:
+                item = await self.tts_queue.get()
+            else:
+                # 窗口中还有句子在等待时不阻塞
+                try:
+                    item = self.tts_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return False
+            if item is None:
+                return True
+            window.add(*item)
+        return False
+
+    async def _speaker(self):
+        """按顺序播放：窗口头部的句子生成好就交给播放器，同时后面的句子在线程池中生成；超时或出错的句子跳过"""
+        window = self.speech_window
+        ended = False
+        waiting = None
+        try:
+            while True:
+                if not ended:
+                    ended = await self._fill(window)
+                segment = window.head()
+                if segment is None:
+                    if ended:
+                        return
+                    continue
+                if waiting is None or waiting[0] is not segment:
+                    waiting = (segment, asyncio.wrap_future(segment.future))
+                # 等待时间较短，期间到达的句子可以及时加入窗口开始生成
+                await asyncio.wait({waiting[1]}, timeout=max(0.0, min(0.05, segment.remaining())))
+                future = segment.future
+                if not future.done():
+                    if segment.remaining() <= 0:
+                        window.skip(segment, "生成超时")
+                    continue
+                window.discard(segment)
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    logger.error(f"TTS 任务出错: {future.exception()}")
+                    continue
+                audio = future.result()
+                if audio is None or segment.cancel.is_set():
+                    continue
+                self._set_state(SPEAKING)
+                self.robot.mark_spoken(segment.text)
+                segment.trace.mark("first_audio")
+                self.robot.player.enqueue(audio)
+        finally:
+            window.clear()
+
+    # ---------- 后台工具结果 ----------
+
+    async def _task_result_loop(self):
+        while True:
+            result = await self.task_results.get()
+            if not getattr(result, "response", None):
+                continue
+            # 等当前回合结束后再播报
+            async with self.turn_lock:
+                await self._send({"type": "assistant_commit", "turn_id": uuid.uuid4().hex, "content": result.response})
+                if not self.session.text_only:
+                    self._set_state(SPEAKING)
+                    # 播报相当于新的一轮回复，可以单独被打断
+                    self.robot.begin_turn(source="task_result", user_id=self.session.user_id)
+                    self._speak(result.response)
+                    self.tts_queue.put_nowait(None)
+                    try:
+                        await self._speaker()
+                    finally:
+                        self.robot.turn_trace.finish()
+                        self._set_state(LISTENING)
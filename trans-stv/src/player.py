@@ -3,6 +3,7 @@ import platform
 import queue
 import subprocess
 import threading
+import time
 import wave
 import pyaudio
 from pydub import  AudioSegment
@@ -11,6 +12,8 @@ import sounddevice as sd
 import numpy as np
 from playsound import playsound
 
+from src.metrics import PLAYER_QUEUE_WAIT_SECONDS
+
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +24,9 @@ class AbstractPlayer(object):
         self.is_playing = False
         self.play_queue = queue.Queue()
         self._stop_event = threading.Event()
-        self.consumer_thread = threading.Thread(target=self._playing)
-        self.consumer_thread.start()
+        # 消费线程在第一次播放时才启动，不播放的会话不占用线程
+        self.consumer_thread = None
+        self._thread_lock = threading.Lock()
 
     @staticmethod
     def to_wav(audio_file):
@@ -33,7 +37,13 @@ class AbstractPlayer(object):
 
     def _playing(self):
         while not self._stop_event.is_set():
-            data = self.play_queue.get()
+            item = self.play_queue.get()
+            if item is None:
+                # shutdown 放入的唤醒标记
+                self.play_queue.task_done()
+                continue
+            data, enqueued_at = item
+            PLAYER_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - enqueued_at)
             self.is_playing = True
             try:
                 self.do_playing(data)
@@ -43,10 +53,22 @@ class AbstractPlayer(object):
                 self.play_queue.task_done()
                 self.is_playing = False
 
+    def prepare(self, audio_file):
+        """把 TTS 生成的文件转换成 do_playing 可以直接播放的音频，可以在播放上一句时提前执行"""
+        return self.to_wav(audio_file)
+
     def play(self, data):
         logger.info(f"play file {data}")
-        audio_file = self.to_wav(data)
-        self.play_queue.put(audio_file)
+        self.enqueue(self.prepare(data))
+
+    def enqueue(self, data):
+        """放入播放队列（data 为 prepare 的结果），同时记录入队时间，用于统计排队等待时长"""
+        if self.consumer_thread is None:
+            with self._thread_lock:
+                if self.consumer_thread is None and not self._stop_event.is_set():
+                    self.consumer_thread = threading.Thread(target=self._playing, daemon=True)
+                    self.consumer_thread.start()
+        self.play_queue.put((data, time.perf_counter()))
 
     def stop(self):
         self._clear_queue()
@@ -54,8 +76,12 @@ class AbstractPlayer(object):
     def shutdown(self):
         self._clear_queue()
         self._stop_event.set()
-        if self.consumer_thread.is_alive():
-            self.consumer_thread.join()
+        # 唤醒阻塞在 play_queue.get() 上的消费线程，否则 join 会一直等待
+        self.play_queue.put(None)
+        with self._thread_lock:
+            consumer_thread = self.consumer_thread
+        if consumer_thread is not None and consumer_thread.is_alive():
+            consumer_thread.join()
 
     def get_playing_status(self):
         """正在播放和队列非空，为正在播放状态"""
@@ -159,11 +185,8 @@ class PygameSoundPlayer(AbstractPlayer):
         except Exception as e:
             logger.error(f"播放音频失败: {e}")
 
-    def play(self, data):
-        logger.info(f"play file {data}")
-        audio_file = self.to_wav(data)
-        sound = pygame.mixer.Sound(audio_file)
-        self.play_queue.put(sound)
+    def prepare(self, audio_file):
+        return pygame.mixer.Sound(self.to_wav(audio_file))
 
     def stop(self):
         super().stop()
@@ -212,6 +235,40 @@ class PlaysoundPlayer(AbstractPlayer):
         # playsound does not provide a stop method
 
 
+class NullPlayer(AbstractPlayer):
+    """
+    不输出声音的播放器，用于离线基准测试（benchmark.py）。
+    realtime 为 true 时按 wav 时长等待，模拟真实播放占用的时间；否则立即播放完成
+    """
+
+    def __init__(self, config=None, *args, **kwargs):
+        super(NullPlayer, self).__init__(*args, **kwargs)
+        self.realtime = (config or {}).get("realtime", True)
+        # 每次 stop 加一，正在“播放”的音频发现变化后立即结束
+        self._generation = 0
+
+    def prepare(self, audio_file):
+        # TTS 输出已经是 wav，不需要转换
+        return audio_file
+
+    def do_playing(self, audio_file):
+        if not self.realtime:
+            return
+        with wave.open(audio_file, "rb") as wf:
+            seconds = wf.getnframes() / wf.getframerate()
+        generation = self._generation
+        deadline = time.monotonic() + seconds
+        while generation == self._generation and not self._stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(0.02, remaining))
+
+    def stop(self):
+        super().stop()
+        self._generation += 1
+
+
 def create_instance(class_name, *args, **kwargs):
     # 获取类对象
     cls = globals().get(class_name)
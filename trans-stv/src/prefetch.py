@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Segment:
+    """窗口中的一句话：生成可播放音频的 Future、文本、所属回合的取消标志和 trace"""
+    __slots__ = ("future", "text", "cancel", "trace", "deadline")
+
+    def __init__(self, future: Future, text, cancel, trace, deadline: float):
+        self.future = future
+        self.text = text
+        self.cancel = cancel
+        self.trace = trace
+        self.deadline = deadline
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+
+class PrefetchWindow:
+    """
+    按顺序播放的句子的预取窗口：最多同时有 ahead 句在生成（TTS、THG、转换成可播放的音频），
+    播放当前句时后面的句子已经在准备，句子之间没有空隙。
+    结果按加入的顺序取出；超过 timeout 秒还没生成好的句子由调用方跳过，不阻塞后面的句子
+    """
+
+    def __init__(self, prepare: Callable[..., Future], ahead: int = 3, timeout: float = 20):
+        self.prepare = prepare
+        self.ahead = max(1, ahead)
+        self.timeout = timeout
+        self._segments = deque()
+        # cancel_turn 可能在其他线程清空窗口
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, prepare, config):
+        config = config or {}
+        return cls(prepare, ahead=config.get("prefetch", 3), timeout=config.get("segment_timeout", 20))
+
+    def __len__(self):
+        return len(self._segments)
+
+    def full(self) -> bool:
+        return len(self._segments) >= self.ahead
+
+    def add(self, text, cancel, trace):
+        """提交一句话开始生成；所属回合已被打断的句子直接丢弃"""
+        if cancel.is_set():
+            return
+        future = self.prepare(text, cancel, trace)
+        with self._lock:
+            self._segments.append(Segment(future, text, cancel, trace, time.monotonic() + self.timeout))
+
+    def head(self) -> Optional[Segment]:
+        with self._lock:
+            return self._segments[0] if self._segments else None
+
+    def discard(self, segment: Segment):
+        """移出已经播放或跳过的句子"""
+        with self._lock:
+            if self._segments and self._segments[0] is segment:
+                self._segments.popleft()
+
+    def skip(self, segment: Segment, reason: str):
+        logger.warning(f"跳过句子（{reason}）: {segment.text}")
+        segment.future.cancel()
+        self.discard(segment)
+
+    def clear(self):
+        """用户打断：取消窗口中所有还没开始的任务"""
+        with self._lock:
+            segments, self._segments = list(self._segments), deque()
+        for segment in segments:
+            segment.future.cancel()
+        return segments
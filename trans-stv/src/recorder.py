@@ -5,6 +5,9 @@ import queue
 import logging
 import pyaudio
 
+from src import audio_codec
+from src.ring_buffer import FrameRing
+
 logger = logging.getLogger(__name__)
 
 
@@ -77,44 +80,76 @@ class RecorderPyAudio(AbstractRecorder):
 
 
 class WebSocketRecorder(AbstractRecorder):
-    """通过WebSocket接收前端音频，并进行后端分帧处理"""
+    """
+    通过WebSocket接收前端音频，并进行后端分帧处理。
+    默认接收 16kHz Int16 PCM；前端可以通过 set_format 协商压缩编码（opus/webm/ogg），
+    服务端解码成 PCM 后按同样的 512 样本分帧，VAD/ASR 无需改动。
+    """
 
     def __init__(self, config):
+        config = config or {}
         self.running = True
         self.audio_queue: queue.Queue = None
-        self._buffer = bytearray()
-        self._frame_size_bytes = 512 * 2  # 512 samples × 2 bytes/sample for 16kHz Int16 PCM
+        # 512 samples × 2 bytes/sample for 16kHz Int16 PCM；放入队列的是环形缓冲区中帧槽的 memoryview
+        self._frame_size_bytes = 512 * 2
+        self._ring = FrameRing(self._frame_size_bytes, config.get("ring_frames", 256))
+        # 允许前端协商的编码
+        self.codecs = [c.lower() for c in config.get("codecs", ["pcm", "opus", "webm", "ogg"])]
+        self.codec = "pcm"
+        # ffmpeg 解码时由读线程回调分帧，加锁避免切换编码时并发写缓冲区
+        self._lock = threading.Lock()
+        self._decoder = audio_codec.create_decoder("pcm", self._put_pcm)
 
     def start_recording(self, audio_queue: queue.Queue):
         self.audio_queue = audio_queue
         self.running = True
 
+    def set_format(self, codec: str) -> str:
+        """协商上行音频编码，返回实际使用的编码；不支持或依赖缺失时回退到 pcm"""
+        codec = (codec or "pcm").lower()
+        if codec not in self.codecs:
+            logger.warning(f"不支持的音频编码 {codec}，使用 pcm")
+            codec = "pcm"
+        try:
+            decoder = audio_codec.create_decoder(codec, self._put_pcm)
+        except Exception as e:
+            logger.warning(f"{codec} 解码器初始化失败，使用 pcm: {e}")
+            codec = "pcm"
+            decoder = audio_codec.create_decoder(codec, self._put_pcm)
+        # 先停掉旧解码器并等它的读线程退出，旧格式的 PCM 不会再写入缓冲区；
+        # close 可能阻塞约2秒，set_format 需要在事件循环之外调用
+        self._decoder.close()
+        with self._lock:
+            self._decoder = decoder
+            self.codec = codec
+            self._ring.clear()
+        logger.info(f"上行音频编码: {codec}")
+        return codec
+
     def put_audio(self, data: bytes):
-        """接收原始 PCM 数据，将其缓冲并分帧后存入 audio_queue"""
+        """接收前端音频数据，解码后缓冲并分帧存入 audio_queue"""
         if not self.running:
             logger.info(f"录音已暂停，丢弃数据")
             return
-        # 累积数据
-        self._buffer.extend(data)
+        self._decoder.feed(data)
 
-        # 按 512 样本（1024 字节）分片
-        while len(self._buffer) >= self._frame_size_bytes:
-            chunk = bytes(self._buffer[:self._frame_size_bytes])
-            # 放入队列
-            try:
-                self.audio_queue.put(chunk, block=False)
-            except queue.Full:
-                logger.warning("audio_queue 已满，丢弃一帧音频")
-            # 移除已用数据
-            del self._buffer[:self._frame_size_bytes]
+    def _put_pcm(self, data: bytes):
+        """接收原始 PCM 数据，写入环形缓冲区，按 512 样本（1024 字节）分帧后存入 audio_queue"""
+        with self._lock:
+            for frame in self._ring.write(data):
+                try:
+                    self.audio_queue.put(frame, block=False)
+                except queue.Full:
+                    logger.warning("audio_queue 已满，丢弃一帧音频")
 
     def stop_recording(self):
         """停止录音，并将缓冲区剩余数据清理"""
         self.running = False
-        if hasattr(self, '_buffer'):
-            if self._buffer:
-                logger.info(f"剩余缓冲数据未满一帧：{len(self._buffer)} 字节，将被丢弃")
-            self._buffer.clear()
+        self._decoder.close()
+        with self._lock:
+            if self._ring.pending():
+                logger.info(f"剩余缓冲数据未满一帧：{self._ring.pending()} 字节，将被丢弃")
+            self._ring.clear()
         logger.info("录音已停止")
 
 def create_instance(class_name, *args, **kwargs):
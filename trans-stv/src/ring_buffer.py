@@ -0,0 +1,74 @@
+import logging
+import weakref
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# 每复制多少帧记录一次警告
+COPY_LOG_INTERVAL = 100
+
+
+class FrameRing:
+    """
+    预分配的分帧环形缓冲区：收到的 PCM 数据直接写入当前帧槽，写满一帧就交出该槽的 memoryview，
+    不再为每帧复制 bytes，也不需要从缓冲区头部删除数据（del buffer[:n] 会搬移剩余的全部数据）。
+    帧槽在 slots 帧之后被复用：复用前通过弱引用检查上一次交出的 memoryview 是否还被持有
+    （仍在下游队列中、等待入队或正在做VAD），还被持有时这一帧改为写入单独分配的缓冲区，不会覆盖未读的帧。
+    下游需要直接持有交出的 memoryview 对象；长期保存的帧（例如为ASR积累的语音）应自行复制，避免一直占用帧槽。
+    """
+
+    def __init__(self, frame_bytes: int = 1024, slots: int = 256):
+        self.frame_bytes = frame_bytes
+        self.slots = slots
+        self._buffer = bytearray(frame_bytes * slots)
+        self._view = memoryview(self._buffer)
+        # 每个帧槽上一次交出的 memoryview 的弱引用
+        self._lent = [None] * slots
+        self._slot = 0
+        # 当前帧写入的位置：帧槽，或帧槽被占用时单独分配的缓冲区
+        self._target = None
+        # 当前帧中已经写入的字节数
+        self._filled = 0
+        # 因帧槽仍被占用而复制的帧数
+        self.copied = 0
+
+    def _next_target(self) -> memoryview:
+        lent = self._lent[self._slot]
+        if lent is not None and lent() is not None:
+            self.copied += 1
+            if self.copied % COPY_LOG_INTERVAL == 1:
+                logger.warning(f"环形缓冲区的帧槽仍被下游占用，累计复制 {self.copied} 帧，可以增大 ring_frames")
+            return memoryview(bytearray(self.frame_bytes))
+        start = self._slot * self.frame_bytes
+        return self._view[start:start + self.frame_bytes]
+
+    def write(self, data) -> List[memoryview]:
+        """写入任意长度的数据，返回本次写满的帧"""
+        frames = []
+        data = memoryview(data).cast("B")
+        offset = 0
+        while offset < len(data):
+            if self._target is None:
+                self._target = self._next_target()
+            size = min(self.frame_bytes - self._filled, len(data) - offset)
+            self._target[self._filled:self._filled + size] = data[offset:offset + size]
+            self._filled += size
+            offset += size
+            if self._filled == self.frame_bytes:
+                # 交出新的切片而不是 _target 本身，弱引用只跟踪下游持有的对象
+                frame = self._target[:]
+                if self._target.obj is self._buffer:
+                    self._lent[self._slot] = weakref.ref(frame)
+                frames.append(frame)
+                self._slot = (self._slot + 1) % self.slots
+                self._target = None
+                self._filled = 0
+        return frames
+
+    def pending(self) -> int:
+        """未满一帧的字节数"""
+        return self._filled
+
+    def clear(self):
+        self._target = None
+        self._filled = 0
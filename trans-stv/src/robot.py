@@ -1,26 +1,27 @@
 import json
 import queue
 import threading
-import uuid
 from abc import ABC
 import logging
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import Future, TimeoutError, CancelledError
 import argparse
 import time
 
 from src import (
     recorder,
     player,
-    asr,
-    llm,
-    tts,
-    thg,
-    vad,
-    memory,
-    rag
 )
-from src.dialogue import Message, Dialogue
-from src.utils import is_interrupt, read_config, is_segment, extract_json_from_string
+from src.model_registry import get_registry
+from src.bounded_queue import BoundedQueue
+from src.executors import SharedPools, FIRST_SENTENCE, SENTENCE, submit, settle
+from src.prefetch import PrefetchWindow
+from src.metrics import VAD_FRAME_SECONDS, ASR_SECONDS, TTS_SECONDS, THG_SECONDS
+from src.dialogue import Message, Dialogue, INTERRUPTED_MARK
+from src.context import ContextWindow
+from src.utils import is_interrupt, read_config
+from src.segmenter import SentenceSegmenter
+from src.tool_calls import ToolCallCollector
+from src.tracing import configure as configure_tracing, NullTrace
 from plugins.registry import Action
 from plugins.task_manager import TaskManager
 
@@ -42,6 +43,7 @@ sys_prompt = """
 # 回复要求
 1. 你的回复应该简短、友好、口语化强一些，回复禁止出现表情符号。
 2. 如果需要调用工具，先不要回答，直接输出工具名和参数，输出格式```json\n{"function_name":"工具名", "args":{参数}}```，必须严格按照此格式。
+   需要同时调用多个工具时（例如同时查天气和理财产品），一次输出所有调用，每个工具一个```json代码块。
 3. 询问天气时，必须调用工具。
 3. 工具调用示例：
    - 天气查询：```json\n{"function_name":"get_weather", "args":{"city":"beijing/beijing"}}```
@@ -86,51 +88,44 @@ class Robot(ABC):
         
         return "\n\n".join(tools_desc)
 
-    def __init__(self, config_file, websocket = None, loop = None):
+    def __init__(self, config_file, websocket = None, loop = None, pools: SharedPools = None):
+        """
+        pools: 所有会话共享的分阶段线程池（TTS、THG、工具等），不传时使用进程内的 SharedPools 单例
+        """
         config = read_config(config_file)
-        self.audio_queue = queue.Queue()
+        self.pools = pools or SharedPools.instance((config.get("Server") or {}).get("pools"))
+        # 各阶段之间的有界队列，处理跟不上时按配置的策略丢帧并计数
+        queues_config = config.get("Queues") or {}
+        self.audio_queue = BoundedQueue.from_config("audio_queue", queues_config.get("audio_queue"))
+        # 模型在进程内共享，会话只持有自己的状态
+        models = get_registry()
 
         self.recorder = recorder.create_instance(
             config["selected_module"]["Recorder"],
             config["Recorder"][config["selected_module"]["Recorder"]]
         )
 
-        self.vad = vad.create_instance(
-            config["selected_module"]["VAD"],
-            config["VAD"][config["selected_module"]["VAD"]]
-        )
-
-        self.asr = asr.create_instance(
-            config["selected_module"]["ASR"],
-            config["ASR"][config["selected_module"]["ASR"]]
-        )
-
-        self.llm = llm.create_instance(
-            config["selected_module"]["LLM"],
-            config["LLM"][config["selected_module"]["LLM"]]
-        )
-
-        self.tts = tts.create_instance(
-            config["selected_module"]["TTS"],
-            config["TTS"][config["selected_module"]["TTS"]]
-        )
-
-        self.thg = thg.create_instance(
-            config["selected_module"]["THG"],
-            config["THG"][config["selected_module"]["THG"]]
-        )
+        self.vad = models.create_vad(config)
+        self.asr = models.get_asr(config)
+        self.llm = models.get_llm(config)
+        self.tts = models.get_tts(config)
+        self.thg = models.get_thg(config)
 
         self.player = player.create_instance(
             config["selected_module"]["Player"],
             config["Player"][config["selected_module"]["Player"]]
         )
 
-        self.memory = memory.Memory(config.get("Memory"))
+        # Memory 实例共享，但每个会话创建时重新加载，摘要包含之前会话的对话
+        self.memory = models.get_memory(config)
+        self.memory.refresh()
         
         # 初始化TaskManager
         self.task_queue = queue.Queue()
-        self.task_manager = TaskManager(config.get("TaskManager"), self.task_queue)
+        self.task_manager = TaskManager(config.get("TaskManager"), self.task_queue, self.pools.tools)
         self.start_task_mode = config.get("StartTaskMode")
+        # 一轮对话中最多带着工具结果请求LLM的次数
+        self.max_tool_rounds = config.get("TaskManager", {}).get("max_tool_rounds", 3)
         
         # 生成工具描述
         available_tools = self.generate_tools_description(self.task_manager.get_functions())
@@ -138,15 +133,33 @@ class Robot(ABC):
         # 构建完整的系统提示词
         self.prompt = sys_prompt.replace("{memory}", self.memory.get_memory()).replace("{available_tools}", available_tools).strip()
 
-        self.vad_queue = queue.Queue()
-        self.dialogue = Dialogue(config["Memory"]["dialogue_history_path"])
+        # 丢帧时优先丢弃不带VAD事件的帧，保留 start/end 事件
+        self.vad_queue = BoundedQueue.from_config("vad_queue", queues_config.get("vad_queue"),
+                                                  droppable=lambda item: item.get("vad_statue") is None)
+
+        # 上下文窗口：只发送最近几轮对话，较早的对话在后台合并成摘要
+        context = None
+        if config.get("Context"):
+            context = ContextWindow.from_config(config["Context"], summarize=self.summarize,
+                                                executor=self.pools.tools)
+        self.dialogue = Dialogue(
+            config["Memory"]["dialogue_history_path"],
+            flush_interval=config["Memory"].get("journal_flush_interval", 5),
+            flush_lines=config["Memory"].get("journal_flush_lines", 20),
+            context=context
+        )
         self.dialogue.put(Message(role="system", content=self.prompt))
 
         self.vad_start = True
         # 保证tts是顺序的
-        self.tts_queue = queue.Queue()
-        # 初始化线程池
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.tts_queue = BoundedQueue.from_config("tts_queue", queues_config.get("tts_queue"))
+        self._speech_sink = None
+        # 播放输出：提前生成后面几句，播放当前句时下一句已经可以播放
+        self.speech_output_config = config.get("SpeechOutput")
+        self.speech_window = PrefetchWindow.from_config(self.prepare_speech, self.speech_output_config)
+
+        # 流式断句配置，每轮回复创建一个断句器
+        self.segmenter_config = config.get("Segmenter")
 
         # 打断相关配置
         self.INTERRUPT = config["interrupt"]
@@ -155,6 +168,19 @@ class Robot(ABC):
         # 线程锁
         self.chat_lock = False
 
+        # 当前回合的取消标志，用户打断时置位；已记录的助手回复和已经开始播放的句子，用于记录打断位置
+        self.turn_cancel = threading.Event()
+        self._turn_reply = None
+        self._turn_speak = False
+        self._spoken = []
+        # 本轮已提交 TTS 的句子数，第一句以最高优先级生成
+        self._turn_segments = 0
+        self._turn_lock = threading.Lock()
+        # 每轮对话的时间线，记录各阶段耗时
+        self.tracer = configure_tracing(config.get("Tracing"))
+        self.turn_trace = NullTrace()
+        self._speech_started = None
+
         # 事件用于控制程序退出
         self.stop_event = threading.Event()
 
@@ -163,7 +189,7 @@ class Robot(ABC):
         self.speech = []
 
         # 初始化单例
-        rag.Rag(config["Rag"])  # 第一次初始化
+        models.get_rag(config)  # 第一次初始化
 
         """修改为前端播放大模型回复内容"""
         # if config["selected_module"]["Player"].lower().find("websocket") > -1:
@@ -173,21 +199,192 @@ class Robot(ABC):
     def listen_dialogue(self, callback):
         self.callback = callback
 
+    def summarize(self, prompt):
+        """用对话模型生成摘要，供上下文窗口合并较早的对话"""
+        return "".join(self.llm.response([{"role": "user", "content": prompt}]))
+
+    def set_speech_sink(self, sink):
+        """chat/chat_tool 断出的句子改为放入 sink（需要有线程安全的 put 方法），由调用方生成并播放"""
+        self._speech_sink = sink
+
+    def set_task_result_sink(self, sink):
+        """后台工具的结果改为放入 sink（需要有 put 方法），由调用方以事件驱动的方式处理"""
+        self.task_queue = sink
+        self.task_manager.result_queue = sink
+
+    def create_segmenter(self):
+        return SentenceSegmenter.from_config(self.segmenter_config)
+
+    def _speak_segments(self, segments, cancel=None):
+        for segment in segments:
+            self._submit_speech(segment, cancel)
+
+    def _submit_speech(self, text, cancel=None):
+        """一句话和所属回合的取消标志、trace 一起放入 tts_queue（或 set_speech_sink 设置的队列），按预取窗口生成并按顺序播放"""
+        cancel = cancel or self.turn_cancel
+        (self._speech_sink or self.tts_queue).put((text, cancel, self.turn_trace))
+
+    def prepare_speech(self, text, cancel=None, trace=None):
+        """
+        在共享的 TTS、THG 线程池中依次生成一句话的语音、转换成可播放的音频并生成数字人视频，
+        返回结果为可播放音频（player.prepare 的结果）的 Future。
+        每轮回复的第一句优先于其他会话后面的句子和后台工具；取消返回的 Future 会同时取消还没开始的 TTS/THG 任务
+        """
+        cancel = cancel or self.turn_cancel
+        trace = trace or self.turn_trace
+        with self._turn_lock:
+            priority = FIRST_SENTENCE if self._turn_segments == 0 else SENTENCE
+            self._turn_segments += 1
+        result = Future()
+        stage = [submit(self.pools.tts, priority, self.render, text, cancel, trace)]
+
+        def on_thg(future, audio):
+            settle(result, None if future.cancelled() else audio)
+
+        def on_tts(future):
+            if future.cancelled():
+                settle(result)
+                return
+            if future.exception() is not None:
+                settle(result, exception=future.exception())
+                return
+            tts_file, audio = future.result()
+            # 回复已被打断，不再生成数字人视频
+            if tts_file is None or cancel.is_set():
+                settle(result)
+                return
+            try:
+                stage[0] = submit(self.pools.thg, priority, self.animate, tts_file, trace)
+            except RuntimeError as e:
+                settle(result, exception=e)
+                return
+            stage[0].add_done_callback(lambda f: on_thg(f, audio))
+
+        stage[0].add_done_callback(on_tts)
+        result.add_done_callback(lambda f: f.cancelled() and stage[0].cancel())
+        return result
+
+    def begin_turn(self, speak=True, start=None, **attributes):
+        """
+        开始新的一轮对话，返回本轮的取消标志。
+        同时开始本轮的 trace（start 为用户开始说话的时间），上一轮的 trace 如果还没结束则在这里结束
+        """
+        with self._turn_lock:
+            self.turn_trace.finish()
+            self.turn_trace = self.tracer.start_trace(start, speak=speak, **attributes)
+            self.turn_cancel = threading.Event()
+            self._turn_reply = None
+            self._turn_speak = speak
+            self._spoken = []
+            self._turn_segments = 0
+        return self.turn_cancel
+
+    def mark_spoken(self, text):
+        """一句回复开始播放"""
+        self._spoken.append(text)
+
+    def cancel_turn(self):
+        """
+        用户打断：取消当前回合。LLM流式生成在下一个token处停止并关闭HTTP连接，
+        还没开始的 TTS/THG 任务取消，已经开始的在下一步检查取消标志，tts_queue 清空，
+        对话历史中的助手回复截断到已经播放的句子并标记为被打断。
+        """
+        with self._turn_lock:
+            if self.turn_cancel.is_set():
+                return
+            self.turn_cancel.set()
+            self.turn_trace.finish(interrupted=True)
+            reply = self._turn_reply
+            if reply is not None:
+                reply.content = self._interrupted_content(reply.content)
+                self.dialogue.update(reply)
+        self.tts_queue.clear()
+        self.speech_window.clear()
+        self.interrupt_playback()
+
+    def _interrupted_content(self, generated):
+        # 语音回合记录用户已经听到的部分，文字回合记录已经生成的部分
+        content = "".join(self._spoken) if self._turn_speak else generated
+        return content + INTERRUPTED_MARK
+
+    def _put_reply(self, cancel, response_message):
+        """记录本轮的助手回复；已被打断时只记录到打断位置"""
+        with self._turn_lock:
+            content = "".join(response_message)
+            if cancel.is_set():
+                content = self._interrupted_content(content)
+            elif not response_message:
+                return None
+            reply = Message(role="assistant", content=content)
+            self.dialogue.put(reply)
+            if cancel is self.turn_cancel:
+                self._turn_reply = reply
+            return reply
+
+    def _traced_llm(self, llm_responses, **attributes):
+        """包装LLM生成器，在本轮的 trace 中记录首token时间（ttft_ms）和生成总耗时"""
+        span = self.turn_trace.start_span("llm", **attributes)
+        chunks = 0
+        try:
+            for chunk in llm_responses:
+                if chunks == 0:
+                    span.set("ttft_ms", round(span.elapsed_ms(), 1))
+                chunks += 1
+                yield chunk
+        finally:
+            llm_responses.close()
+            span.end(chunks=chunks)
+
+    def detect_vad(self, frame):
+        """单帧VAD检测，返回 None 或 {"start": ..} / {"end": ..}"""
+        with VAD_FRAME_SECONDS.time():
+            return self.vad.is_vad(frame)
+
+    def detect_vad_async(self, frame):
+        """
+        单帧VAD检测，返回 Future。支持批量推理的VAD（SileroVAD）和其他会话的帧合并推理，
+        其余的在共享的VAD线程池中逐帧执行
+        """
+        is_vad_async = getattr(self.vad, "is_vad_async", None)
+        if is_vad_async is None:
+            return self.pools.vad.submit(self.detect_vad, frame)
+        started = time.perf_counter()
+        future = is_vad_async(frame)
+        future.add_done_callback(lambda _: VAD_FRAME_SECONDS.observe(time.perf_counter() - started))
+        return future
+
+    def recognize(self, frames):
+        """ASR识别一段语音帧，返回文本"""
+        with ASR_SECONDS.time(), self.turn_trace.span("asr", frames=len(frames)) as span:
+            text, _ = self.asr.recognizer(frames)
+            span.set("chars", len(text or ""))
+        return text
+
+    def queue_stats(self):
+        """各阶段队列的深度和丢弃计数"""
+        return [q.stats() for q in (self.audio_queue, self.vad_queue, self.tts_queue)]
+
     def shutdown(self):
         """关闭所有资源，确保程序安全退出"""
         logger.info("Shutting down Robot...")
         self.stop_event.set()
-        self.executor.shutdown(wait=True)
+        self.task_manager.shutdown()
         self.recorder.stop_recording()
         self.player.shutdown()
+        self.turn_trace.finish()
+        self.dialogue.close()
         logger.info("Shutdown complete.")
 
-    def chat_tool(self, query):
+    def chat_tool(self, query, tool_round=0, cancel=None, on_delta=None):
+        # 后续的工具轮次沿用本轮开始时的取消标志，被打断后不会把剩下的句子算到下一轮
+        cancel = cancel or self.turn_cancel
         # 打印逐步生成的响应内容
-        start = 0
+        segmenter = self.create_segmenter()
         try:
             start_time = time.time()  # 记录开始时间
-            llm_responses = self.llm.response_call(self.dialogue.get_llm_dialogue(), functions_call=self.task_manager.get_functions())
+            llm_responses = self._traced_llm(
+                self.llm.response_call(self.dialogue.get_llm_dialogue(), functions_call=self.task_manager.get_functions()),
+                round=tool_round)
         except Exception as e:
             #self.chat_lock = False
             logger.error(f"LLM 处理出错 {query}: {e}")
@@ -195,175 +392,103 @@ class Robot(ABC):
 
         tool_call_flag = False
         response_message = []
-        # tool call 参数
-        function_name = None
-        function_id = None
-        function_arguments = ""
+        # 收集回复中的所有工具调用
+        collector = ToolCallCollector()
         content_arguments = ""
         for chunk in llm_responses:
+            if cancel.is_set():
+                # 关闭生成器，同时关闭LLM的HTTP连接
+                llm_responses.close()
+                logger.info("回复被打断，停止生成")
+                break
             content, tools_call = chunk
             if content is not None and len(content)>0:
-                if len(response_message)<=0 and content=="```":
+                if len(response_message)<=0 and content.lstrip().startswith("```"):
                     tool_call_flag = True
             if tools_call is not None:
                 tool_call_flag = True
-                if tools_call[0].id is not None:
-                    function_id = tools_call[0].id
-                if tools_call[0].function.name is not None:
-                    function_name = tools_call[0].function.name
-                if tools_call[0].function.arguments is not None:
-                    function_arguments += tools_call[0].function.arguments
+                collector.add(tools_call)
             if content is not None and len(content) > 0:
                 if tool_call_flag:
                     content_arguments+=content
                 else:
                     response_message.append(content)
+                    if on_delta:
+                        on_delta(content)
                     end_time = time.time()  # 记录结束时间
                     logger.info(f"大模型返回时间时间: {end_time - start_time} 秒, 生成token={content}")
-                    if is_segment(response_message):
-                        segment_text = "".join(response_message[start:])
-                        # 为了保证语音的连贯，至少2个字才转tts
-                        if len(segment_text) <= max(2, start):
-                            continue
-                        future = self.executor.submit(self.speak_and_play, segment_text)
-                        self.tts_queue.put(future)
-                        # futures.append(future)
-                        start = len(response_message)
+                    self._speak_segments(segmenter.feed(content), cancel)
 
+        if cancel.is_set():
+            return response_message
         if not tool_call_flag:
-            if start < len(response_message):
-                segment_text = "".join(response_message[start:])
-                future = self.executor.submit(self.speak_and_play, segment_text)
-                self.tts_queue.put(future)
-        else:
-            # 处理函数调用
-            logger.info(f"🔧 检测到工具调用，开始解析...")
-            
-            if function_id is None:
-                # 尝试从内容中提取JSON格式的工具调用
-                json_str = extract_json_from_string(content_arguments)
-                if json_str is not None:
-                    try:
-                        content_arguments_json = json.loads(json_str)
-                        function_name = content_arguments_json.get("function_name")
-                        function_args = content_arguments_json.get("args", {})
-                        function_arguments = json.dumps(function_args, ensure_ascii=False)
-                        function_id = str(uuid.uuid4().hex)
-                        logger.info(f"✅ 成功解析JSON格式: function_name={function_name}, args={function_args}")
-                    except json.JSONDecodeError as e:
-                        logger.error(f"❌ JSON解析失败: {e}, 原始内容: {json_str}")
-                        return []
-                else:
-                    # 如果找不到JSON格式，尝试直接从文本中提取函数名
-                    logger.warning(f"⚠️ 未找到JSON格式，尝试直接解析文本: {content_arguments[:100]}...")
-                    # 可以在这里添加更多的解析逻辑
-                    return []
-                
-                # 解析函数参数
-                try:
-                    function_arguments = json.loads(function_arguments)
-                except json.JSONDecodeError as e:
-                    logger.error(f"❌ 函数参数解析失败: {e}, 参数: {function_arguments}")
-                    return []
-            
-            # 验证函数名
-            if not function_name:
-                logger.error(f"❌ 未找到有效的函数名")
-                return []
-                
-            logger.info(f"🚀 准备调用工具: function_name={function_name}, function_id={function_id}, function_arguments={function_arguments}")
-            
-            # 调用工具
-            try:
-                result = self.task_manager.tool_call(function_name, function_arguments)
-                logger.info(f"📊 工具调用结果: action={result.action}, response={result.response}")
-            except Exception as e:
-                logger.error(f"❌ 工具调用异常: {e}")
-                return []
-            
-            # 根据返回的action类型处理
-            if result.action == Action.NOTFOUND: # = (0, "没有找到函数")
-                logger.error(f"❌ 没有找到函数: {function_name}")
-                return [f"抱歉，没有找到名为'{function_name}'的工具函数。"]
-            elif result.action == Action.NONE: # = (1,  "啥也不干")
-                logger.info(f"ℹ️ 工具调用完成，无需进一步处理")
-                return []
-            elif result.action == Action.RESPONSE: # = (2, "直接回复")
-                logger.info(f"💬 工具返回直接回复: {result.response}")
-                if result.response:
-                    future = self.executor.submit(self.speak_and_play, result.response)
-                    self.tts_queue.put(future)
-                    return [result.response]
-                return []
-            elif result.action == Action.REQLLM: # = (3, "调用函数后再请求llm生成回复")
-                logger.info(f"🔄 工具调用完成，请求LLM生成后续回复")
-                # 添加工具内容
-                self.dialogue.put(Message(role='assistant',
-                                          tool_calls=[{"id": function_id, "function": {"arguments": json.dumps(function_arguments ,ensure_ascii=False),
-                                                                                       "name": function_name},
-                                                       "type": 'function', "index": 0}]))
-
-                self.dialogue.put(Message(role="tool", tool_call_id=function_id, content=result.result))
-                return self.chat_tool(query)
-            elif result.action == Action.ADDSYSTEM: # = (4, "添加系统prompt到对话中去")
-                logger.info(f"📋 添加系统提示词到对话历史")
-                self.dialogue.put(Message(**result.result))
-                return []
-            elif result.action == Action.ADDSYSTEMSPEAK: # = (5, "添加系统prompt到对话中去&主动说话")
-                logger.info(f"🗣️ 添加系统提示词并主动说话")
-                self.dialogue.put(Message(role='assistant',
-                                          tool_calls=[{"id": function_id, "function": {
-                                              "arguments": json.dumps(function_arguments, ensure_ascii=False),
-                                              "name": function_name},
-                                                       "type": 'function', "index": 0}]))
-
-                self.dialogue.put(Message(role="tool", tool_call_id=function_id, content=result.response))
-                self.dialogue.put(Message(**result.result))
-                self.dialogue.put(Message(role="user", content="ok"))
-                return self.chat_tool(query)
-            else:
-                logger.error(f"❌ 未知的action类型: {result.action}")
-                return []
-        return response_message
+            rest = segmenter.flush()
+            if rest:
+                self._speak_segments([rest], cancel)
+            return response_message
 
-    def chat(self, query):
+        # 处理函数调用
+        logger.info(f"🔧 检测到工具调用，开始解析...")
+        calls = collector.calls(content_arguments)
+        if not calls:
+            logger.warning(f"⚠️ 没有解析出工具调用: {content_arguments[:100]}...")
+            return []
+        if tool_round >= self.max_tool_rounds:
+            logger.warning(f"工具调用已达到 {self.max_tool_rounds} 轮，忽略: {calls}")
+            return []
+        replies, follow_up = self._dispatch_tool_calls(calls)
+        for reply in replies:
+            if on_delta:
+                on_delta(reply)
+            self._submit_speech(reply, cancel)
+        if follow_up and not cancel.is_set():
+            logger.info(f"🔄 工具调用完成，请求LLM生成后续回复")
+            return replies + self.chat_tool(query, tool_round + 1, cancel, on_delta)
+        return replies
+
+    def chat(self, query, on_delta=None):
+        """
+        语音对话：按 StartTaskMode 选择是否支持工具调用，回复边生成边断句交给 TTS 播放，返回回复的各段文本。
+        on_delta: 可选回调，每生成一段回复文本就调用一次 on_delta(text)，用于流式推送给前端
+        """
+        # 本轮在识别语音前已经由 _duplex 开始
+        cancel = self.turn_cancel
         self.dialogue.put(Message(role="user", content=query))
         response_message = []
         # futures = []
         start = 0
         self.chat_lock = True
         if self.start_task_mode:
-            response_message = self.chat_tool(query)
+            response_message = self.chat_tool(query, cancel=cancel, on_delta=on_delta)
         else:
             # 提交 LLM 任务
             try:
                 start_time = time.time()  # 记录开始时间
-                llm_responses = self.llm.response(self.dialogue.get_llm_dialogue())
+                # 流式请求，用户打断时关闭生成器即可中止生成
+                llm_responses = self._traced_llm(self.llm.response_stream(self.dialogue.get_llm_dialogue()))
             except Exception as e:
                 self.chat_lock = False
                 logger.error(f"LLM 处理出错 {query}: {e}")
                 return None
-            # 提交 TTS 任务到线程池
+            # 边生成边断句，提交 TTS 任务到线程池
+            segmenter = self.create_segmenter()
             for content in llm_responses:
+                if cancel.is_set():
+                    # 关闭生成器，同时关闭LLM的HTTP连接
+                    llm_responses.close()
+                    logger.info("回复被打断，停止生成")
+                    break
                 response_message.append(content)
+                if on_delta:
+                    on_delta(content)
                 end_time = time.time()  # 记录结束时间
                 logger.debug(f"大模型返回时间时间: {end_time - start_time} 秒, 生成token={content}")
-                if is_segment(response_message):
-                    segment_text = "".join(response_message[start:])
-                    # 为了保证语音的连贯，至少2个字才转tts
-                    if len(segment_text)<=max(2, start):
-                        continue
-                    future = self.executor.submit(self.speak_and_play, segment_text)
-                    self.tts_queue.put(future)
-                    #futures.append(future)
-                    start = len(response_message)
+                self._speak_segments(segmenter.feed(content), cancel)
 
             # 处理剩余的响应
-            if start < len(response_message):
-                segment_text = "".join(response_message[start:])
-                future = self.executor.submit(self.speak_and_play, segment_text)
-                self.tts_queue.put(future)
-                #futures.append(future)
+            rest = segmenter.flush()
+            if rest and not cancel.is_set():
+                self._speak_segments([rest], cancel)
 
             # 等待所有 TTS 任务完成
             """
@@ -379,10 +504,11 @@ class Robot(ABC):
         # 更新对话
         if self.callback:
             self.callback({"role": "assistant", "content": "".join(response_message)})
-        self.dialogue.put(Message(role="assistant", content="".join(response_message)))
+        self._put_reply(cancel, response_message)
         self.dialogue.dump_dialogue()
-        logger.debug(json.dumps(self.dialogue.get_llm_dialogue(), indent=4, ensure_ascii=False))
-        return True
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(self.dialogue.get_llm_dialogue(), indent=4, ensure_ascii=False))
+        return response_message
 
     def chat_tts(self, query):
         self.dialogue.put(Message(role="user", content=query))
@@ -412,7 +538,7 @@ class Robot(ABC):
                 # 为了保证语音的连贯，至少2个字才转tts
                 if len(segment_text)<=max(2, start):
                     continue
-                future = self.executor.submit(self.generate_tts, segment_text)
+                future = self.pools.tts.submit(self.generate_tts, segment_text)
                 tts_file = future.result()  # 直接获取结果
                 if tts_file is not None:
                     tts_files.append(tts_file)
@@ -423,7 +549,7 @@ class Robot(ABC):
         # 处理剩余的响应
         if start < len(response_message):
             segment_text = "".join(response_message[start:])
-            future = self.executor.submit(self.generate_tts, segment_text)
+            future = self.pools.tts.submit(self.generate_tts, segment_text)
             tts_file = future.result()  # 直接获取结果
             if tts_file is not None:
                 tts_files.append(tts_file)
@@ -440,17 +566,28 @@ class Robot(ABC):
             logger.info(f"大模型返回时间时间: {end_time - start_time} 秒, 生成token={content}")
         self.dialogue.put(Message(role="assistant", content="".join(response_message)))
         self.dialogue.dump_dialogue()
-        logger.info(json.dumps(self.dialogue.get_llm_dialogue(), indent=4, ensure_ascii=False))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(self.dialogue.get_llm_dialogue(), indent=4, ensure_ascii=False))
 
         return response_message
 
-    def chat_tool_tts(self, query):
-        self.dialogue.put(Message(role="user", content=query))
+    def chat_tool_tts(self, query, on_delta=None, tool_round=0, cancel=None):
+        """
+        文本对话，支持工具调用。
+        on_delta: 可选回调，LLM 每生成一段回复文本就调用一次 on_delta(text)，用于流式推送给前端
+        tool_round: 第几次带着工具结果请求LLM，0 表示用户的新问题
+        cancel: 本轮的取消标志，后续的工具轮次沿用第一轮取到的标志
+        """
+        cancel = cancel or self.turn_cancel
+        if tool_round == 0:
+            self.dialogue.put(Message(role="user", content=query))
         # 打印逐步生成的响应内容
         start = 0
         try:
             start_time = time.time()  # 记录开始时间
-            llm_responses = self.llm.response_call(self.dialogue.get_llm_dialogue(), functions_call=self.task_manager.get_functions())
+            llm_responses = self._traced_llm(
+                self.llm.response_call_stream(self.dialogue.get_llm_dialogue(), functions_call=self.task_manager.get_functions()),
+                round=tool_round)
         except Exception as e:
             #self.chat_lock = False
             logger.error(f"LLM 处理出错 {query}: {e}")
@@ -458,85 +595,117 @@ class Robot(ABC):
 
         tool_call_flag = False
         response_message = []
-        # tool call 参数
-        function_name = None
-        function_id = None
-        function_arguments = ""
+        # 回复开头的内容，用于判断是否为```工具调用，判断出来之前不推送给前端
+        head = ""
+        head_decided = False
+        # 收集回复中的所有工具调用
+        collector = ToolCallCollector()
         content_arguments = ""
         for chunk in llm_responses:
+            if cancel.is_set():
+                # 关闭生成器，同时关闭LLM的HTTP连接
+                llm_responses.close()
+                logger.info("回复被打断，停止生成")
+                break
             content, tools_call = chunk
-            # 1. 检测工具调用标志（通过```开始标记）
-            if content is not None and len(content)>0:
-                # content=="```"？开启stream？或者不开启时response_message不能添加think内容
-                if len(response_message)<=0 and content.startswith("```"):
-                    tool_call_flag = True
+            # 1. 检测工具调用标志（通过```开始标记），```可能被拆成多个token
+            if content is not None and len(content)>0 and not head_decided:
+                head += content
+                if len(head.lstrip()) < 3:
+                    content = None
+                else:
+                    head_decided = True
+                    if head.lstrip().startswith("```"):
+                        tool_call_flag = True
+                    content = head
             # 2. 处理工具调用信息
             if tools_call is not None:
                 tool_call_flag = True
-                if tools_call[0].id is not None:
-                    function_id = tools_call[0].id
-                if tools_call[0].function.name is not None:
-                    function_name = tools_call[0].function.name
-                if tools_call[0].function.arguments is not None:
-                    function_arguments += tools_call[0].function.arguments
-            logger.info(msg=f"function_name={function_name}, function_id={function_id}, function_arguments={function_arguments}")
+                collector.add(tools_call)
+                logger.info(f"工具调用chunk: {tools_call}")
             # 3. 分类处理内容
             if content is not None and len(content) > 0:
                 if tool_call_flag:
                     content_arguments+=content
                 else:
                     response_message.append(content)
-                    # 实时更新对话历史和记录日志
-                    self.dialogue.put(Message(role="assistant", content="".join(response_message)))
-                    self.dialogue.dump_dialogue()
+                    if on_delta:
+                        on_delta(content)
                     end_time = time.time()  # 记录结束时间
-                    logger.info(f"大模型返回时间时间: {end_time - start_time} 秒, 生成token={content}")
-        logger.info(json.dumps(self.dialogue.get_llm_dialogue(), indent=4, ensure_ascii=False))
+                    logger.debug(f"大模型返回时间时间: {end_time - start_time} 秒, 生成token={content}")
+        # 回复过短，没有判断出是否为工具调用
+        if not head_decided and len(head) > 0 and not cancel.is_set():
+            response_message.append(head)
+            if on_delta:
+                on_delta(head)
+        # 回复生成完后只记录一条完整的助手消息，并在本轮结束时写入对话日志
+        self._put_reply(cancel, response_message)
+        self.dialogue.dump_dialogue()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(self.dialogue.get_llm_dialogue(), indent=4, ensure_ascii=False))
+        if cancel.is_set() or not tool_call_flag:
+            return response_message
 
         # 处理函数调用
-        if function_id is None:
-            a = extract_json_from_string(content_arguments)
-            if a is not None:
-                content_arguments_json = json.loads(a)
-                function_name = content_arguments_json["function_name"]
-                function_arguments = json.dumps(content_arguments_json["args"], ensure_ascii=False)
-                function_id = str(uuid.uuid4().hex)
-            else:
-                return response_message
-            function_arguments = json.loads(function_arguments)
-        logger.info(f"function_name={function_name}, function_id={function_id}, function_arguments={function_arguments}")
-        # 调用工具
-        result = self.task_manager.tool_call(function_name, function_arguments)
-        logger.info(f"=== 工具调用结果 ===")
-        logger.info(f"工具名: {function_name}")
-        logger.info(f"调用参数: {json.dumps(function_arguments, ensure_ascii=False, indent=2)}")
-        logger.info(f"执行结果 action: {result.action}")
-        logger.info(f"执行结果 response: {result.response}")
-        logger.info(f"执行结果 content: {getattr(result, 'result', None)}")
-        logger.info(f"==================")
-        if result.action == Action.NOTFOUND: # = (0, "没有找到函数")
-            logger.error(f"没有找到函数{function_name}")
+        calls = collector.calls(content_arguments)
+        if not calls:
+            logger.warning(f"没有解析出工具调用: {content_arguments[:100]}")
             return response_message
-        elif result.action == Action.NONE: # = (1,  "啥也不干")
+        if tool_round >= self.max_tool_rounds:
+            logger.warning(f"工具调用已达到 {self.max_tool_rounds} 轮，忽略: {calls}")
             return response_message
-        elif result.action == Action.RESPONSE: # = (2, "直接回复")
-            return [result.response]
-        elif result.action == Action.REQLLM: # = (3, "调用函数后再请求llm生成回复")
-            # self.dialogue.put(Message(role='assistant',tool_calls=[{"id": function_id, "function": {"arguments": json.dumps(function_arguments ,ensure_ascii=False),"name": function_name},"type":'function',"index": 0}]))
-            self.dialogue.put(Message(role="tool", tool_call_id=function_id, content=result.result))
-            self.chat_tool_tts(query)
-        elif result.action == Action.ADDSYSTEM: # = (4, "添加系统prompt到对话中去")
-            self.dialogue.put(Message(**result.result))
-            return response_message
-        elif result.action == Action.ADDSYSTEMSPEAK: # = (5, "添加系统prompt到对话中去&主动说话")
-            # self.dialogue.put(Message(role='assistant',tool_calls=[{"id": function_id, "function": {"arguments": json.dumps(function_arguments, ensure_ascii=False), "name": function_name},"type":'function',"index": 0}]))
-            self.dialogue.put(Message(role="tool", tool_call_id=function_id, content=result.response))
-            self.dialogue.put(Message(**result.result))
+        replies, follow_up = self._dispatch_tool_calls(calls)
+        for reply in replies:
+            if on_delta:
+                on_delta(reply)
+            response_message.append(reply)
+        if follow_up and not cancel.is_set():
+            # 所有工具的结果都已写入对话历史，只再请求一次LLM
+            response_message += self.chat_tool_tts(query, on_delta, tool_round + 1, cancel)
+        return response_message
+
+    def _dispatch_tool_calls(self, calls):
+        """
+        并发执行一轮回复中的所有工具调用，结果写入对话历史。
+        返回 (直接回复给用户的内容, 是否需要带着工具结果再请求一次LLM)
+        """
+        logger.info(f"🚀 准备调用工具: {calls}")
+        with self.turn_trace.span("tools", names=[call.name for call in calls]):
+            results = self.task_manager.tool_calls([(call.name, call.arguments) for call in calls])
+        replies = []
+        # 需要交给LLM的工具结果 (调用, 内容)
+        tool_results = []
+        system_messages = []
+        speak = False
+        for call, result in zip(calls, results):
+            logger.info(f"📊 工具调用结果: {call.name}, action={result.action}, response={result.response}, result={result.result}")
+            if result.action == Action.NOTFOUND: # = (0, "没有找到函数")
+                logger.error(f"❌ 没有找到函数: {call.name}")
+                replies.append(f"抱歉，没有找到名为'{call.name}'的工具函数。")
+            elif result.action == Action.NONE: # = (1,  "啥也不干")
+                continue
+            elif result.action == Action.RESPONSE: # = (2, "直接回复")
+                if result.response:
+                    replies.append(result.response)
+            elif result.action == Action.REQLLM: # = (3, "调用函数后再请求llm生成回复")
+                tool_results.append((call, result.result))
+            elif result.action == Action.ADDSYSTEM: # = (4, "添加系统prompt到对话中去")
+                system_messages.append(result.result)
+            elif result.action == Action.ADDSYSTEMSPEAK: # = (5, "添加系统prompt到对话中去&主动说话")
+                tool_results.append((call, result.response))
+                system_messages.append(result.result)
+                speak = True
+            else:
+                logger.error(f"❌ 未知的action类型: {result.action}")
+        if tool_results:
+            self.dialogue.put(Message(role="assistant", tool_calls=[call.to_message() for call, _ in tool_results]))
+            for call, content in tool_results:
+                self.dialogue.put(Message(role="tool", tool_call_id=call.id, content=content))
+        for message in system_messages:
+            self.dialogue.put(Message(**message))
+        if speak:
             self.dialogue.put(Message(role="user", content="ok"))
-            return self.chat_tool_tts(query)
-        else:
-            logger.error(f"not found action type: {result.action}")
-        return response_message  
+        return replies, bool(tool_results)
 
     def interrupt_playback(self):
         """中断当前的语音播放"""
@@ -546,37 +715,53 @@ class Robot(ABC):
         if text is None or len(text)<=0:
             logger.info(f"无需tts转换，query为空，{text}")
             return None
-        tts_file = self.tts.to_tts(text)
+        with TTS_SECONDS.time():
+            tts_file = self.tts.to_tts(text)
         if tts_file is None:
             logger.error(f"tts转换失败，{text}")
             return None
         logger.info(f"tts文件生成成功: {tts_file}")
         return tts_file
-    def speak_and_play(self, text):
+    def synthesize(self, text, cancel=None, trace=None):
+        """生成一句话的语音，返回 tts 文件；回复已被打断时不再生成"""
         if text is None or len(text)<=0:
             logger.info(f"无需tts转换，query为空，{text}")
             return None
-        tts_file = self.tts.to_tts(text)
+        if cancel is not None and cancel.is_set():
+            return None
+        trace = trace or self.turn_trace
+        with TTS_SECONDS.time(), trace.span("tts", chars=len(text)):
+            tts_file = self.tts.to_tts(text)
         if tts_file is None:
             logger.error(f"tts转换失败，{text}")
             return None
         logger.debug(f"TTS 文件生成完毕{self.chat_lock}")
-        # 调用THG生成数字人视频
+        return tts_file
+
+    def render(self, text, cancel=None, trace=None):
+        """生成语音并转换成播放器可以直接播放的音频，返回 (tts 文件, 音频)"""
+        tts_file = self.synthesize(text, cancel, trace)
+        if tts_file is None or (cancel is not None and cancel.is_set()):
+            return None, None
+        trace = trace or self.turn_trace
+        with trace.span("prepare"):
+            audio = self.player.prepare(tts_file)
+        return tts_file, audio
+
+    def animate(self, tts_file, trace=None):
+        """调用THG生成数字人视频，失败时只记录日志，不影响语音播放"""
+        trace = trace or self.turn_trace
+        video_path = None
         try:
-            video_path = self.thg.to_thg(tts_file)
+            with THG_SECONDS.time(), trace.span("thg"):
+                video_path = self.thg.to_thg(tts_file)
             if video_path:
                 logger.info(f"THG数字人视频生成成功: {video_path}")
             else:
                 logger.warning("THG数字人视频生成失败")
         except Exception as e:
             logger.error(f"THG处理出错: {e}")
-        
-        #if self.chat_lock is False:
-        #    return None
-        # 开始播放
-        # self.player.play(tts_file)
-        #return True
-        return tts_file
+        return video_path
 
     def _duplex(self):
         # 处理识别结果
@@ -589,8 +774,8 @@ class Robot(ABC):
         if not self.task_queue.empty() and  not self.vad_start and vad_status is None \
                 and not self.player.get_playing_status() and self.chat_lock is False:
             result = self.task_queue.get()
-            future = self.executor.submit(self.speak_and_play, result.response)
-            self.tts_queue.put(future)
+            # 播报后台工具结果相当于新的一轮回复，可以单独被打断
+            self._submit_speech(result.response, self.begin_turn(source="task_result"))
 
         """ 语音唤醒
         if time.time() - self.start_time>=60:
@@ -605,7 +790,7 @@ class Robot(ABC):
             if self.player.get_playing_status() or self.chat_lock is True:  # 正在播放，打断场景
                 if self.INTERRUPT:
                     self.chat_lock = False
-                    self.interrupt_playback()
+                    self.cancel_turn()
                     self.vad_start = True
                     self.speech.append(data)
                 else:
@@ -613,12 +798,18 @@ class Robot(ABC):
             else:  # 没有播放，正常
                 self.vad_start = True
                 self.speech.append(data)
+            self._speech_started = time.time()
         elif "end" in vad_status and len(self.speech) > 0:
+            # 用户说完，开始新的一轮，trace 从开始说话算起
+            speech_end = time.time()
+            self.begin_turn(speak=True, start=self._speech_started, source="voice")
+            self.turn_trace.add_span("vad", self._speech_started or speech_end, speech_end, frames=len(self.speech))
+            self.turn_trace.mark("speech_end", speech_end)
             try:
                 logger.debug(f"语音包的长度：{len(self.speech)}")
                 self.vad_start = False
                 voice_data = [d["voice"] for d in self.speech]
-                text, tmpfile = self.asr.recognizer(voice_data)
+                text = self.recognize(voice_data)
                 self.speech = []
             except Exception as e:
                 self.vad_start = False
@@ -632,25 +823,45 @@ class Robot(ABC):
             logger.debug(f"ASR识别结果: {text}")
             if self.callback:
                 self.callback({"role": "user", "content": str(text)})
-            self.executor.submit(self.chat, text)
+            self.pools.chat.submit(self.chat, text)
         return True
 
     def _tts_priority(self):
+        def fill(window):
+            # 窗口为空时等待新的句子，否则只取已经到达的句子，不耽误播放窗口头部的句子
+            while not window.full():
+                try:
+                    window.add(*self.tts_queue.get(block=len(window) == 0, timeout=0.1))
+                except queue.Empty:
+                    return
+
         def priority_thread():
+            window = self.speech_window
             while not self.stop_event.is_set():
                 try:
-                    future = self.tts_queue.get()
+                    fill(window)
+                    segment = window.head()
+                    if segment is None:
+                        continue
                     try:
-                        tts_file = future.result(timeout=1000)
+                        # 等待时间较短，期间到达的句子可以及时加入窗口开始生成
+                        audio = segment.future.result(timeout=max(0.0, min(0.05, segment.remaining())))
+                    except CancelledError:
+                        window.discard(segment)
+                        continue
                     except TimeoutError:
-                        logger.error("TTS 任务超时")
+                        if segment.remaining() <= 0:
+                            window.skip(segment, "生成超时")
                         continue
                     except Exception as e:
-                        logger.error(f"TTS 任务出错: {e}")
+                        window.skip(segment, f"生成出错: {e}")
                         continue
-                    if tts_file is None:
+                    window.discard(segment)
+                    if audio is None or segment.cancel.is_set():
                         continue
-                    self.player.play(tts_file)
+                    self.mark_spoken(segment.text)
+                    segment.trace.mark("first_audio")
+                    self.player.enqueue(audio)
                 except Exception as e:
                     logger.error(f"tts_priority priority_thread: {e}")
         tts_priority = threading.Thread(target=priority_thread, daemon=True)
@@ -661,7 +872,7 @@ class Robot(ABC):
             while not self.stop_event.is_set():
                 try:
                     data = self.audio_queue.get()
-                    vad_statue = self.vad.is_vad(data)
+                    vad_statue = self.detect_vad(data)
                     self.vad_queue.put({"voice": data, "vad_statue": vad_statue})
                 except Exception as e:
                     logger.error(f"VAD 处理出错: {e}")
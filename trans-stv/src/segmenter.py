@@ -0,0 +1,141 @@
+import logging
+import re
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 句末标点，遇到即可断句
+STRONG_BREAKS = set("。！？.!?；;…\n")
+# 句中停顿，首句或长度足够时断句
+WEAK_BREAKS = set("，,、：:")
+# 夹在数字中间时不是断点：3.14、1,000、10:30
+NUMERIC_SEPARATORS = set(".,:")
+# 英文句点后面跟空白才算句末，避免把网址、版本号断开
+ASCII_PERIOD = "."
+# 句点后面跟空白也不是句末的常见英文缩写（小写，不含最后的句点）；e.g.、U.S. 这类带点的缩写另外判断
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "approx", "e.g", "i.e"}
+# 跟在标点后面的引号、括号，归到前一句
+CLOSERS = set("”’\"'）)」』】》")
+# 含有文字或数字的片段才值得合成语音
+_SPEAKABLE = re.compile(r"[0-9A-Za-z一-鿿]")
+
+
+class SentenceSegmenter:
+    """
+    流式断句：LLM 每生成一段文本调用 feed，返回可以送去 TTS 的完整片段；回复结束时调用 flush 取出剩余部分。
+    - 首个片段使用更小的最小长度，尽快发出第一句语音
+    - 之后的片段至少 min_chars 个字，在句末标点或句中停顿处断开
+    - 超过 max_chars 仍没有断点时强制切分，但不会切断数字和英文单词
+    - 数字中的小数点、千分位、时间的冒号不作为断点
+    - 常见英文缩写（Mr.、Dr.、e.g.、U.S.）的句点不作为断点
+    只扫描新到达的文本，不会反复拼接已经处理过的内容。
+    """
+
+    def __init__(self, min_chars: int = 10, max_chars: int = 60, first_min_chars: int = 4):
+        self.min_chars = min_chars
+        self.max_chars = max(max_chars, min_chars)
+        self.first_min_chars = first_min_chars
+        self._buffer = ""
+        # 已扫描过、确认不是断点的位置
+        self._pos = 0
+        self._first = True
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            min_chars=config.get("min_chars", 10),
+            max_chars=config.get("max_chars", 60),
+            first_min_chars=config.get("first_min_chars", 4),
+        )
+
+    def feed(self, text: str) -> List[str]:
+        if not text:
+            return []
+        self._buffer += text
+        chunks = []
+        while True:
+            end = self._find_break()
+            if end is None:
+                break
+            chunk = self._emit(end)
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def flush(self) -> Optional[str]:
+        """回复结束，返回剩余的文本"""
+        chunk = self._emit(len(self._buffer)) if self._buffer else None
+        self._first = True
+        return chunk
+
+    def _emit(self, end: int) -> Optional[str]:
+        chunk, self._buffer = self._buffer[:end].strip(), self._buffer[end:]
+        self._pos = 0
+        if not _SPEAKABLE.search(chunk):
+            return None
+        self._first = False
+        return chunk
+
+    def _min_length(self) -> int:
+        return self.first_min_chars if self._first else self.min_chars
+
+    def _find_break(self) -> Optional[int]:
+        """返回断句位置（片段结束的下标），没有可用断点时返回 None"""
+        buffer = self._buffer
+        length = len(buffer)
+        i = self._pos
+        while i < length:
+            ch = buffer[i]
+            if ch in STRONG_BREAKS or ch in WEAK_BREAKS:
+                prev = buffer[i - 1] if i > 0 else ""
+                if ch in NUMERIC_SEPARATORS and prev.isdigit():
+                    if i == length - 1:
+                        # 还不知道后面是不是数字，等下一段文本
+                        break
+                    if buffer[i + 1].isdigit():
+                        i += 1
+                        continue
+                if ch == ASCII_PERIOD and prev.isascii() and prev.isalpha():
+                    if i == length - 1:
+                        break
+                    if not buffer[i + 1].isspace() or _is_abbreviation(buffer, i):
+                        i += 1
+                        continue
+                end = i + 1
+                # 连续的标点和后面的引号、括号归到同一句
+                while end < length and (buffer[end] in STRONG_BREAKS or buffer[end] in CLOSERS):
+                    end += 1
+                if len(buffer[:end].strip()) >= self._min_length():
+                    return end
+            i += 1
+        self._pos = i
+        if len(buffer.strip()) > self.max_chars:
+            return self._force_cut()
+        return None
+
+    def _force_cut(self) -> int:
+        """没有断点但已经太长时强制切分，往前退到不在数字或英文单词中间的位置"""
+        cut = self.max_chars
+        while cut > 0 and _splits_word(self._buffer, cut):
+            cut -= 1
+        return cut or self.max_chars
+
+
+def _is_abbreviation(buffer: str, index: int) -> bool:
+    """index 处的句点是否是英文缩写的一部分"""
+    start = index
+    while start > 0 and buffer[start - 1].isascii() and (buffer[start - 1].isalpha() or buffer[start - 1] == "."):
+        start -= 1
+    word = buffer[start:index].lower()
+    if word in ABBREVIATIONS:
+        return True
+    # e.g.、U.S.、a.m. 这类由一两个字母和句点组成的缩写
+    parts = word.split(".")
+    return len(parts) > 1 and all(0 < len(part) <= 2 for part in parts)
+
+
+def _splits_word(buffer: str, index: int) -> bool:
+    """index 处切开是否会把一个数字或英文单词断成两半"""
+    left, right = buffer[index - 1], buffer[index]
+    return left.isascii() and right.isascii() and (left.isalnum() or left == ".") and right.isalnum()
@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# WebSocket 关闭码（4000-4999 为应用自定义）
+CLOSE_SESSION_EXPIRED = 4000  # 会话空闲超时
+CLOSE_SESSION_EVICTED = 4001  # 会话数达到上限，最久未活跃的会话被回收
+
+
+class Session:
+    """一个用户的会话：Robot 实例、当前 websocket 以及最近活跃时间"""
+
+    def __init__(self, user_id: str, robot, websocket=None, text_only: bool = False):
+        self.user_id = user_id
+        self.robot = robot
+        self.websocket = websocket
+        # 过载时接入的会话只提供文字对话，不处理上行音频
+        self.text_only = text_only
+        self.last_active = time.monotonic()
+        # 事件驱动的会话处理流程（SessionPipeline），同一会话的对话在其中按顺序处理
+        self.pipeline = None
+
+
+class SessionManager:
+    """
+    会话管理：
+    - 空闲过期用最小堆保存截止时间，每个会话在堆里只有一项，活跃时只更新时间戳，
+      到期弹出时再检查，没过期就按新的截止时间重新入堆，过期检查 O(log n)
+    - 会话数超过 max_sessions 时按 LRU 回收最久未活跃的会话
+    - Robot 的释放（线程池关闭、播放器停止）放到独立线程池执行，不阻塞事件循环
+    """
+
+    def __init__(self, idle_timeout: float = 600, max_sessions: int = 100):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        # 按最近活跃时间排序，最久未活跃的在最前面
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._teardown_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-teardown")
+        self._releasing = set()
+        # 已移除会话的队列累计丢弃数，加上在线会话的丢弃数后只增不减
+        self.retired_dropped: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, user_id: str) -> Optional[Session]:
+        return self.sessions.get(user_id)
+
+    def touch(self, user_id: str):
+        session = self.sessions.get(user_id)
+        if session is None:
+            return
+        session.last_active = time.monotonic()
+        self.sessions.move_to_end(user_id)
+
+    def add(self, session: Session) -> List[Session]:
+        """加入新会话，返回因超出容量被回收的会话"""
+        self.sessions[session.user_id] = session
+        self.sessions.move_to_end(session.user_id)
+        self._push(session)
+        evicted = []
+        while len(self.sessions) > self.max_sessions:
+            _, oldest = self.sessions.popitem(last=False)
+            self._retire(oldest)
+            evicted.append(oldest)
+        self._wakeup.set()
+        return evicted
+
+    def remove(self, user_id: str) -> Optional[Session]:
+        # 堆中的旧项在弹出时发现会话已不存在，直接丢弃
+        session = self.sessions.pop(user_id, None)
+        if session is not None:
+            self._retire(session)
+        return session
+
+    def _retire(self, session: Session):
+        if session.pipeline is None:
+            return
+        for stats in session.pipeline.queue_stats():
+            self.retired_dropped[stats["name"]] = self.retired_dropped.get(stats["name"], 0) + stats["dropped"]
+
+    def _push(self, session: Session):
+        deadline = session.last_active + self.idle_timeout
+        heapq.heappush(self._deadlines, (deadline, next(self._seq), session.user_id, session))
+
+    def pop_expired(self, now: float) -> List[Session]:
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, user_id, session = heapq.heappop(self._deadlines)
+            if self.sessions.get(user_id) is not session:
+                continue
+            if session.last_active + self.idle_timeout > now:
+                self._push(session)
+                continue
+            self.sessions.pop(user_id, None)
+            self._retire(session)
+            expired.append(session)
+        return expired
+
+    def next_deadline(self) -> Optional[float]:
+        return self._deadlines[0][0] if self._deadlines else None
+
+    async def release(self, session: Session, close_code: int = CLOSE_SESSION_EXPIRED, reason: str = ""):
+        """停止会话处理流程，关闭 websocket，并在独立线程池中释放 Robot"""
+        if session.pipeline is not None:
+            session.pipeline.stop()
+        if session.websocket is not None:
+            try:
+                await session.websocket.close(code=close_code, reason=reason)
+            except Exception as e:
+                logger.debug(f"{session.user_id} 关闭websocket出错: {e}")
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._teardown_executor, session.robot.shutdown)
+            logger.info(f"{session.user_id} 对应的robot已释放")
+        except Exception as e:
+            logger.info(f"{session.user_id} 对应的robot释放 出错: {e}")
+
+    async def run(self):
+        """过期清理任务：睡眠到最近的截止时间，而不是定期扫描所有会话"""
+        while True:
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            for session in self.pop_expired(time.monotonic()):
+                logger.info(f"{session.user_id} 空闲超时，释放会话")
+                self.release_later(session, CLOSE_SESSION_EXPIRED, "session expired")
+
+    def release_later(self, session: Session, close_code: int, reason: str = ""):
+        task = asyncio.create_task(self.release(session, close_code, reason))
+        self._releasing.add(task)
+        task.add_done_callback(self._releasing.discard)
+
+    def shutdown(self):
+        self._teardown_executor.shutdown(wait=False)
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+# IPC 消息按行分隔，SDP 可能有几十KB，放宽单行长度限制
+IPC_LINE_LIMIT = 1024 * 1024
+# 没有指定房间时使用的默认房间
+DEFAULT_ROOM = "default"
+# 房间已满时关闭 websocket 使用的状态码
+CLOSE_ROOM_FULL = 4002
+# 等待信令中心确认加入房间的超时时间（秒）
+JOIN_TIMEOUT = 5
+
+
+class RoomFullError(Exception):
+    pass
+
+
+class RoomIndex:
+    """
+    房间索引：room_id -> {user_id: 值}，以及 user_id -> room_id。
+    查找通话对端只需要两次字典查找，与在线用户总数无关。
+    单进程模式下值是 websocket，信令中心里值是用户所在的 worker。
+    """
+
+    def __init__(self, max_room_size: int = 2):
+        self.max_room_size = max_room_size
+        self.rooms: Dict[str, Dict[str, Any]] = {}
+        self.user_rooms: Dict[str, str] = {}
+
+    def join(self, room_id: str, user_id: str, value):
+        # 同一用户重新加入时先离开原来的房间
+        if self.user_rooms.get(user_id) not in (None, room_id):
+            self.leave(user_id)
+        room = self.rooms.setdefault(room_id, {})
+        if user_id not in room and len(room) >= self.max_room_size:
+            raise RoomFullError(f"房间 {room_id} 已满")
+        room[user_id] = value
+        self.user_rooms[user_id] = room_id
+
+    def leave(self, user_id: str, value=None) -> Optional[str]:
+        """离开房间；传入 value 时只有值相同才移除，避免旧连接断开时把同一用户的新连接删掉"""
+        room_id = self.user_rooms.get(user_id)
+        if room_id is None:
+            return None
+        room = self.rooms.get(room_id, {})
+        if value is not None and room.get(user_id) is not value and room.get(user_id) != value:
+            return None
+        room.pop(user_id, None)
+        self.user_rooms.pop(user_id, None)
+        if not room:
+            self.rooms.pop(room_id, None)
+        return room_id
+
+    def get(self, user_id: str):
+        room_id = self.user_rooms.get(user_id)
+        if room_id is None:
+            return None
+        return self.rooms[room_id].get(user_id)
+
+    def peers(self, user_id: str, target: str = None) -> List[Tuple[str, Any]]:
+        """返回信令消息的接收方：指定了 target 时只发给 target，否则发给同房间的其他成员"""
+        room_id = self.user_rooms.get(user_id)
+        if room_id is None:
+            return []
+        room = self.rooms[room_id]
+        if target is not None:
+            return [(target, room[target])] if target in room and target != user_id else []
+        return [(uid, value) for uid, value in room.items() if uid != user_id]
+
+
+class Signaling:
+    """单进程模式的 WebRTC 信令转发，所有连接都在本进程内"""
+
+    def __init__(self, max_room_size: int = 2):
+        self.index = RoomIndex(max_room_size)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def join(self, user_id: str, websocket: WebSocket, room_id: str = DEFAULT_ROOM):
+        """加入房间，房间已满时抛出 RoomFullError"""
+        self.index.join(room_id, user_id, websocket)
+
+    async def leave(self, user_id: str, websocket: WebSocket = None):
+        self.index.leave(user_id, websocket)
+
+    async def relay(self, user_id: str, data: str, target: str = None):
+        """转发信令消息给同一房间里的通话对端"""
+        peers = self.index.peers(user_id, target)
+        if not peers:
+            logger.info(f"用户 {user_id} 的房间里没有对端，丢弃信令消息")
+        for _, websocket in peers:
+            await websocket.send_text(data)
+
+    async def deliver(self, user_id: str, data: str):
+        websocket = self.index.get(user_id)
+        if websocket is None:
+            logger.warning(f"用户 {user_id} 不在本进程，丢弃信令消息")
+            return
+        await websocket.send_text(data)
+
+
+class IPCSignaling(Signaling):
+    """
+    多进程模式：通话双方可能被分配到不同的 worker，
+    信令消息通过本机 Unix socket 交给 SignalingHub，再由 Hub 投递到对方所在的 worker。
+    """
+
+    def __init__(self, socket_path: str, worker_id: str, max_room_size: int = 2):
+        super().__init__(max_room_size)
+        self.socket_path = socket_path
+        self.worker_id = worker_id
+        self._reader = None
+        self._writer = None
+        self._listen_task = None
+        # 等待信令中心答复的 join 请求：序号 -> Future
+        self._joins: Dict[int, asyncio.Future] = {}
+        self._join_seq = 0
+
+    async def start(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path, limit=IPC_LINE_LIMIT)
+        await self._send({"op": "register", "worker": self.worker_id})
+        self._listen_task = asyncio.create_task(self._listen())
+        logger.info(f"worker {self.worker_id} 已连接信令中心 {self.socket_path}")
+
+    async def stop(self):
+        if self._listen_task:
+            self._listen_task.cancel()
+        if self._writer:
+            self._writer.close()
+
+    async def _send(self, message: dict):
+        self._writer.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+        await self._writer.drain()
+
+    async def _listen(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                logger.error("信令中心连接已断开")
+                return
+            try:
+                message = json.loads(line)
+                if message.get("op") == "deliver":
+                    await self.deliver(message["to"], message["data"])
+                elif message.get("op") == "joined":
+                    future = self._joins.pop(message["seq"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+            except Exception as e:
+                logger.error(f"处理信令中心消息出错: {e}")
+
+    async def join(self, user_id: str, websocket: WebSocket, room_id: str = DEFAULT_ROOM):
+        """
+        房间成员可能分布在多个 worker，容量以信令中心为准：本进程先记录连接，再等待信令中心答复，
+        房间已满时移除本地记录并抛出 RoomFullError
+        """
+        self.index.rooms.setdefault(room_id, {})[user_id] = websocket
+        self.index.user_rooms[user_id] = room_id
+        self._join_seq += 1
+        seq = self._join_seq
+        future = asyncio.get_running_loop().create_future()
+        self._joins[seq] = future
+        await self._send({"op": "join", "seq": seq, "user_id": user_id, "room_id": room_id})
+        try:
+            result = await asyncio.wait_for(future, JOIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._joins.pop(seq, None)
+            logger.warning(f"信令中心 {JOIN_TIMEOUT} 秒内没有确认用户 {user_id} 加入房间 {room_id}")
+            return
+        if not result.get("ok"):
+            self.index.leave(user_id, websocket)
+            raise RoomFullError(result.get("error") or f"房间 {room_id} 已满")
+
+    async def leave(self, user_id: str, websocket: WebSocket = None):
+        if self.index.leave(user_id, websocket) is not None:
+            await self._send({"op": "leave", "user_id": user_id})
+
+    async def relay(self, user_id: str, data: str, target: str = None):
+        await self._send({"op": "relay", "from": user_id, "target": target, "data": data})
+
+
+class SignalingHub:
+    """运行在分发进程中的信令中心，记录每个用户所在的 worker 并转发消息"""
+
+    def __init__(self, socket_path: str, max_room_size: int = 2):
+        self.socket_path = socket_path
+        self.workers: Dict[str, asyncio.StreamWriter] = {}
+        # 房间成员 -> 所在的 worker_id
+        self.index = RoomIndex(max_room_size)
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.socket_path, limit=IPC_LINE_LIMIT)
+        logger.info(f"信令中心已启动: {self.socket_path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "register":
+                    worker_id = message["worker"]
+                    self.workers[worker_id] = writer
+                elif op == "join":
+                    reply = {"op": "joined", "seq": message.get("seq"), "ok": True}
+                    try:
+                        self.index.join(message.get("room_id", DEFAULT_ROOM), message["user_id"], worker_id)
+                    except RoomFullError as e:
+                        logger.warning(f"{e}，用户 {message['user_id']} 加入失败")
+                        reply.update(ok=False, error=str(e))
+                    await self._write(writer, reply)
+                elif op == "leave":
+                    self.index.leave(message["user_id"], worker_id)
+                elif op == "relay":
+                    await self._relay(message["from"], message["data"], message.get("target"))
+        except Exception as e:
+            logger.error(f"worker {worker_id} 信令连接出错: {e}")
+        finally:
+            if worker_id is not None:
+                self.workers.pop(worker_id, None)
+                for uid in [uid for uid in self.index.user_rooms if self.index.get(uid) == worker_id]:
+                    self.index.leave(uid)
+            writer.close()
+
+    async def _relay(self, user_id: str, data: str, target: str = None):
+        for uid, worker_id in self.index.peers(user_id, target):
+            await self._deliver(worker_id, uid, data)
+
+    async def _deliver(self, worker_id: str, user_id: str, data: str):
+        writer = self.workers.get(worker_id)
+        if writer is None:
+            return
+        await self._write(writer, {"op": "deliver", "to": user_id, "data": data})
+
+    @staticmethod
+    async def _write(writer: asyncio.StreamWriter, message: dict):
+        writer.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+        await writer.drain()
+
+
+def create_signaling(socket_path: str = None, worker_id: str = None, max_room_size: int = 2) -> Signaling:
+    if socket_path:
+        return IPCSignaling(socket_path, worker_id, max_room_size)
+    return Signaling(max_room_size)
@@ -110,6 +110,15 @@ class SadTalker(AbstractTHG):
             logger.error(f"视频生成失败: {e}")
             return None
 
+class NullTHG(AbstractTHG):
+    """不生成数字人视频，用于离线基准测试或不需要数字人的部署"""
+
+    def __init__(self, config=None):
+        pass
+
+    def to_thg(self, driven_audio):
+        return None
+
 def create_instance(class_name, *args, **kwargs):
     # 获取类对象
     cls = globals().get(class_name)
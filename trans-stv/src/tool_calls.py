@@ -0,0 +1,115 @@
+import json
+import logging
+import re
+import uuid
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 回复中的代码块，模型按系统提示词把工具调用写成 ```json {"function_name":..., "args":{...}}```
+_CODE_BLOCK = re.compile(r"```(?:json)?\s*\n?([\s\S]*?)\n?```", re.IGNORECASE)
+# 没有代码块时，匹配花括号包围的JSON对象（最多嵌套一层）
+_JSON_OBJECT = re.compile(r"(\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\})")
+
+
+class ToolCall:
+    """一次工具调用：函数名、参数和调用 id"""
+
+    def __init__(self, name: str, arguments: Dict = None, call_id: str = None):
+        self.id = call_id or uuid.uuid4().hex
+        self.name = name
+        self.arguments = arguments or {}
+
+    def to_message(self) -> Dict:
+        """写入对话历史中助手消息的 tool_calls 格式，参数保持为对象（Ollama 要求）"""
+        return {"id": self.id, "type": "function", "function": {"name": self.name, "arguments": self.arguments}}
+
+    def __repr__(self):
+        return f"ToolCall({self.name}, {json.dumps(self.arguments, ensure_ascii=False)})"
+
+
+def _field(obj, name):
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def _parse_arguments(arguments) -> Optional[Dict]:
+    if arguments is None or arguments == "":
+        return {}
+    if isinstance(arguments, dict):
+        return arguments
+    try:
+        arguments = json.loads(arguments)
+    except (TypeError, json.JSONDecodeError) as e:
+        logger.error(f"工具参数解析失败: {e}, 参数: {arguments}")
+        return None
+    return arguments if isinstance(arguments, dict) else None
+
+
+def _calls_from_json(data) -> List[ToolCall]:
+    items = data if isinstance(data, list) else [data]
+    calls = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("function_name"):
+            continue
+        arguments = _parse_arguments(item.get("args"))
+        if arguments is not None:
+            calls.append(ToolCall(item["function_name"], arguments))
+    return calls
+
+
+def extract_tool_calls(content: str) -> List[ToolCall]:
+    """从回复文本中提取所有工具调用，每个代码块可以是一个调用对象或调用列表"""
+    if not content:
+        return []
+    blocks = _CODE_BLOCK.findall(content) or _JSON_OBJECT.findall(content)
+    calls = []
+    for block in blocks:
+        block = block.strip()
+        if not block:
+            continue
+        try:
+            data = json.loads(block)
+        except json.JSONDecodeError as e:
+            logger.error(f"工具调用JSON解析失败: {e}, 原始内容: {block}")
+            continue
+        calls.extend(_calls_from_json(data))
+    return calls
+
+
+class ToolCallCollector:
+    """
+    收集一次LLM回复中的所有工具调用。原生的 tool_calls 可能分多个 chunk 到达：
+    带 index 的增量（OpenAI 格式）按 index 拼接参数，不带 index 的（Ollama 格式）每个都是完整的调用。
+    没有原生 tool_calls 时从回复文本中提取。
+    """
+
+    def __init__(self):
+        self._native: Dict[int, Dict] = {}
+
+    def add(self, tool_calls):
+        for call in tool_calls or []:
+            index = _field(call, "index")
+            if index is None:
+                index = len(self._native)
+            entry = self._native.setdefault(index, {"id": None, "name": None, "arguments": None})
+            function = _field(call, "function") or {}
+            if _field(call, "id"):
+                entry["id"] = _field(call, "id")
+            if _field(function, "name"):
+                entry["name"] = _field(function, "name")
+            arguments = _field(function, "arguments")
+            if isinstance(arguments, str) and isinstance(entry["arguments"], str):
+                entry["arguments"] += arguments
+            elif arguments is not None:
+                entry["arguments"] = arguments
+
+    def calls(self, content: str = None) -> List[ToolCall]:
+        calls = []
+        for index in sorted(self._native):
+            entry = self._native[index]
+            arguments = _parse_arguments(entry["arguments"])
+            if not entry["name"] or arguments is None:
+                logger.error(f"忽略无效的工具调用: {entry}")
+                continue
+            calls.append(ToolCall(entry["name"], arguments, entry["id"]))
+        return calls or extract_tool_calls(content)
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """一个阶段的耗时，start/end 为 time.time() 秒"""
+
+    def __init__(self, trace: "Trace", name: str, start: float = None, attributes: Dict = None):
+        self.trace = trace
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.end_time: Optional[float] = None
+        self.attributes = dict(attributes or {})
+
+    def elapsed_ms(self) -> float:
+        return (time.time() - self.start) * 1000
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, end: float = None, **attributes):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time() if end is None else end
+        self.attributes.update(attributes)
+        self.trace._add(self)
+
+    def to_dict(self, origin: float) -> Dict:
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 1),
+            "duration_ms": round((self.end_time - self.start) * 1000, 1),
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """
+    一轮对话的时间线。各阶段在不同线程中执行，span 结束时加入 trace；
+    finish 后导出为一行 JSON，之后结束的 span 忽略。
+    """
+
+    def __init__(self, tracer: "Tracer", attributes: Dict = None, start: float = None):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        self.start = time.time() if start is None else start
+        self.attributes = dict(attributes or {})
+        self.spans: List[Span] = []
+        # 只记录第一次出现的时间点，例如第一段语音开始播放（first_audio）
+        self.marks: Dict[str, float] = {}
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def start_span(self, name: str, start: float = None, **attributes) -> Span:
+        return Span(self, name, start, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.set("error", repr(e))
+            raise
+        finally:
+            span.end()
+
+    def add_span(self, name: str, start: float, end: float, **attributes):
+        """记录一段已经测量好的区间，例如VAD检测到的语音段"""
+        self.start_span(name, start, **attributes).end(end)
+
+    def mark(self, name: str, at: float = None):
+        with self._lock:
+            if not self.finished and name not in self.marks:
+                self.marks[name] = time.time() if at is None else at
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def _add(self, span: Span):
+        with self._lock:
+            if not self.finished:
+                self.spans.append(span)
+
+    def finish(self, **attributes):
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.attributes.update(attributes)
+            end = time.time()
+        self.tracer.export(self, end)
+
+    def to_dict(self, end: float) -> Dict:
+        origin = min([self.start] + [s.start for s in self.spans])
+        # 首音延迟：从用户说完（文字消息为收到消息）到第一段语音开始播放
+        ttfa = None
+        if "first_audio" in self.marks:
+            ttfa = round((self.marks["first_audio"] - self.marks.get("speech_end", self.start)) * 1000, 1)
+        return {
+            "trace_id": self.trace_id,
+            "start": datetime.fromtimestamp(origin).isoformat(timespec="milliseconds"),
+            "duration_ms": round((end - origin) * 1000, 1),
+            "ttfa_ms": ttfa,
+            "attributes": self.attributes,
+            "marks": {name: round((t - origin) * 1000, 1) for name, t in self.marks.items()},
+            "spans": [s.to_dict(origin) for s in sorted(self.spans, key=lambda s: s.start)],
+        }
+
+
+class NullTrace(Trace):
+    """关闭追踪或未被采样时使用，所有操作都不记录"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.finished = True
+
+    def finish(self, **attributes):
+        pass
+
+
+class Tracer:
+    """
+    每轮对话一个 trace，结束时以 JSON Lines 追加到 directory/turns-<日期>.jsonl，
+    每行包含 trace_id、各阶段（vad、asr、llm、tools、tts、prepare、thg）的相对开始时间和耗时。
+    """
+
+    def __init__(self, directory: str = "tmp/traces/", enabled: bool = False, sample_rate: float = 1.0):
+        self.directory = directory
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            directory=config.get("directory", "tmp/traces/"),
+            enabled=config.get("enabled", False),
+            sample_rate=config.get("sample_rate", 1.0),
+        )
+
+    def start_trace(self, start: float = None, **attributes) -> Trace:
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return NullTrace()
+        return Trace(self, attributes, start)
+
+    def export(self, trace: Trace, end: float):
+        line = json.dumps(trace.to_dict(end), ensure_ascii=False)
+        file_path = os.path.join(self.directory, f"turns-{datetime.now().strftime('%Y-%m-%d')}.jsonl")
+        try:
+            with self._lock, open(file_path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+        except OSError as e:
+            logger.error(f"写入追踪数据失败: {e}")
+
+
+_tracer = Tracer()
+_tracer_lock = threading.Lock()
+
+
+def configure(config) -> Tracer:
+    """按配置创建进程内共享的 Tracer，只在第一次调用时生效"""
+    global _tracer
+    with _tracer_lock:
+        if config and not _tracer.enabled and config.get("enabled"):
+            _tracer = Tracer.from_config(config)
+    return _tracer
+
+
+def get_tracer() -> Tracer:
+    return _tracer
@@ -4,6 +4,7 @@ import os
 import subprocess
 import time
 import uuid
+import wave
 from abc import ABC, ABCMeta, abstractmethod
 from datetime import datetime
 
@@ -199,6 +200,38 @@ class KOKOROTTS(AbstractTTS):
             return None
 
 
+class SilentTTS(AbstractTTS):
+    """
+    生成静音 wav 的TTS，不依赖外部服务，用于离线基准测试（benchmark.py）。
+    每次转换固定等待 latency_ms，音频时长按字数估算，使下游播放耗时和真实TTS接近
+    """
+
+    def __init__(self, config):
+        config = config or {}
+        self.output_file = config.get("output_file", "tmp/")
+        self.latency_ms = config.get("latency_ms", 100)
+        self.seconds_per_char = config.get("seconds_per_char", 0.2)
+        self.sample_rate = config.get("sample_rate", 16000)
+        os.makedirs(self.output_file, exist_ok=True)
+
+    def _generate_filename(self, extension=".wav"):
+        return os.path.join(self.output_file, f"tts-{datetime.now().date()}@{uuid.uuid4().hex}{extension}")
+
+    def to_tts(self, text):
+        tmpfile = self._generate_filename(".wav")
+        time.sleep(self.latency_ms / 1000)
+        frames = int(len(text) * self.seconds_per_char * self.sample_rate)
+        try:
+            with wave.open(tmpfile, "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(self.sample_rate)
+                wav.writeframes(b"\x00\x00" * frames)
+            return tmpfile
+        except Exception as e:
+            logger.error(f"Failed to generate TTS file: {e}")
+            return None
+
 
 def create_instance(class_name, *args, **kwargs):
     # 获取类对象
@@ -3,14 +3,23 @@ import uuid
 import wave
 from abc import ABC, abstractmethod
 import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime
 
 import numpy as np
 import torch
 from silero_vad import load_silero_vad, VADIterator
 
+from src.executors import settle
+
 logger = logging.getLogger(__name__)
 
+# 批量推理直接读写的模型内部状态，silero-vad 5.x 的 ONNX 模型（OnnxWrapper）才有
+BATCH_STATE_ATTRS = ("_state", "_context", "_last_sr", "_last_batch_size")
+
 
 class VAD(ABC):
     @abstractmethod
@@ -21,10 +30,166 @@ class VAD(ABC):
         pass
 
 
+class _Request:
+    __slots__ = ("session", "x", "sr", "future")
+
+    def __init__(self, session, x, sr, future):
+        self.session = session
+        self.x = x
+        self.sr = sr
+        self.future = future
+
+
+class SileroModel:
+    """
+    Silero 权重，进程内只加载一次，由所有会话共享。
+    所有会话的推理交给一个批处理线程：每一拍（batch_window_ms）收集各会话排队的帧，
+    把各自的循环状态拼成一个 batch 只调用一次模型，再把输出和新状态按会话拆开。
+    同一会话的帧按顺序进入不同的 batch，保证循环状态依次更新。
+    拼接状态依赖 ONNX 模型的内部属性（BATCH_STATE_ATTRS），加载后检查不到这些属性时
+    退回每个会话一个独立的模型，仍由批处理线程逐帧推理。
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.onnx = config.get("onnx", True)
+        self.model = load_silero_vad(onnx=self.onnx)
+        self.batched = all(hasattr(self.model, name) for name in BATCH_STATE_ATTRS)
+        if not self.batched:
+            logger.warning(f"Silero VAD 模型（onnx={self.onnx}）没有 {BATCH_STATE_ATTRS} 状态，不能批量推理，每个会话使用独立的模型")
+        self.lock = threading.Lock()
+        self.batch_window = config.get("batch_window_ms", 5) / 1000
+        self.max_batch = config.get("max_batch", 64)
+        # 复用的输入 batch，避免每拍分配新的 tensor
+        self._batch = None
+        self._requests = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        # 统计：推理次数和处理的帧数，两者之比为平均 batch 大小
+        self.batches = 0
+        self.frames = 0
+        logger.info("Silero VAD 模型加载完成")
+
+    def session(self):
+        if self.batched:
+            return SileroSession(self)
+        return SileroSession(self, load_silero_vad(onnx=self.onnx))
+
+    def infer(self, session, x, sr) -> Future:
+        """提交一帧，返回结果为该帧语音概率（形状为 (1,) 的 tensor）的 Future"""
+        future = Future()
+        with self._cond:
+            self._requests.append(_Request(session, x, sr, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="silero-batch")
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        """取出一个 batch：每个会话最多一帧、采样率相同，其余的帧保持顺序留到下一拍"""
+        batch, deferred, sessions = [], [], set()
+        sr = self._requests[0].sr
+        while self._requests and len(batch) < self.max_batch:
+            request = self._requests.popleft()
+            if request.session in sessions or request.sr != sr:
+                deferred.append(request)
+                continue
+            sessions.add(request.session)
+            batch.append(request)
+        self._requests.extendleft(reversed(deferred))
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._requests:
+                    self._cond.wait()
+            # 等这一拍内其他会话的帧到达
+            if self.batch_window > 0:
+                time.sleep(self.batch_window)
+            with self._cond:
+                batch = self._next_batch()
+            try:
+                outputs = self._forward(batch)
+            except Exception as e:
+                logger.error(f"Silero VAD 批量推理出错: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, output in zip(batch, outputs):
+                request.future.set_result(output)
+
+    def _stack(self, frames):
+        """把各会话的帧复制进复用的 batch tensor；帧长度不一致时退回 torch.stack"""
+        size = frames[0].shape[-1]
+        if any(frame.shape[-1] != size for frame in frames):
+            return torch.stack(frames)
+        if self._batch is None or self._batch.shape[0] < len(frames) or self._batch.shape[1] != size:
+            self._batch = torch.zeros((max(self.max_batch, len(frames)), size))
+        batch = self._batch[:len(frames)]
+        torch.stack(frames, out=batch)
+        return batch
+
+    @staticmethod
+    def _initial_state(sr):
+        context_size = 64 if sr == 16000 else 32
+        return torch.zeros((2, 1, 128)), torch.zeros((1, context_size))
+
+    @torch.no_grad()
+    def _forward(self, batch):
+        sr = batch[0].sr
+        if not self.batched:
+            # 各会话的模型自己保存循环状态，逐个推理
+            outputs = [request.session.model(request.x, sr) for request in batch]
+            self.batches += len(batch)
+            self.frames += len(batch)
+            return outputs
+        states = [request.session.states or self._initial_state(sr) for request in batch]
+        model = self.model
+        with self.lock:
+            # 把各会话的状态拼成 batch，模型看到的 batch 大小与上次一致时不会重置状态
+            model._state = torch.cat([state for state, _ in states], dim=1)
+            model._context = torch.cat([context for _, context in states], dim=0)
+            model._last_sr = sr
+            model._last_batch_size = len(batch)
+            out = model(self._stack([request.x for request in batch]), sr)
+            state, context = model._state, model._context
+        for i, request in enumerate(batch):
+            request.session.states = (state[:, i:i + 1], context[i:i + 1])
+        self.batches += 1
+        self.frames += len(batch)
+        return [out[i] for i in range(len(batch))]
+
+
+class SileroSession:
+    """
+    单个会话的 Silero 状态句柄，实现 VADIterator 需要的 reset_states() 和 __call__()。
+    states 为 (循环状态, 上下文)，None 表示初始状态；model 为不能批量推理时本会话独立的模型
+    """
+
+    def __init__(self, shared: SileroModel, model=None):
+        self.shared = shared
+        self.model = model
+        self.states = None
+        # 异步检测时已经由批处理算好的概率，VADIterator 调用 __call__ 时直接返回
+        self.ready = None
+
+    def reset_states(self):
+        self.states = None
+        if self.model is not None:
+            self.model.reset_states()
+
+    def __call__(self, x, sr):
+        if self.ready is not None:
+            return self.ready
+        return self.shared.infer(self, x, sr).result()
+
+
 class SileroVAD(VAD):
-    def __init__(self, config):
-        print("SileroVAD", config)
-        self.model = load_silero_vad()
+    def __init__(self, config, shared=None):
+        self.shared = shared if shared is not None else SileroModel(config)
+        self.model = self.shared.session()
         self.sampling_rate = config.get("sampling_rate")
         self.threshold = config.get("threshold")
         self.min_silence_duration_ms = config.get("min_silence_duration_ms")
@@ -32,21 +197,68 @@ class SileroVAD(VAD):
                             threshold=self.threshold,
                             sampling_rate=self.sampling_rate,
                             min_silence_duration_ms=self.min_silence_duration_ms)
+        # 复用的输入帧：int16 原地转换成 float32 写入这个 tensor（numpy 视图与 tensor 共享内存）
+        self._frame = torch.zeros(512 if self.sampling_rate == 16000 else 256)
+        self._frame_np = self._frame.numpy()
         logger.debug(f"VAD Iterator initialized with model {self.model}")
 
     @staticmethod
-    def int2float(sound):
+    def int2float(sound, out=None):
         """
         Convert int16 audio data to float32.
+        out 为长度相同的 float32 数组时原地转换，不分配新的数组
         """
-        sound = sound.astype(np.float32) / 32768.0
-        return sound
+        if out is None or out.shape != sound.shape:
+            return sound.astype(np.float32) / 32768.0
+        np.copyto(out, sound, casting="unsafe")
+        out *= 1 / 32768.0
+        return out
+
+    def _to_tensor(self, data):
+        """
+        帧转换成 float32 tensor。标准长度的帧写入复用的 self._frame，
+        因此同一会话需要等上一帧处理完再处理下一帧（VAD本来就按顺序处理）
+        """
+        audio_int16 = np.frombuffer(data, dtype=np.int16)
+        if audio_int16.shape == self._frame_np.shape:
+            self.int2float(audio_int16, self._frame_np)
+            return self._frame
+        return torch.from_numpy(self.int2float(audio_int16))
+
+    def is_vad_async(self, data) -> Future:
+        """
+        异步检测一帧：语音概率与其他会话的帧合并推理，算好后在批处理线程中更新本会话的 VADIterator，
+        返回结果为 None 或 {"start": ..} / {"end": ..} 的 Future。同一会话需要等上一帧完成再提交下一帧
+        """
+        result = Future()
+        try:
+            x = self._to_tensor(data)
+            prob = self.model.shared.infer(self.model, x, self.sampling_rate)
+        except Exception as e:
+            logger.error(f"Error in VAD processing: {e}")
+            result.set_result(None)
+            return result
+
+        def on_prob(future):
+            vad_output = None
+            try:
+                self.model.ready = future.result()
+                vad_output = self.vad_iterator(x)
+                if vad_output is not None:
+                    logger.debug(f"VAD output: {vad_output}")
+            except Exception as e:
+                logger.error(f"Error in VAD processing: {e}")
+            finally:
+                self.model.ready = None
+            # 会话已关闭时 Future 可能已被取消
+            settle(result, vad_output)
+
+        prob.add_done_callback(on_prob)
+        return result
 
     def is_vad(self, data):
         try:
-            audio_int16 = np.frombuffer(data, dtype=np.int16)
-            audio_float32 = self.int2float(audio_int16)
-            vad_output = self.vad_iterator(torch.from_numpy(audio_float32))
+            vad_output = self.vad_iterator(self._to_tensor(data))
             if vad_output is not None:
                 logger.debug(f"VAD output: {vad_output}")
             return vad_output
@@ -62,6 +274,13 @@ class SileroVAD(VAD):
             logger.error(f"Error resetting VAD states: {e}")
 
 
+def load_shared(class_name, config):
+    """加载可在会话间共享的 VAD 权重，没有共享部分的实现返回 None"""
+    if class_name == "SileroVAD":
+        return SileroModel(config)
+    return None
+
+
 def create_instance(class_name, *args, **kwargs):
     # 获取类对象
     cls = globals().get(class_name)